@@ -1,64 +1,266 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
+import atexit
+import copy
+import os
 import time
+from typing import Callable, List
 
 from icosagent.authmngr.authmngr import AuthManager
-from icosagent.config.config import read_config, DMConfig
-from icosagent.deploymngr.nuvla import nuvla_authn, Nuvla, \
-    DeploymentManagerNuvla
+from icosagent.config.config import read_config, DMConfig, DeployConf, \
+    JobManagerConf, LogConf, SchedulerConf
+from icosagent.deploymngr.limits import TokenBucket
+from icosagent.deploymngr.reaper import Reaper
+from icosagent.deploymngr.nuvla import nuvla_client, nuvla_login, Nuvla, \
+    DeploymentManagerNuvla, instrument_nuvla, rate_limit_nuvla
+from icosagent.health import Health
 from icosagent.jobmngr.jm import JobManagerProxy
-from icosagent.log import get_logger
+from icosagent.jobmngr.sync import JobSync
+from icosagent.jobmngr.workqueue import WorkQueue, queue_wait_sec
+from icosagent.log import get_logger, setup_logging
+from icosagent.metrics import REGISTRY, METRICS_PATH, Histogram
+from icosagent.replay import Recording, ReplayJM, ReplayReport, \
+    TrafficRecorder, record_jm, record_nuvla
+from icosagent.scheduler import PollScheduler
+from icosagent.server import AgentServer
+from icosagent.session import Session
 
 log = get_logger('main')
 
 CONFIG_PATH = '/etc/icos/dm.conf'
 
-SLEEP_SEC = 10
+job_to_launch_sec = REGISTRY.histogram(
+    'dm_job_to_launch_seconds',
+    'Time from job creation on the JM to its launch on Nuvla.')
+cycle_sec = REGISTRY.histogram(
+    'dm_cycle_seconds', 'Duration of poll and deploy cycles.',
+    labelnames=('outcome',))
+cycle_phase_sec = REGISTRY.histogram(
+    'dm_cycle_phase_seconds', 'Duration of the phases of the cycles.',
+    labelnames=('phase',))
+cycle_jobs = REGISTRY.histogram(
+    'dm_cycle_jobs', 'Jobs got from the JM per cycle.',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
 
 
-def sleep(sec=SLEEP_SEC):
-    log.info(f'Sleeping {sec} sec...')
-    time.sleep(sec)
+def observe_job_to_launch(deployments: list, deployed: list):
+    created = {}
+    for job in deployments:
+        ts = JobManagerProxy.job_created_at(job)
+        gid = job.get('job_group_id')
+        if ts is not None and (gid not in created or ts < created[gid]):
+            created[gid] = ts
+    now = time.time()
+    for gid in dict.fromkeys(d['job'] for d in deployed):
+        if gid in created:
+            job_to_launch_sec.observe(max(0.0, now - created[gid]))
+    if job_to_launch_sec.count:
+        log.info('Job to launch: mean %.1f sec, p99 <= %s sec, count %s',
+                 job_to_launch_sec.mean, job_to_launch_sec.quantile(0.99),
+                 job_to_launch_sec.count)
+
+
+def cycle(sync: JobSync, dm: DeploymentManagerNuvla,
+          nuvla_ready: Callable[[], bool] = None,
+          queue: WorkQueue = None) -> str:
+    """Runs one poll and deploy cycle. Returns `PollScheduler` outcome.
+    `nuvla_ready` tells, possibly after waiting, whether Nuvla can be used
+    yet; the JM is polled meanwhile. With `queue`, the jobs polled are
+    queued and only the next groups taken from the queue are deployed."""
+    start = time.perf_counter()
+    outcome = _poll_and_deploy(sync, dm, nuvla_ready, queue)
+    cycle_sec.labels(outcome=outcome).observe(time.perf_counter() - start)
+    return outcome
+
+
+def _poll_and_deploy(sync: JobSync, dm: DeploymentManagerNuvla,
+                     nuvla_ready: Callable[[], bool] = None,
+                     queue: WorkQueue = None) -> str:
+    jm = sync.jm
+    try:
+        log.info('Getting deployments to launch on Nuvla.')
+        with cycle_phase_sec.labels(phase='poll').time():
+            deployments = sync.changed() + dm.reclaim(jm)
+        cycle_jobs.observe(len(deployments))
+        if queue is not None:
+            if queue.put(deployments, sync.full):
+                sync.resync()
+            deployments = queue.take()
+        if not deployments:
+            log.info('No deployments to launch on Nuvla.')
+            return PollScheduler.IDLE
+    except Exception:
+        log.exception('Failed getting deployments to launch from ICOS JM.')
+        return PollScheduler.ERROR
+
+    if nuvla_ready and not nuvla_ready():
+        log.warning('Not logged in to Nuvla yet, deploying later.')
+        sync.resync()
+        return PollScheduler.ERROR
+
+    try:
+        log.info('Deploying %s deployments on Nuvla.', len(deployments))
+        with cycle_phase_sec.labels(phase='deploy').time():
+            deployed = dm.deploy(deployments, jm)
+        if deployed:
+            log.info('Deployed on Nuvla: %s', deployed)
+            observe_job_to_launch(deployments, deployed)
+        else:
+            log.info('Nothing was deployed on Nuvla.')
+        # Poll right away only if jobs left the JM queue, or are waiting in
+        # the work queue, so that failing jobs are not retried in a tight
+        # loop.
+        if dm.completed_jobs or (queue is not None and len(queue)):
+            return PollScheduler.BUSY
+        return PollScheduler.IDLE
+    except Exception:
+        log.exception('Failed starting deployments on Nuvla.')
+        return PollScheduler.ERROR
+
+
+def replay(recording: Recording, config: DMConfig, speed: float = 1.0,
+           drain: float = 60.0) -> ReplayReport:
+    """Runs the cycles of the agent on the jobs of `recording`, arriving
+    `speed` times faster than recorded, against simulated Nuvla with the
+    recorded call latencies. Stops once all the jobs are finished, or
+    `drain` seconds after the last one arrived. The launch journal and
+    sharding are not used."""
+    nuvla = recording.simulated_nuvla()
+    dm_config = copy.copy(config.dm)
+    dm_config.journal_path = ''
+    dm_config.replicas = 1
+    dm = DeploymentManagerNuvla(nuvla, dm_config)
+    replay_jm = ReplayJM()
+    sync = JobSync(replay_jm.proxy(copy.copy(config.jm)),
+                   config.jm.resync_interval)
+    # Waits of this replay only, not of the other ones in the process.
+    queue_wait = Histogram(queue_wait_sec.name, queue_wait_sec.help)
+    queue = WorkQueue(dm_config.queue_max_groups,
+                      dm_config.queue_max_launches, wait_sec=queue_wait)
+    scheduler = PollScheduler(config.scheduler)
+    if dm_config.confirm_started:
+        dm.tracker.start()
+
+    start = time.monotonic()
+    arrivals = replay_jm.play(recording.arrivals, speed)
+    arrived_at = None
+    try:
+        while True:
+            outcome = cycle(sync, dm, queue=queue)
+            if not arrivals.is_alive():
+                arrived_at = arrived_at or time.monotonic()
+                if not replay_jm.pending or \
+                        time.monotonic() - arrived_at >= drain:
+                    break
+            scheduler.wait(outcome)
+    finally:
+        dm.close()
+    return ReplayReport(replay_jm, nuvla, time.monotonic() - start,
+                        queue_wait)
+
+
+def _replay_config(conf_file: str) -> DMConfig:
+    # Tuning is taken from the configuration file when there is one.
+    if os.path.exists(conf_file):
+        return read_config(conf_file)
+    config = DMConfig()
+    config.jm = JobManagerConf()
+    config.dm = DeployConf()
+    config.scheduler = SchedulerConf()
+    config.log = LogConf()
+    return config
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='ICOS Deployment Manager for Nuvla.')
+    parser.add_argument('config', nargs='?', default=CONFIG_PATH,
+                        help=f'configuration file (default: {CONFIG_PATH})')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record the jobs got from ICOS JM and the '
+                             'timings of the Nuvla calls to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay the jobs recorded to FILE against '
+                             'simulated Nuvla, report and exit')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay the jobs SPEED times faster than '
+                             'recorded (default: 1)')
+    parser.add_argument('--drain', type=float, default=60.0,
+                        help='seconds to wait for the jobs to finish after '
+                             'the last one arrived (default: 60)')
+    return parser.parse_args(argv)
 
 
 def main():
-    if len(sys.argv) > 1:
-        conf_file = sys.argv[1]
-    else:
-        conf_file = CONFIG_PATH
-    config: DMConfig = read_config(conf_file)
+    args = parse_args()
+    if args.replay:
+        config = _replay_config(args.config)
+        setup_logging(config.log)
+        report = replay(Recording.load(args.replay), config, args.speed,
+                        args.drain)
+        print(report.summary())
+        return
 
-    auth_mngr = AuthManager(config.keycloak)
-    jm = JobManagerProxy(config.jm, auth_mngr)
+    config: DMConfig = read_config(args.config)
+    setup_logging(config.log)
 
-    nuvla_api: Nuvla = nuvla_authn(config.nuvla)
-    dm = DeploymentManagerNuvla(nuvla_api)
+    session = Session(config.http)
+    auth_mngr = AuthManager(config.keycloak, session)
+    jm = JobManagerProxy(config.jm, auth_mngr, session)
+    sync = JobSync(jm, config.jm.resync_interval)
 
-    while True:
-        try:
-            log.info('Getting deployments to launch on Nuvla.')
-            deployments = jm.deployments_to_launch()
-            if not deployments:
-                log.info('No deployments to launch on Nuvla.')
-                sleep()
-                continue
-        except Exception:
-            log.exception('Failed getting deployments to launch from ICOS JM.')
-            sleep()
-            continue
+    nuvla_api: Nuvla = nuvla_client(config.nuvla)
+    if args.record:
+        recorder = TrafficRecorder(args.record)
+        atexit.register(recorder.close)
+        record_jm(jm, recorder)
+        record_nuvla(nuvla_api, recorder)
+
+    health = Health(config.health)
+    instrument_nuvla(nuvla_api)
+    rate_limit_nuvla(nuvla_api, TokenBucket(config.dm.nuvla_rate,
+                                            config.dm.nuvla_burst))
+    dm = DeploymentManagerNuvla(nuvla_api, config.dm)
+    dm.register_metrics()
+    queue = WorkQueue(config.dm.queue_max_groups, config.dm.queue_max_launches)
+    queue.register_metrics()
 
+    def init_nuvla():
+        nuvla_login(nuvla_api, config.nuvla)
         try:
-            log.info(f'Deploying {len(deployments)} deployments on Nuvla.')
-            deployed = dm.deploy(deployments, jm)
-            if deployed:
-                log.info('Deployed on Nuvla: %s', deployed)
-            else:
-                log.info('Nothing was deployed on Nuvla.')
+            dm.load_modules_index()
+            dm.load_deployments_index()
         except Exception:
-            log.exception('Failed starting deployments on Nuvla.')
+            log.exception('Failed loading app modules from Nuvla.')
+
+    # Both logins run in the background, and the JM is polled meanwhile.
+    health.init('keycloak', auth_mngr.token)
+    health.init('nuvla', init_nuvla)
+    if config.dm.confirm_started:
+        dm.tracker.start()
+    # With several replicas, only the first one collects garbage.
+    if dm.sharding.index == 0:
+        Reaper(dm, jm, config.dm.gc_interval, config.dm.gc_dry_run,
+               config.dm.gc_min_age, config.dm.gc_page_size,
+               config.dm.gc_batch, config.dm.gc_rate).start()
+
+    scheduler = PollScheduler(config.scheduler)
+    server = AgentServer(config.server)
+    server.route('POST', PollScheduler.TRIGGER_PATH, scheduler.handle_trigger)
+    server.route('GET', METRICS_PATH, REGISTRY.handle_metrics)
+    server.route('GET', Health.READY_PATH, health.handle_ready)
+    server.route('GET', Health.LIVE_PATH, health.handle_live)
+    server.start()
 
-        sleep()
+    def nuvla_ready() -> bool:
+        return health.wait('nuvla', config.health.nuvla_wait)
+
+    while True:
+        outcome = cycle(sync, dm, nuvla_ready, queue)
+        health.beat()
+        scheduler.wait(outcome)
+        health.beat()
 
 
 if __name__ == '__main__':
@@ -12,3 +12,11 @@ url = {{ tpl .Values.nuvla.url . }}
 api_key = {{ tpl .Values.nuvla.apiKey . }}
 api_secret = {{ tpl .Values.nuvla.apiSecret . }}
 debug = {{ tpl .Values.nuvla.debug . }}
+
+[dm]
+launch_workers = {{ .Values.dm.launchWorkers }}
+replicas = {{ .Values.dm.replicas }}
+journal_path = {{ .Values.dm.statePath }}/dm-journal.jsonl
+
+[server]
+port = {{ .Values.dm.serverPort }}
@@ -1,32 +1,154 @@
 import json
+import threading
+import time
+from typing import Callable, Union
+
 import requests
 
 from icosagent.config.config import KeycloakConf
+from icosagent.session import Session
 from icosagent.log import get_logger
+from icosagent.metrics import REGISTRY
 
 
 log = get_logger('authmngr')
 
+token_request_sec = REGISTRY.histogram(
+    'keycloak_token_request_seconds', 'Latency of Keycloak token requests.',
+    labelnames=('grant_type',))
+token_request_failures = REGISTRY.counter(
+    'keycloak_token_request_failures_total', 'Failed Keycloak token requests.',
+    labelnames=('grant_type',))
+
 
 class AuthManager:
     """Implements
     curl -iv -d 'client_id=ID' -d 'client_secret=SECRET' \
         -d 'grant_type=client_credentials' 'https://keycloak/path'
+
+    The token is cached together with its expiry. `token()` refreshes it
+    in the background once it gets within `token_refresh_margin` seconds of
+    expiring, and blocks only when there is no valid token. Refreshes use
+    the refresh token when there is a valid one, and only one refresh runs
+    at a time.
     """
 
-    def __init__(self, config: KeycloakConf):
+    def __init__(self, config: KeycloakConf, session: requests.Session = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.session = session or Session()
         self.url = config.url
         self.client_id = config.client_id
         self.client_secret = config.client_secret
         self.grant_type = 'client_credentials'
+        self.refresh_margin = config.token_refresh_margin
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._access_token = None
+        self._refresh_at = 0.0
+        self._expires_at = 0.0
+        self._refresh_token = None
+        self._refresh_expires_at = 0.0
 
-    def get_token(self):
+    def _post(self, data: dict) -> dict:
+        grant_type = data.get('grant_type')
+        try:
+            with token_request_sec.labels(grant_type=grant_type).time():
+                res = self.session.post(self.url, data=data)
+            res.raise_for_status()
+            return json.loads(res.text)
+        except Exception:
+            token_request_failures.labels(grant_type=grant_type).inc()
+            raise
+
+    def _store(self, resp: dict, issued_at: float):
+        expires_in = resp.get('expires_in')
+        with self._lock:
+            self._access_token = resp['access_token']
+            if expires_in:
+                self._expires_at = issued_at + expires_in
+                self._refresh_at = issued_at + max(
+                    expires_in - self.refresh_margin, expires_in / 2)
+            else:
+                self._expires_at = self._refresh_at = float('inf')
+            if resp.get('refresh_token'):
+                self._refresh_token = resp['refresh_token']
+                self._refresh_expires_at = \
+                    issued_at + resp.get('refresh_expires_in', expires_in or 0)
+            return self._access_token
+
+    def _use_refresh_token(self) -> Union[dict, None]:
+        with self._lock:
+            refresh_token = self._refresh_token
+            if not refresh_token or \
+                    self._clock() >= self._refresh_expires_at:
+                return None
         data = {
             'client_id': self.client_id,
             'client_secret': self.client_secret,
-            'grant_type': self.grant_type
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
         }
-        log.info('Getting token for %s of type %s from %s', self.client_id,
-                 self.grant_type, self.url)
-        res = requests.post(self.url, data=data)
-        return json.loads(res.text)['access_token']
+        log.info('Refreshing token for %s from %s', self.client_id, self.url)
+        try:
+            return self._post(data)
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            log.warning('Failed refreshing token: %s', ex)
+            with self._lock:
+                self._refresh_token = None
+            return None
+
+    def get_token(self):
+        """Gets new token from Keycloak, with the refresh token if possible,
+        and caches it."""
+        issued_at = self._clock()
+        resp = self._use_refresh_token()
+        if resp is None:
+            data = {
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'grant_type': self.grant_type
+            }
+            log.info('Getting token for %s of type %s from %s',
+                     self.client_id, self.grant_type, self.url)
+            resp = self._post(data)
+        return self._store(resp, issued_at)
+
+    def _refresh(self, stale: Union[str, None]) -> str:
+        with self._refresh_lock:
+            with self._lock:
+                # Another caller has refreshed the token meanwhile.
+                if self._access_token != stale and \
+                        self._clock() < self._expires_at:
+                    return self._access_token
+            return self.get_token()
+
+    def _refresh_in_background(self, stale: str):
+        try:
+            self._refresh(stale)
+        except Exception:
+            log.exception('Failed refreshing token in background.')
+
+    def token(self) -> str:
+        """Returns cached token, refreshing it when needed."""
+        now = self._clock()
+        with self._lock:
+            token = self._access_token
+            refresh_at, expires_at = self._refresh_at, self._expires_at
+        if token and now < refresh_at:
+            return token
+        if token and now < expires_at:
+            if not self._refresh_lock.locked():
+                threading.Thread(target=self._refresh_in_background,
+                                 args=(token,), daemon=True,
+                                 name='token-refresh').start()
+            return token
+        return self._refresh(token)
+
+    def invalidate(self, token: str):
+        """Drops `token` if it is still the cached one, e.g. after it got
+        rejected."""
+        with self._lock:
+            if self._access_token == token:
+                self._access_token = None
+                self._refresh_at = self._expires_at = 0.0
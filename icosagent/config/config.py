@@ -7,6 +7,7 @@ class KeycloakConf:
     client_id: str
     client_secret: str
     grant_type: str = 'client_credentials'
+    token_refresh_margin = 30.0
 
 
 class NuvlaConf:
@@ -18,12 +19,88 @@ class NuvlaConf:
 
 class JobManagerConf:
     url: str
+    transition_workers = 4
+    bulk_uri = ''
+    resync_interval = 0.0
+
+
+class HttpConf:
+    pool_connections = 2
+    pool_maxsize = 10
+    connect_timeout = 5.0
+    read_timeout = 30.0
+
+
+class SchedulerConf:
+    min_interval = 1.0
+    max_interval = 30.0
+    backoff_factor = 2.0
+    jitter = 0.1
+
+
+class ServerConf:
+    host = '0.0.0.0'
+    port = 0
+
+
+class HealthConf:
+    retry_min_interval = 1.0
+    retry_max_interval = 60.0
+    nuvla_wait = 10.0
+    liveness_timeout = 300.0
+
+
+class LogConf:
+    format = 'text'
+    queue = False
+    queue_size = 10000
+    sample_burst = 0
+    sample_interval = 60.0
+
+
+class DeployConf:
+    launch_workers = 1
+    lock_before_launch = False
+    creds_cache_ttl = 600
+    creds_cache_size = 1024
+    creds_load_ttl = 60.0
+    confirm_started = False
+    track_min_interval = 1.0
+    track_max_interval = 30.0
+    track_timeout = 600.0
+    replicas = 1
+    replica = ''
+    shard_lease = 300.0
+    journal_path = ''
+    journal_fsync = False
+    update_deployments = True
+    validate_manifests = True
+    manifest_max_bytes = 1048576
+    manifest_max_documents = 100
+    nuvla_rate = 0.0
+    nuvla_burst = 10
+    breaker_failures = 3
+    breaker_reset = 60.0
+    queue_max_groups = 10000
+    queue_max_launches = 0
+    gc_interval = 0.0
+    gc_dry_run = False
+    gc_min_age = 3600.0
+    gc_page_size = 500
+    gc_batch = 100
+    gc_rate = 1.0
 
 
 class DMConfig:
     keycloak: KeycloakConf
     nuvla: NuvlaConf
     jm: JobManagerConf
+    dm: DeployConf
+    http: HttpConf
+    scheduler: SchedulerConf
+    server: ServerConf
+    health: HealthConf
+    log: LogConf
 
 
 def keyclok_from_config(config: configparser.ConfigParser) -> KeycloakConf:
@@ -33,6 +110,8 @@ def keyclok_from_config(config: configparser.ConfigParser) -> KeycloakConf:
     keycloak.client_secret = config['keycloak'].get('client_secret')
     keycloak.grant_type = config['keycloak'].get('grant_type',
                                                  'client_credentials')
+    keycloak.token_refresh_margin = config['keycloak'].getfloat(
+        'token_refresh_margin', keycloak.token_refresh_margin)
     return keycloak
 
 
@@ -47,9 +126,140 @@ def nuvla_from_config(config: configparser.ConfigParser) -> NuvlaConf:
 def jm_from_config(config: configparser.ConfigParser) -> JobManagerConf:
     jm = JobManagerConf()
     jm.url = config['jm']['url']
+    jm.transition_workers = config['jm'].getint('transition_workers',
+                                                jm.transition_workers)
+    jm.bulk_uri = config['jm'].get('bulk_uri', jm.bulk_uri)
+    jm.resync_interval = config['jm'].getfloat('resync_interval',
+                                               jm.resync_interval)
     return jm
 
 
+def dm_from_config(config: configparser.ConfigParser) -> DeployConf:
+    dm = DeployConf()
+    if not config.has_section('dm'):
+        return dm
+    dm.launch_workers = config['dm'].getint('launch_workers',
+                                            dm.launch_workers)
+    dm.lock_before_launch = config['dm'].getboolean('lock_before_launch',
+                                                    dm.lock_before_launch)
+    dm.creds_cache_ttl = config['dm'].getfloat('creds_cache_ttl',
+                                               dm.creds_cache_ttl)
+    dm.creds_cache_size = config['dm'].getint('creds_cache_size',
+                                              dm.creds_cache_size)
+    dm.creds_load_ttl = config['dm'].getfloat('creds_load_ttl',
+                                              dm.creds_load_ttl)
+    dm.confirm_started = config['dm'].getboolean('confirm_started',
+                                                 dm.confirm_started)
+    dm.track_min_interval = config['dm'].getfloat('track_min_interval',
+                                                  dm.track_min_interval)
+    dm.track_max_interval = config['dm'].getfloat('track_max_interval',
+                                                  dm.track_max_interval)
+    dm.track_timeout = config['dm'].getfloat('track_timeout',
+                                             dm.track_timeout)
+    dm.replicas = config['dm'].getint('replicas', dm.replicas)
+    dm.replica = config['dm'].get('replica', dm.replica)
+    dm.shard_lease = config['dm'].getfloat('shard_lease', dm.shard_lease)
+    dm.journal_path = config['dm'].get('journal_path', dm.journal_path)
+    dm.journal_fsync = config['dm'].getboolean('journal_fsync',
+                                               dm.journal_fsync)
+    dm.update_deployments = config['dm'].getboolean('update_deployments',
+                                                    dm.update_deployments)
+    dm.validate_manifests = config['dm'].getboolean('validate_manifests',
+                                                    dm.validate_manifests)
+    dm.manifest_max_bytes = config['dm'].getint('manifest_max_bytes',
+                                                dm.manifest_max_bytes)
+    dm.manifest_max_documents = config['dm'].getint(
+        'manifest_max_documents', dm.manifest_max_documents)
+    dm.nuvla_rate = config['dm'].getfloat('nuvla_rate', dm.nuvla_rate)
+    dm.nuvla_burst = config['dm'].getint('nuvla_burst', dm.nuvla_burst)
+    dm.breaker_failures = config['dm'].getint('breaker_failures',
+                                              dm.breaker_failures)
+    dm.breaker_reset = config['dm'].getfloat('breaker_reset',
+                                             dm.breaker_reset)
+    dm.queue_max_groups = config['dm'].getint('queue_max_groups',
+                                              dm.queue_max_groups)
+    dm.queue_max_launches = config['dm'].getint('queue_max_launches',
+                                                dm.queue_max_launches)
+    dm.gc_interval = config['dm'].getfloat('gc_interval', dm.gc_interval)
+    dm.gc_dry_run = config['dm'].getboolean('gc_dry_run', dm.gc_dry_run)
+    dm.gc_min_age = config['dm'].getfloat('gc_min_age', dm.gc_min_age)
+    dm.gc_page_size = config['dm'].getint('gc_page_size', dm.gc_page_size)
+    dm.gc_batch = config['dm'].getint('gc_batch', dm.gc_batch)
+    dm.gc_rate = config['dm'].getfloat('gc_rate', dm.gc_rate)
+    return dm
+
+
+def http_from_config(config: configparser.ConfigParser) -> HttpConf:
+    http = HttpConf()
+    if not config.has_section('http'):
+        return http
+    http.pool_connections = config['http'].getint('pool_connections',
+                                                  http.pool_connections)
+    http.pool_maxsize = config['http'].getint('pool_maxsize',
+                                              http.pool_maxsize)
+    http.connect_timeout = config['http'].getfloat('connect_timeout',
+                                                   http.connect_timeout)
+    http.read_timeout = config['http'].getfloat('read_timeout',
+                                                http.read_timeout)
+    return http
+
+
+def scheduler_from_config(config: configparser.ConfigParser) \
+        -> SchedulerConf:
+    scheduler = SchedulerConf()
+    if not config.has_section('scheduler'):
+        return scheduler
+    section = config['scheduler']
+    scheduler.min_interval = section.getfloat('min_interval',
+                                              scheduler.min_interval)
+    scheduler.max_interval = section.getfloat('max_interval',
+                                              scheduler.max_interval)
+    scheduler.backoff_factor = section.getfloat('backoff_factor',
+                                                scheduler.backoff_factor)
+    scheduler.jitter = section.getfloat('jitter', scheduler.jitter)
+    return scheduler
+
+
+def server_from_config(config: configparser.ConfigParser) -> ServerConf:
+    server = ServerConf()
+    if not config.has_section('server'):
+        return server
+    server.host = config['server'].get('host', server.host)
+    server.port = config['server'].getint('port', server.port)
+    return server
+
+
+def health_from_config(config: configparser.ConfigParser) -> HealthConf:
+    health = HealthConf()
+    if not config.has_section('health'):
+        return health
+    section = config['health']
+    health.retry_min_interval = section.getfloat('retry_min_interval',
+                                                 health.retry_min_interval)
+    health.retry_max_interval = section.getfloat('retry_max_interval',
+                                                 health.retry_max_interval)
+    health.nuvla_wait = section.getfloat('nuvla_wait', health.nuvla_wait)
+    health.liveness_timeout = section.getfloat('liveness_timeout',
+                                               health.liveness_timeout)
+    return health
+
+
+def log_from_config(config: configparser.ConfigParser) -> LogConf:
+    log = LogConf()
+    if not config.has_section('log'):
+        return log
+    section = config['log']
+    log.format = section.get('format', log.format)
+    if log.format not in ('text', 'json'):
+        raise ValueError(f'Unknown log format: {log.format}')
+    log.queue = section.getboolean('queue', log.queue)
+    log.queue_size = section.getint('queue_size', log.queue_size)
+    log.sample_burst = section.getint('sample_burst', log.sample_burst)
+    log.sample_interval = section.getfloat('sample_interval',
+                                           log.sample_interval)
+    return log
+
+
 def read_config(file_path) -> DMConfig:
     if not os.path.exists(file_path):
         raise Exception(f'Config file {file_path} not found.')
@@ -59,10 +269,22 @@ def read_config(file_path) -> DMConfig:
     keycloak = keyclok_from_config(config)
     nuvla = nuvla_from_config(config)
     jm = jm_from_config(config)
+    dm = dm_from_config(config)
+    http = http_from_config(config)
+    scheduler = scheduler_from_config(config)
+    server = server_from_config(config)
+    health = health_from_config(config)
+    log = log_from_config(config)
 
     conf: DMConfig = DMConfig()
     conf.keycloak = keycloak
     conf.nuvla = nuvla
     conf.jm = jm
+    conf.dm = dm
+    conf.http = http
+    conf.scheduler = scheduler
+    conf.server = server
+    conf.health = health
+    conf.log = log
 
     return conf
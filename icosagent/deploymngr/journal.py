@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+from typing import Dict, Tuple, Union
+
+from icosagent.log import get_logger
+
+log = get_logger('journal')
+
+
+class LaunchJournal:
+    """Append-only journal of the launches of job groups.
+
+    Each deployment launched for a job group on a target is recorded, with
+    the digest of the launched app, as one JSON line, and the group is
+    recorded as done once the state of its jobs was updated on the JM. On
+    restart, the journal is replayed so that the targets a group was already
+    launched on are not launched again, e.g. when the agent crashed before
+    completing the jobs on the JM, or when some other target of the group
+    failed.
+
+    Without `path`, the journal is kept in memory only. Lines are flushed to
+    the OS on each record; with `fsync` they are also synced to the disk, at
+    the cost of a disk write per record. The file is compacted to the groups
+    not done yet on open and once `compact_after` groups are done.
+    """
+
+    LAUNCHED = 'launched'
+    DONE = 'done'
+
+    def __init__(self, path: str = '', fsync: bool = False,
+                 compact_after: int = 1000):
+        self.path = path
+        self.fsync = fsync
+        self.compact_after = compact_after
+        # Job group ID to {target: (app digest, deployment ID)}.
+        self._groups: Dict[str, Dict[str, Tuple[str, str]]] = {}
+        self._done_since_compaction = 0
+        self._file = None
+        self._lock = threading.Lock()
+        if path:
+            self._replay()
+            self._compact()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._groups)
+
+    def _apply(self, entry: dict):
+        gid = entry['group']
+        if entry['op'] == self.LAUNCHED:
+            self._groups.setdefault(gid, {})[entry['target']] = \
+                (entry['app'], entry['deployment'])
+        elif entry['op'] == self.DONE:
+            self._groups.pop(gid, None)
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    # Most likely the last line, cut short by a crash.
+                    log.warning('Skipping bad line %s of journal %s', n,
+                                self.path)
+        log.info('Replayed journal %s: %s groups in progress', self.path,
+                 len(self._groups))
+
+    def _compact(self):
+        """Rewrites the journal with the groups not done yet."""
+        if self._file:
+            self._file.close()
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for gid, targets in self._groups.items():
+                for target, (app, dpl_id) in targets.items():
+                    f.write(self._line(dict(
+                        op=self.LAUNCHED, group=gid, target=target, app=app,
+                        deployment=dpl_id)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._done_since_compaction = 0
+
+    @staticmethod
+    def _line(entry: dict) -> str:
+        return json.dumps(entry, separators=(',', ':')) + '\n'
+
+    def _append(self, op: str, gid: str, **kwargs):
+        entry = dict(op=op, group=gid, **kwargs)
+        with self._lock:
+            self._apply(entry)
+            if not self._file:
+                return
+            self._file.write(self._line(entry))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if op == self.DONE:
+                self._done_since_compaction += 1
+                if self._done_since_compaction >= self.compact_after:
+                    self._compact()
+
+    def launched(self, gid: str, target: str, app: str, dpl_id: str):
+        self._append(self.LAUNCHED, gid, target=target, app=app,
+                     deployment=dpl_id)
+
+    def done(self, gid: str):
+        with self._lock:
+            if gid not in self._groups:
+                return
+        self._append(self.DONE, gid)
+
+    def deployment(self, gid: str, target: str, app: str) -> Union[str, None]:
+        """Returns ID of the deployment of `app` already launched for the
+        group on `target`, if any."""
+        with self._lock:
+            recorded = self._groups.get(gid, {}).get(target)
+        if recorded and recorded[0] == app:
+            return recorded[1]
+        return None
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Callable, Hashable, List
+
+from icosagent.log import get_logger
+
+log = get_logger('limits')
+
+
+class TokenBucket:
+    """Limits the rate of calls to `rate` per second on average, allowing
+    bursts of up to `burst` calls. `acquire()` blocks the calling thread
+    until the call is allowed. A `rate` of 0 disables the limit."""
+
+    def __init__(self, rate: float, burst: int = 1,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self) -> float:
+        """Takes a token, waiting for it if needed. Returns the number of
+        seconds waited."""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            # The token is reserved right away, so that waiting callers are
+            # served in order.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """Circuit breakers of independent keys, e.g. deployment targets.
+
+    The circuit of a key opens after `failure_threshold` consecutive
+    failures, and `allow()` then returns False for the key. After
+    `reset_timeout` seconds the circuit is half-open: one probe is allowed,
+    and its success closes the circuit while its failure opens it again. A
+    `failure_threshold` of 0 disables the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        # Key to [state, consecutive failures, time of the last state change]
+        # of the keys with failures.
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def state(self, key: Hashable) -> str:
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit[0] if circuit else self.CLOSED
+
+    def open_keys(self) -> List[Hashable]:
+        with self._lock:
+            return [k for k, c in self._circuits.items() if c[0] != self.CLOSED]
+
+    def allow(self, key: Hashable) -> bool:
+        if not self.enabled:
+            return True
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit[0] == self.CLOSED:
+                return True
+            now = self._clock()
+            # A probe that never reported back does not block the key
+            # forever.
+            if now - circuit[2] >= self.reset_timeout:
+                circuit[0], circuit[2] = self.HALF_OPEN, now
+                log.info('Circuit of %s half-open, probing', key)
+                return True
+            return False
+
+    def success(self, key: Hashable):
+        with self._lock:
+            circuit = self._circuits.pop(key, None)
+        if circuit and circuit[0] != self.CLOSED:
+            log.info('Circuit of %s closed', key)
+
+    def failure(self, key: Hashable):
+        if not self.enabled:
+            return
+        with self._lock:
+            circuit = self._circuits.setdefault(key, [self.CLOSED, 0, 0.0])
+            circuit[1] += 1
+            if circuit[0] == self.HALF_OPEN or \
+                    circuit[1] >= self.failure_threshold:
+                if circuit[0] != self.OPEN:
+                    log.warning('Circuit of %s open after %s failures', key,
+                                circuit[1])
+                circuit[0], circuit[2] = self.OPEN, self._clock()
@@ -0,0 +1,162 @@
+import hashlib
+import math
+import re
+from typing import Iterable, List, NamedTuple, Tuple
+
+import yaml
+
+from icosagent.deploymngr.cache import TTLCache
+from icosagent.log import get_logger
+
+log = get_logger('manifest')
+
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+DOCUMENT_SEPARATOR = '---\n'
+# DNS subdomain name (RFC 1123), required for the names of the built-in
+# workload, networking, config and storage objects.
+NAME_RE = re.compile(r'^[a-z0-9]([-a-z0-9.]*[a-z0-9])?$')
+NAME_MAX_LEN = 253
+DNS_NAME_KINDS = frozenset((
+    'Pod', 'Deployment', 'StatefulSet', 'DaemonSet', 'ReplicaSet',
+    'ReplicationController', 'Job', 'CronJob', 'Service', 'Ingress',
+    'NetworkPolicy', 'ConfigMap', 'Secret', 'ServiceAccount', 'Namespace',
+    'PersistentVolume', 'PersistentVolumeClaim', 'StorageClass',
+    'HorizontalPodAutoscaler', 'PodDisruptionBudget', 'LimitRange',
+    'ResourceQuota', 'PriorityClass'))
+# Kinds holding other objects in `items`, without metadata of their own.
+LIST_KINDS = frozenset(('List',))
+
+
+class ManifestError(ValueError):
+    pass
+
+
+class Document(NamedTuple):
+    # (kind, namespace, name) of the object.
+    key: Tuple[str, str, str]
+    text: str
+
+
+def _valid_name(kind: str, name) -> bool:
+    if not isinstance(name, str) or not name or len(name) > NAME_MAX_LEN:
+        return False
+    if kind in DNS_NAME_KINDS:
+        return bool(NAME_RE.match(name))
+    # Other kinds, e.g. RBAC ones named like `system:reader`, only need a
+    # name usable in an API path.
+    return name not in ('.', '..') and not any(c in name for c in '/%')
+
+
+def _check_object(obj, n: int) -> Tuple[str, str, str]:
+    if not isinstance(obj, dict):
+        raise ManifestError(f'document {n} is not a mapping')
+    for field in ('apiVersion', 'kind'):
+        if not isinstance(obj.get(field), str) or not obj[field]:
+            raise ManifestError(f'document {n} has no {field}')
+    kind = obj['kind']
+    if kind in LIST_KINDS:
+        items = obj.get('items')
+        if not isinstance(items, list):
+            raise ManifestError(f'{kind} in document {n} has no items')
+        keys = [_check_object(item, n) for item in items]
+        # Lists are told apart by the objects they hold.
+        return kind, '', ','.join('/'.join(k) for k in keys)
+    metadata = obj.get('metadata')
+    if not isinstance(metadata, dict):
+        raise ManifestError(f'{kind} in document {n} has no metadata')
+    name = metadata.get('name')
+    checked = name
+    if not name:
+        # A prefix the server appends a random suffix to.
+        name = metadata.get('generateName')
+        checked = f'{name}x' if isinstance(name, str) and name else None
+    if not _valid_name(kind, checked):
+        raise ManifestError(f'{kind} in document {n} has invalid name: '
+                            f'{name!r}')
+    return kind, str(metadata.get('namespace') or ''), name
+
+
+class ManifestValidator:
+    """Parses, validates and normalises the Kubernetes manifests of jobs
+    before anything is created on Nuvla.
+
+    Each document of a manifest must be a Kubernetes object with
+    `apiVersion`, `kind` and a valid name, or a `List` of such objects. The
+    names of the built-in kinds in `DNS_NAME_KINDS` must be DNS subdomain
+    names, those of other kinds only usable in an API path. Manifests larger than `max_bytes`
+    or with more than `max_documents` documents are rejected before being
+    parsed. Documents are re-serialised, so that the same objects always
+    give the same text, and the result of each manifest, including
+    errors, is cached by its digest.
+    """
+
+    def __init__(self, max_bytes: int = 1048576, max_documents: int = 100,
+                 cache_size: int = 1024):
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.cache = TTLCache(math.inf, cache_size)
+
+    def _parse(self, manifest: str) -> Tuple[Document, ...]:
+        if not isinstance(manifest, str) or not manifest.strip():
+            raise ManifestError('empty manifest')
+        if len(manifest.encode()) > self.max_bytes:
+            raise ManifestError(f'manifest larger than {self.max_bytes} '
+                                f'bytes')
+        documents = []
+        try:
+            for obj in yaml.load_all(manifest, Loader=SafeLoader):
+                if obj is None:
+                    continue
+                if len(documents) == self.max_documents:
+                    raise ManifestError(f'more than {self.max_documents} '
+                                        f'documents')
+                key = _check_object(obj, len(documents) + 1)
+                text = yaml.dump(obj, Dumper=SafeDumper, sort_keys=False,
+                                 default_flow_style=False)
+                documents.append(Document(key, text))
+        except yaml.YAMLError as ex:
+            raise ManifestError(f'invalid YAML: {ex}') from ex
+        if not documents:
+            raise ManifestError('no documents')
+        return tuple(documents)
+
+    def documents(self, manifest: str) -> Tuple[Document, ...]:
+        """Returns the validated documents of `manifest`. Raises
+        `ManifestError` if it is not valid."""
+        digest = hashlib.sha256(str(manifest).encode()).digest()
+        result = self.cache.get(digest)
+        if result is None:
+            try:
+                result = (True, self._parse(manifest))
+            except ManifestError as ex:
+                # Only the message, the exception would keep its frames.
+                result = (False, str(ex))
+            self.cache.put(digest, result)
+        ok, value = result
+        if not ok:
+            raise ManifestError(value)
+        return value
+
+    def join(self, parts: Iterable[Tuple[Document, ...]]) -> str:
+        """Joins documents of the manifests of the jobs of a group into one
+        manifest, leaving out the documents repeated across the jobs. Raises
+        `ManifestError` if different documents define the same object or
+        the result is too large."""
+        texts: List[str] = []
+        seen = {}
+        for documents in parts:
+            for doc in documents:
+                if doc.key in seen:
+                    if seen[doc.key] != doc.text:
+                        raise ManifestError('{} {} defined more than once'
+                                            .format(doc.key[0], doc.key[2]))
+                    continue
+                seen[doc.key] = doc.text
+                texts.append(doc.text)
+        manifest = DOCUMENT_SEPARATOR.join(texts)
+        if len(manifest.encode()) > self.max_bytes:
+            raise ManifestError(f'merged manifest larger than '
+                                f'{self.max_bytes} bytes')
+        return manifest
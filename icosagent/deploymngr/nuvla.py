@@ -1,9 +1,14 @@
-import time
-from typing import List, Union
+import functools
+import hashlib
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+from http import HTTPStatus
 from requests.exceptions import HTTPError
 
 from nuvla.api import Api as Nuvla, NuvlaError
-from nuvla.api.resources.base import ResourceBase
+from nuvla.api.resources.base import ResourceBase, ResourceNotFound
 from nuvla.api.resources.credential import Credential
 from nuvla.api.resources.infra_service import InfraService, \
     InfraServiceGroup, InfraServiceK8s
@@ -12,17 +17,65 @@ from nuvla.api.resources.deployment import Deployment
 from nuvla.api.resources.user import User
 
 from icosagent.jobmngr.jm import JobManagerProxy
-from icosagent.config.config import NuvlaConf
+from icosagent.jobmngr.sharding import JobSharding, replica_index
+from icosagent.config.config import DeployConf, NuvlaConf
+from icosagent.deploymngr.cache import TTLCache
+from icosagent.deploymngr.journal import LaunchJournal
+from icosagent.deploymngr.limits import CircuitBreaker, TokenBucket
+from icosagent.deploymngr.manifest import ManifestError, ManifestValidator
+from icosagent.deploymngr.placement import CredentialSelector
+from icosagent.deploymngr.tracker import DeploymentTracker
 from icosagent.log import get_logger
+from icosagent.metrics import REGISTRY, Registry
 
 log = get_logger('dm-nuvla')
 
+NUVLA_CALLS = ('get', 'search', 'add', 'edit', 'delete', 'operation')
+
+request_sec = REGISTRY.histogram(
+    'nuvla_request_seconds', 'Latency of Nuvla API calls.',
+    labelnames=('call', 'resource'))
+request_failures = REGISTRY.counter(
+    'nuvla_request_failures_total', 'Failed Nuvla API calls.',
+    labelnames=('call', 'resource'))
+launches_total = REGISTRY.counter(
+    'dm_launches_total', 'Deployment launches on Nuvla targets.',
+    labelnames=('result',))
+updates_total = REGISTRY.counter(
+    'dm_deployment_updates_total',
+    'Deployments of re-issued job groups kept or updated instead of '
+    'launched again.', labelnames=('result',))
+
+# Maximum number of resources Nuvla returns from one search.
+SEARCH_MAX_RESULTS = 10000
+
+APP_DIGEST_LEN = 16
+APP_DIGEST_RE = re.compile(f'-([0-9a-f]{{{APP_DIGEST_LEN}}})$')
+
+# Attributes of the credentials needed to choose one for a launch.
+CRED_SELECT = 'id,parent,status'
+
+# Tags of the deployments telling the job group and the target they were
+# launched for.
+GROUP_TAG = 'icos-job-group='
+TARGET_TAG = 'icos-target='
+
+# The deployments in these states are not running the app any more.
+GONE_STATES = (Deployment.STATE_STOPPING, Deployment.STATE_STOPPED,
+               Deployment.STATE_ERROR)
+
+
+class DeploymentBusy(Exception):
+    """The deployment of a job group has to be updated but is in a state
+    that does not allow it, e.g. still starting."""
+
 
 def infra_service_creds_by_ne_id(nuvla: Nuvla, ne_id: str,
                                  infra_service_type=InfraServiceK8s.subtype) -> List[dict]:
     """Given NuvlaEdge ID `ne_id` and the infrastructure service type
     `infra_service_type` (e.g. 'kubernetes'), finds and returns the list of
-    credentials corresponding to the first infrastructure service."""
+    credentials of all the infrastructure services of the type on the
+    NuvlaEdge."""
 
     # Get infra service group that is defined on the NE.
     ne = NuvlaEdge(nuvla)
@@ -33,16 +86,101 @@ def infra_service_creds_by_ne_id(nuvla: Nuvla, ne_id: str,
     flt = f'parent="{infra_service_group}" and subtype="{infra_service_type}"'
     resources = nuvla.search(InfraService.resource, filter=flt,
                              select='id').resources
-    # NB! We take the first one.
-    infra_service_resource = resources[0].data['id']
+    if not resources:
+        return []
 
-    # Find all credentials of the IS
-    flt = f'parent="{infra_service_resource}"'
+    # Find all credentials of the ISes.
+    flt = _or_filter('parent', (x.data['id'] for x in resources))
     resources = nuvla.search(Credential.resource, filter=flt,
-                             select='id').resources
+                             select=CRED_SELECT).resources
     return [x.data for x in resources]
 
 
+def is_auth_or_not_found_error(ex: Exception) -> bool:
+    """Tells whether `ex` means that a resource used for a launch (e.g. the
+    credential or the module) is no longer accessible or does not exist."""
+    if isinstance(ex, ResourceNotFound):
+        return True
+    status = getattr(getattr(ex, 'response', None), 'status_code', None)
+    return status in (HTTPStatus.UNAUTHORIZED, HTTPStatus.FORBIDDEN,
+                      HTTPStatus.NOT_FOUND)
+
+
+def _or_filter(attr: str, values) -> str:
+    return ' or '.join(f'{attr}="{v}"' for v in values)
+
+
+def infra_service_creds_by_ne_ids(nuvla: Nuvla, ne_ids: List[str],
+                                  infra_service_type=InfraServiceK8s.subtype) \
+        -> Tuple[Dict[str, List[dict]], Dict[str, str]]:
+    """Batch version of `infra_service_creds_by_ne_id`. Finds credentials of
+    the infrastructure services of type `infra_service_type` for all the
+    NuvlaEdge IDs `ne_ids` with at most three searches. IDs of infrastructure
+    services are accepted as well, in which case the credentials of the
+    infrastructure service itself are returned.
+
+    Returns tuple of dictionaries: ID to the list of credentials, and ID to
+    the reason why the credentials were not found."""
+    ne_ids = list(dict.fromkeys(ne_ids))
+    # ID to the IDs of its ISes.
+    id_to_is = {x: [x] for x in ne_ids
+                if x.startswith(f'{InfraService.resource}/')}
+    ne_to_isg = {}
+
+    # Get infra service groups that are defined on the NEs.
+    edges = [x for x in ne_ids if x not in id_to_is]
+    if edges:
+        resources = nuvla.search(NuvlaEdge.resource,
+                                 filter=_or_filter('id', edges),
+                                 select=f'id,{InfraServiceGroup.resource}',
+                                 last=len(edges)).resources
+        ne_to_isg = {x.data['id']: x.data.get(InfraServiceGroup.resource)
+                     for x in resources}
+
+    # Find all ISes of the requested type in the groups ...
+    groups = list(dict.fromkeys(x for x in ne_to_isg.values() if x))
+    if groups:
+        flt = f'({_or_filter("parent", groups)}) and ' \
+              f'subtype="{infra_service_type}"'
+        resources = nuvla.search(InfraService.resource, filter=flt,
+                                 select='id,parent',
+                                 last=SEARCH_MAX_RESULTS).resources
+        isg_to_is = {}
+        for x in resources:
+            isg_to_is.setdefault(x.data['parent'], []).append(x.data['id'])
+        for ne_id, isg in ne_to_isg.items():
+            if isg in isg_to_is:
+                id_to_is[ne_id] = isg_to_is[isg]
+
+    # Find all credentials of the ISes.
+    is_to_creds = {}
+    if id_to_is:
+        flt = _or_filter('parent', {x for v in id_to_is.values() for x in v})
+        resources = nuvla.search(Credential.resource, filter=flt,
+                                 select=CRED_SELECT,
+                                 last=SEARCH_MAX_RESULTS).resources
+        for x in resources:
+            is_to_creds.setdefault(x.data['parent'], []).append(x.data)
+
+    creds, failures = {}, {}
+    for ne_id in ne_ids:
+        if ne_id in id_to_is:
+            found = [c for x in id_to_is[ne_id] for c in is_to_creds.get(x, [])]
+            if found:
+                creds[ne_id] = found
+            else:
+                failures[ne_id] = \
+                    f'no credentials on {", ".join(id_to_is[ne_id])}'
+        elif ne_id not in ne_to_isg:
+            failures[ne_id] = 'NuvlaEdge not found'
+        elif not ne_to_isg[ne_id]:
+            failures[ne_id] = 'no infrastructure service group'
+        else:
+            failures[ne_id] = f'no {infra_service_type} infrastructure ' \
+                              f'service in {ne_to_isg[ne_id]}'
+    return creds, failures
+
+
 class NuvlaResourceBase(ResourceBase):
     def get_select(self, ne_id, select: Union[List, None]) -> dict:
         if not select:
@@ -77,15 +215,88 @@ class NuvlaUser(User):
         return response.json().get('resource-id')
 
 
-def nuvla_authn(config: NuvlaConf) -> Nuvla:
+def resource_type_of(arg) -> str:
+    # Resource name, resource ID or CimiResource.
+    rid = getattr(arg, 'id', arg)
+    return rid.split('/')[0] if isinstance(rid, str) else ''
+
+
+def wrap_nuvla_calls(nuvla: Nuvla, wrap: Callable) -> Nuvla:
+    """Replaces the API calls of `nuvla` (see `NUVLA_CALLS`) by `wrap(call,
+    func)`. Calls the API makes from within another one (`add` searches the
+    collection, `edit` gets the resource) go to `func` directly, so that
+    each call made to `nuvla` goes through `wrap` once."""
+    depth = threading.local()
+    for call in NUVLA_CALLS:
+        func = getattr(nuvla, call)
+        wrapped = wrap(call, func)
+
+        @functools.wraps(func)
+        def outermost(*args, _func=func, _wrapped=wrapped, **kwargs):
+            if getattr(depth, 'n', 0):
+                return _func(*args, **kwargs)
+            depth.n = getattr(depth, 'n', 0) + 1
+            try:
+                return _wrapped(*args, **kwargs)
+            finally:
+                depth.n -= 1
+
+        setattr(nuvla, call, outermost)
+    return nuvla
+
+
+def instrument_nuvla(nuvla: Nuvla) -> Nuvla:
+    """Wraps the API calls of `nuvla` (see `NUVLA_CALLS`) to observe their
+    latency and failures."""
+    def wrap(call, func):
+        def timed(*args, **kwargs):
+            labels = {'call': call,
+                      'resource': resource_type_of(args[0]) if args else ''}
+            try:
+                with request_sec.labels(**labels).time():
+                    return func(*args, **kwargs)
+            except Exception:
+                request_failures.labels(**labels).inc()
+                raise
+        return timed
+
+    return wrap_nuvla_calls(nuvla, wrap)
+
+
+def rate_limit_nuvla(nuvla: Nuvla, bucket: TokenBucket) -> Nuvla:
+    """Makes the API calls of `nuvla` (see `NUVLA_CALLS`) wait for a token
+    of `bucket` first."""
+    if not bucket.enabled:
+        return nuvla
+
+    def wrap(call, func):
+        def limited(*args, **kwargs):
+            bucket.acquire()
+            return func(*args, **kwargs)
+        return limited
+
+    return wrap_nuvla_calls(nuvla, wrap)
+
+
+def nuvla_client(config: NuvlaConf) -> Nuvla:
+    """Returns Nuvla client that logs in with the API key of `config` by
+    itself whenever Nuvla answers that the session is missing or expired."""
+    kwargs = {'debug': config.debug, 'reauthenticate': True,
+              'login_creds': {'key': config.api_key,
+                              'secret': config.api_secret}}
     if config.url:
-        nuvla = Nuvla(endpoint=config.url, debug=config.debug)
-    else:
-        nuvla = Nuvla(debug=config.debug)
+        return Nuvla(endpoint=config.url, **kwargs)
+    return Nuvla(**kwargs)
+
 
+def nuvla_login(nuvla: Nuvla, config: NuvlaConf):
     user_api = NuvlaUser(nuvla)
     user_api.login_apikey(config.api_key, config.api_secret)
 
+
+def nuvla_authn(config: NuvlaConf) -> Nuvla:
+    nuvla = nuvla_client(config)
+    nuvla_login(nuvla, config)
     return nuvla
 
 
@@ -94,37 +305,337 @@ class DeploymentManagerNuvla:
     PARENT_PATH = 'icos/deploymentmanagement'
     AUTHOR = 'group/icos'
 
-    def __init__(self, nuvla_api: Nuvla):
+    def __init__(self, nuvla_api: Nuvla, config: DeployConf = None):
         self.nuvla = nuvla_api
         self.dpl_api = Deployment(self.nuvla)
+        self.config = config or DeployConf()
+        self.creds_cache = TTLCache(self.config.creds_cache_ttl,
+                                    self.config.creds_cache_size)
+        self.placement = CredentialSelector(self.nuvla,
+                                            self.config.creds_load_ttl)
+        self.tracker = DeploymentTracker(
+            self.nuvla, min_interval=self.config.track_min_interval,
+            max_interval=self.config.track_max_interval,
+            timeout=self.config.track_timeout)
+        self.journal = LaunchJournal(self.config.journal_path,
+                                     self.config.journal_fsync)
+        self.breaker = CircuitBreaker(self.config.breaker_failures,
+                                      self.config.breaker_reset)
+        self.manifests = None
+        if self.config.validate_manifests:
+            self.manifests = ManifestValidator(
+                self.config.manifest_max_bytes,
+                self.config.manifest_max_documents)
+        self.sharding = JobSharding(1, 0)
+        if self.config.replicas > 1:
+            # Jobs waiting for their deployments to start stay locked.
+            lock_lease = self.config.shard_lease
+            if lock_lease > 0 and self.config.confirm_started:
+                lock_lease += self.config.track_timeout
+            self.sharding = JobSharding(
+                self.config.replicas, replica_index(self.config.replica),
+                self.config.shard_lease, lock_lease)
+        # Number of jobs completed, or left locked until their deployments
+        # are confirmed as started, by the last `deploy()` call.
+        self.completed_jobs = 0
+        # App digest to module ID.
+        self._modules = {}
+        self._modules_lock = threading.Lock()
+        # (job group ID, target) to (app digest, deployment ID) of the
+        # deployment of the group running on the target.
+        self._deployments = {}
+        self._deployments_lock = threading.Lock()
+        # With a single worker everything runs inline in the caller's thread.
+        self._executor = None
+        if self.config.launch_workers > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.config.launch_workers,
+                thread_name_prefix='dm-launch')
+
+    def register_metrics(self, registry: Registry = REGISTRY):
+        """Exposes the state of the caches and of the tracker."""
+        registry.counter('dm_creds_cache_hits_total',
+                         'Targets with credentials found in the cache.',
+                         fn=lambda: self.creds_cache.stats()['hits'])
+        registry.counter('dm_creds_cache_misses_total',
+                         'Targets with credentials not found in the cache.',
+                         fn=lambda: self.creds_cache.stats()['misses'])
+        registry.gauge('dm_creds_cache_size',
+                       'Targets with cached credentials.',
+                       fn=lambda: len(self.creds_cache))
+        registry.gauge('dm_app_modules', 'Indexed app modules.',
+                       fn=lambda: len(self._modules))
+        registry.gauge('dm_group_deployments',
+                       'Indexed deployments of job groups.',
+                       fn=lambda: len(self._deployments))
+        registry.gauge('dm_open_circuits',
+                       'Targets skipped because of repeated failures.',
+                       fn=lambda: len(self.breaker.open_keys()))
+        registry.gauge('dm_tracked_deployments',
+                       'Deployments waiting for a final state.',
+                       fn=lambda: len(self.tracker))
+
+    def close(self):
+        self.tracker.stop()
+        self.journal.close()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _submit(self, func: Callable, *args) -> Future:
+        if self._executor:
+            return self._executor.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+    @staticmethod
+    def app_digest(manifest: str, app_name: str) -> str:
+        digest = hashlib.sha256(app_name.encode())
+        digest.update(b'\0')
+        digest.update(manifest.encode())
+        return digest.hexdigest()[:APP_DIGEST_LEN]
+
+    def load_modules_index(self):
+        """Warms up the index of app modules with the ones already created
+        under `PARENT_PATH`."""
+        resources = self.nuvla.search(
+            Module.resource, filter=f'parent-path="{self.PARENT_PATH}"',
+            select='id,path', last=SEARCH_MAX_RESULTS).resources
+        modules = {}
+        for x in resources:
+            match = APP_DIGEST_RE.search(x.data.get('path', ''))
+            if match:
+                modules[match.group(1)] = x.data['id']
+        with self._modules_lock:
+            self._modules.update(modules)
+        log.info('Loaded %s app modules from %s', len(modules),
+                 self.PARENT_PATH)
+
+    def forget_module(self, module_id: str):
+        """Drops `module_id` from the index of app modules, e.g. once it is
+        deleted."""
+        with self._modules_lock:
+            for digest in [k for k, v in self._modules.items()
+                           if v == module_id]:
+                del self._modules[digest]
+
+    @staticmethod
+    def deployment_tags(gid: str, target: str) -> List[str]:
+        return [f'{GROUP_TAG}{gid}', f'{TARGET_TAG}{target}']
+
+    def load_deployments_index(self):
+        """Warms up the index of the deployments of job groups with the
+        running ones launched from the modules under `PARENT_PATH`."""
+        resources = self.nuvla.search(
+            Deployment.resource,
+            filter=f'module/parent-path="{self.PARENT_PATH}" and '
+                   f'state="{Deployment.STATE_STARTED}"',
+            select='id,tags,module', last=SEARCH_MAX_RESULTS).resources
+        deployments = {}
+        for x in resources:
+            tags = dict(t.split('=', 1) for t in x.data.get('tags') or []
+                        if '=' in t)
+            gid = tags.get(GROUP_TAG[:-1])
+            target = tags.get(TARGET_TAG[:-1])
+            match = APP_DIGEST_RE.search(
+                (x.data.get('module') or {}).get('path', ''))
+            if gid and target and match:
+                deployments[(gid, target)] = (match.group(1), x.data['id'])
+        with self._deployments_lock:
+            self._deployments.update(deployments)
+        log.info('Loaded %s deployments of job groups', len(deployments))
+
+    def forget_deployment(self, dpl_id: str):
+        """Drops `dpl_id` from the index of the deployments of job groups,
+        e.g. once it is stopped."""
+        with self._deployments_lock:
+            for key in [k for k, v in self._deployments.items()
+                        if v[1] == dpl_id]:
+                del self._deployments[key]
+
+    @staticmethod
+    def module_name(app_name: str) -> str:
+        """Returns the last part of the path of the modules of `app_name`,
+        followed by `-<app digest>`."""
+        return app_name.lower().replace(' ', '-')
 
     def create_app_k8s(self, manifest: str, app_name: str):
-        app_name = f'{app_name} {int(time.time())}'
+        """Returns ID of the module with the `manifest` of `app_name`. The
+        module is created only if the same app with the same manifest was not
+        created before."""
+        digest = self.app_digest(manifest, app_name)
+        with self._modules_lock:
+            module_id = self._modules.get(digest)
+        if module_id:
+            log.debug('Reusing app %s for %s', module_id, app_name)
+            return module_id
+
+        app_name = f'{app_name} {digest}'
         module_api = Module(self.nuvla)
         app = AppBuilderK8s() \
             .name(app_name) \
             .description(app_name) \
             .author(self.AUTHOR) \
-            .path(f'{self.PARENT_PATH}/{app_name.lower().replace(" ", "-")}') \
+            .path(f'{self.PARENT_PATH}/{self.module_name(app_name)}') \
             .script(manifest) \
             .build()
-        log.info(f'Create app {app}')
+        log.info('Create app %s', app_name)
+        log.debug('App: %s', app)
 
-        return module_api.create(app, exist_ok=True)
+        module_id = module_api.create(app, exist_ok=True)
+        with self._modules_lock:
+            self._modules[digest] = module_id
+        return module_id
 
-    def launch(self, dpl_manifest: str, app_name: str, infra_cred_id: str) -> str:
+    def launch(self, dpl_manifest: str, app_name: str, infra_cred_id: str,
+               tags: List[str] = None) -> str:
         module_id = self.create_app_k8s(dpl_manifest, app_name)
         log.info('Created app %s', module_id)
 
-        dpl = self.dpl_api.launch(module_id, infra_cred_id=infra_cred_id)
-        log.info('Launched deployment %s', dpl.id)
-
-        return dpl.id
-
-    def wait_in_final_state(self, dpl_id: str):
-        final = [Deployment.STATE_STARTED, Deployment.STATE_ERROR]
-        while self.dpl_api.state(self.dpl_api.get(dpl_id)) not in final:
-            time.sleep(5)
+        try:
+            dpl_id = self.nuvla.add(Deployment.resource, {
+                'module': {'href': module_id}}).data['resource-id']
+            data = {'parent': infra_cred_id}
+            if tags:
+                data['tags'] = tags
+            self.nuvla.edit(dpl_id, data)
+            self.dpl_api.start(dpl_id)
+        except Exception as ex:
+            if is_auth_or_not_found_error(ex):
+                self.forget_module(module_id)
+            raise
+        log.info('Launched deployment %s', dpl_id)
+
+        return dpl_id
+
+    def update(self, gid: str, target: str, manifest: str,
+               app_name: str) -> Union[str, None]:
+        """Brings the deployment of group `gid` running on `target`, if
+        any, to the app of `manifest`. The deployment is kept as it is when
+        it runs the same app already, and is otherwise updated in place to
+        the module of the app. Returns ID of the deployment, or None when
+        the group has no running deployment on the target. Raises
+        `DeploymentBusy` when the deployment cannot be updated yet, so that
+        the group is deployed again in a later cycle rather than launched a
+        second time next to it."""
+        with self._deployments_lock:
+            current = self._deployments.get((gid, target))
+        if not current:
+            return None
+        current_app, dpl_id = current
+        try:
+            dpl = self.nuvla.get(dpl_id)
+        except Exception as ex:
+            if not is_auth_or_not_found_error(ex):
+                raise
+            dpl = None
+        if dpl is None or dpl.data.get('state') in GONE_STATES:
+            log.info('Deployment %s of group %s on %s is gone', dpl_id, gid,
+                     target)
+            self.forget_deployment(dpl_id)
+            return None
+
+        app = self.app_digest(manifest, app_name)
+        if app == current_app:
+            log.info('Group %s unchanged on %s, keeping %s', gid, target,
+                     dpl_id)
+            updates_total.labels(result='unchanged').inc()
+            return dpl_id
+        if 'update' not in dpl.operations:
+            updates_total.labels(result='deferred').inc()
+            raise DeploymentBusy(f'Deployment {dpl_id} of group {gid} on '
+                                 f'{target} cannot be updated in state '
+                                 f'{dpl.data.get("state")}')
+
+        module_id = self.create_app_k8s(manifest, app_name)
+        self.nuvla.operation(dpl, 'fetch-module', {'module-href': module_id})
+        self.nuvla.operation(dpl, 'update')
+        log.info('Updated deployment %s of group %s on %s to %s', dpl_id,
+                 gid, target, module_id)
+        updates_total.labels(result='updated').inc()
+        with self._deployments_lock:
+            self._deployments[(gid, target)] = (app, dpl_id)
+        return dpl_id
+
+    def _launch_once(self, gid: str, target: str, manifest: str,
+                     app_name: str, infra_cred_id: str) -> str:
+        """Launches the app of group `gid` on `target`, unless the journal
+        shows it was launched there already. With
+        `DeployConf.update_deployments`, the deployment of the group already
+        running on the target is updated instead, if any (see `update`)."""
+        app = self.app_digest(manifest, app_name)
+        dpl_id = self.journal.deployment(gid, target, app)
+        if dpl_id:
+            log.info('Group %s already launched on %s as %s', gid, target,
+                     dpl_id)
+            return dpl_id
+        if self.config.update_deployments:
+            dpl_id = self.update(gid, target, manifest, app_name)
+            if dpl_id:
+                # The deployment stays on its own credential.
+                self.placement.release(infra_cred_id)
+        if not dpl_id:
+            dpl_id = self.launch(manifest, app_name, infra_cred_id,
+                                 self.deployment_tags(gid, target))
+            with self._deployments_lock:
+                self._deployments[(gid, target)] = (app, dpl_id)
+        self.journal.launched(gid, target, app, dpl_id)
+        return dpl_id
+
+    def wait_in_final_state(self, dpl_id: str, timeout: float = None) -> str:
+        """Blocks until deployment `dpl_id` is started or failed. Returns
+        the final state, or `DeploymentTracker.TIMEOUT`."""
+        done = threading.Event()
+        final = {}
+
+        def on_final(_, state):
+            final['state'] = state
+            done.set()
+
+        self.tracker.watch(dpl_id, on_final, timeout)
+        while not done.is_set():
+            if not self.tracker.running:
+                self.tracker.poll()
+            done.wait(self.tracker.interval)
+        return final['state']
+
+    def _confirm_started(self, gid: str, job_ids: set, dpl_ids: list,
+                         jm: JobManagerProxy):
+        """Marks the jobs as completed once all the deployments `dpl_ids`
+        are started, or as degraded as soon as one of them fails or times
+        out."""
+        pending = set(dpl_ids)
+        lock = threading.Lock()
+
+        def on_final(dpl_id: str, state: str):
+            with lock:
+                if not pending:
+                    return
+                if state == Deployment.STATE_STARTED:
+                    pending.discard(dpl_id)
+                    if pending:
+                        return
+                else:
+                    pending.clear()
+            if state != Deployment.STATE_STARTED:
+                self.forget_deployment(dpl_id)
+            transitions = jm.transitions()
+            for job_id in job_ids:
+                if state == Deployment.STATE_STARTED:
+                    transitions.complete(job_id)
+                else:
+                    log.error('Job %s degraded: deployment %s is %s', job_id,
+                              dpl_id, state)
+                    transitions.degrade(job_id)
+            if all(transitions.flush().values()):
+                self.journal.done(gid)
+
+        for dpl_id in dpl_ids:
+            self.tracker.watch(dpl_id, on_final)
 
     def terminate(self, dpl_id: str):
         self.dpl_api.terminate(dpl_id)
@@ -155,7 +666,7 @@ class DeploymentManagerNuvla:
             manifest = deployment['manifest']
             job_id = deployment['ID']
 
-            target_to_cred = self.creds_for_targets(
+            target_to_cred, _ = self.creds_for_targets(
                 [t['cluster_name'] for t in targets])
 
             app_name = deployment['job_group_name']
@@ -164,91 +675,288 @@ class DeploymentManagerNuvla:
                 jm.lock_job(job_id)
                 try:
                     depl_id = self.launch(manifest, app_name, cred)
-                    log.info(f'Launched app on {target} with: {depl_id}')
+                    log.info('Launched app on %s with: %s', target, depl_id,
+                             extra={'job': job_id, 'target': target,
+                                    'deployment': depl_id})
                     deployed_jobs.append({'job': job_id,
                                           'target': target,
                                           'deployment': depl_id})
                     jm.mark_job_as_completed(job_id)
                 except Exception:
-                    log.exception(f'Failed launching deployment: {job_id}')
+                    log.exception('Failed launching deployment: %s', job_id,
+                                  extra={'job': job_id, 'target': target})
                     jm.unlock_job(job_id)
 
         return deployed_jobs
 
-    def creds_for_targets(self, targets: List[str]):
-        target_to_cred = {}
+    def resolve_creds(self, targets: List[str]) -> Tuple[dict, dict]:
+        """Returns tuple of target to the list of its credentials and target
+        to the reason why its credentials were not found. Targets missing in
+        the credentials cache are resolved in one batch, and the load of the
+        credentials to choose from is refreshed with one more search."""
+        target_creds = {}
+        missing = []
+        for target in dict.fromkeys(targets):
+            creds = self.creds_cache.get(target)
+            if creds is None:
+                missing.append(target)
+            else:
+                target_creds[target] = creds
+
+        failures = {}
+        if missing:
+            found, failures = infra_service_creds_by_ne_ids(self.nuvla,
+                                                            missing)
+            for target, creds in found.items():
+                self.creds_cache.put(target, creds)
+            target_creds.update(found)
+
         for target in targets:
-            creds = infra_service_creds_by_ne_id(self.nuvla, target)
-            if not creds:
+            if target in failures:
                 log.error(
-                    'Failed finding credentials for deployment target: %s',
-                    target)
-                break
-            # FIXME: Find a way to select the right credential.
-            target_to_cred[target] = creds[0]['id']
-
-        return target_to_cred
+                    'Failed finding credentials for deployment target %s: %s',
+                    target, failures[target])
+        self.placement.refresh(target_creds.values())
+        return target_creds, failures
+
+    def creds_for_targets(self, targets: List[str]) -> Tuple[dict, dict]:
+        """Returns tuple of target to the ID of the credential to launch with
+        and target to the reason why its credentials were not found."""
+        target_creds, failures = self.resolve_creds(targets)
+        target_to_cred = {t: self.placement.choose(target_creds[t])
+                          for t in dict.fromkeys(targets) if t in target_creds}
+        return target_to_cred, failures
 
     # FIXME: Remove all the code below after ICOS first review.
 
     MANIFEST_SEPARATOR = '\r\n---\r\n'
 
     @classmethod
-    def _merge_jobs(cls, jobs: list):
-        group_ids = set()
-        for job in jobs:
-            group_ids.add(job.get('job_group_id'))
-
+    def _merge_jobs(cls, jobs: Iterable[dict]) -> dict:
+        """Merges `jobs` of the same job group in one pass over `jobs`, which
+        can be a generator. Returns dictionary of job group ID to the set of
+        merged job `IDs` and the merged `job`, that is, the first job of the
+        group without `ID` and with the manifests of all the jobs of the
+        group. The input jobs are not modified."""
         jobs_merged = {}
-        for gid in group_ids:
-            for job in jobs:
-                if job.get('job_group_id') == gid:
-                    if gid not in jobs_merged:
-                        jobs_merged[gid] = {'IDs': {job['ID']},
-                                            'job': job}
-                        del jobs_merged[gid]['job']['ID']
-                    elif job['ID'] not in jobs_merged[gid]['IDs']:
-                        jobs_merged[gid]['IDs'].add(job['ID'])
-                        jobs_merged[gid]['job']['manifest'] += \
-                            cls.MANIFEST_SEPARATOR + job['manifest']
+        manifests = {}
+        for job in jobs:
+            gid = job.get('job_group_id')
+            mjob = jobs_merged.get(gid)
+            if mjob is None:
+                jobs_merged[gid] = {'IDs': {job['ID']},
+                                    'job': {k: v for k, v in job.items()
+                                            if k != 'ID'}}
+                manifests[gid] = [job.get('manifest')]
+            elif job['ID'] not in mjob['IDs']:
+                mjob['IDs'].add(job['ID'])
+                manifests[gid].append(job['manifest'])
+        for gid, parts in manifests.items():
+            if len(parts) > 1:
+                jobs_merged[gid]['job']['manifest'] = \
+                    cls.MANIFEST_SEPARATOR.join(parts)
         return jobs_merged
 
+    def _validate_manifests(self, jobs: list) -> Tuple[dict, dict]:
+        """Returns tuple of job group ID to its validated and merged
+        manifest, and of job group ID to the error of its invalid
+        manifests."""
+        parts = {}
+        invalid = {}
+        for job in jobs:
+            gid = job.get('job_group_id')
+            if job.get('orchestrator') != 'nuvla' or gid in invalid:
+                continue
+            try:
+                parts.setdefault(gid, []).append(
+                    self.manifests.documents(job.get('manifest')))
+            except ManifestError as ex:
+                invalid[gid] = f'job {job["ID"]}: {ex}'
+        manifests = {}
+        for gid, documents in parts.items():
+            if gid in invalid:
+                continue
+            try:
+                manifests[gid] = self.manifests.join(documents)
+            except ManifestError as ex:
+                invalid[gid] = str(ex)
+        return manifests, invalid
+
+    def reclaim(self, jm: JobManagerProxy) -> list:
+        """Returns the jobs left locked by other replicas, e.g. ones that
+        crashed, that this replica takes over (see `JobSharding.reclaim`)."""
+        try:
+            return self.sharding.reclaim(jm.fetch_jobs)
+        except Exception:
+            log.exception('Failed getting jobs locked by other replicas.')
+            return []
+
     def deploy(self, deployments: list, jm: JobManagerProxy) -> list:
-        deployed_jobs = []
-        log.debug(f'Jobs: {deployments}')
+        """Launches merged job groups on their Nuvla targets.
+
+        Credentials of all the targets are resolved in one batch, then the
+        launches on independent targets run on the launch workers (see
+        `DeployConf.launch_workers`). The jobs of a group are locked before
+        any of its targets is launched, and then either marked as
+        completed, when all the targets of the group were launched, or
+        unlocked otherwise. The job state transitions are buffered and only
+        the final state of each job is sent to the JM at the end of the
+        call, unless `DeployConf.lock_before_launch` is set.
+
+        With `DeployConf.validate_manifests`, the manifests are validated
+        and merged without repeated documents first (see
+        `ManifestValidator`), and the jobs of groups with invalid manifests
+        are marked as degraded without anything being created on Nuvla.
+
+        Targets that failed repeatedly are skipped for a while (see
+        `CircuitBreaker`), which fails the groups deployed on them.
+
+        Launches are recorded in the journal (see `LaunchJournal`), and the
+        targets a group was already launched on are not launched again.
+
+        With `DeployConf.update_deployments`, a group re-issued by the JM
+        keeps the deployments it has running on its targets when its
+        manifest did not change, and has them updated in place otherwise
+        (see `update`).
+
+        With `DeployConf.replicas`, only the jobs of the groups owned by this
+        replica are deployed (see `JobSharding`), and they are always locked
+        on the JM, with the lease of this replica, before being launched.
+
+        With `DeployConf.confirm_started`, the jobs of successfully launched
+        groups are left locked and are marked as completed (or degraded) by
+        the deployment tracker once Nuvla reports their deployments as
+        started (or failed).
+        """
+        self.completed_jobs = 0
+        deployments = self.sharding.select(deployments)
+        log.debug('Jobs: %s', deployments)
         merged_jobs = self._merge_jobs(deployments)
-        log.debug(f'Merged jobs: {merged_jobs}')
+        log.debug('Merged jobs: %s', merged_jobs)
+
+        transitions = jm.transitions()
+        if self.sharding.enabled:
+            transitions.lock_fields = self.sharding.lease_fields()
+        manifests, invalid = {}, {}
+        if self.manifests:
+            manifests, invalid = self._validate_manifests(deployments)
+
+        groups = []
         for gid, mjob in merged_jobs.items():
             if mjob['job'].get('orchestrator') != 'nuvla':
                 continue
+            if gid in invalid:
+                log.error('Invalid manifest of job group %s: %s', gid,
+                          invalid[gid])
+                for job_id in mjob['IDs']:
+                    transitions.degrade(job_id)
+                continue
             # For IT-1 assuming deployment targets are IDs in the form
             # nuvlabox/<UUID>. Then, for each nuvlabox/<UUID> target we will have
             # to get the associated COE credential.
-            job = mjob['job']
-            targets = self.nuvla_targets(job)
+            targets = self.nuvla_targets(mjob['job'])
             if not targets:
                 continue
+            groups.append((gid, mjob, [t['cluster_name'] for t in targets]))
+
+        all_targets = list(dict.fromkeys(
+            t for _, _, targets in groups for t in targets))
+        blocked = [t for t in all_targets if not self.breaker.allow(t)]
+        if blocked:
+            log.warning('Skipping targets with open circuit: %s', blocked)
+        target_creds, failures = self.resolve_creds(
+            [t for t in all_targets if t not in blocked])
+        for target in failures:
+            self.breaker.failure(target)
+        failures.update((t, 'circuit open') for t in blocked)
+
+        launches = []
+        for gid, mjob, targets in groups:
+            # Chosen per launch, so that the groups on the same target
+            # spread over its credentials.
+            target_to_cred = {t: self.placement.choose(target_creds[t])
+                              for t in targets if t in target_creds}
+            if not target_to_cred:
+                continue
+            unresolved = [t for t in targets if t in failures]
+
+            manifest = manifests.get(gid, mjob['job']['manifest'])
+            app_name = mjob['job']['job_group_name']
+
+            for job_id in mjob['IDs']:
+                transitions.lock(job_id)
+            # Replicas see only the unlocked jobs of the groups they take
+            # over, so the lock has to be on the JM before launching.
+            if self.config.lock_before_launch or self.sharding.enabled:
+                transitions.flush()
+            futures = [(target, cred, self._submit(
+                self._launch_once, gid, target, manifest, app_name, cred))
+                       for target, cred in target_to_cred.items()]
+            launches.append((gid, mjob, futures, unresolved))
 
-            manifest = job['manifest']
-            app_name = job['job_group_name']
-
-            target_to_cred = self.creds_for_targets(
-                [t['cluster_name'] for t in targets])
-
-            for target, cred in target_to_cred.items():
-                for job_id in mjob['IDs']:
-                    jm.lock_job(job_id)
+        deployed_jobs = []
+        completed = []
+        done_groups = []
+        started_groups = []
+        for gid, mjob, futures, unresolved in launches:
+            failed = bool(unresolved)
+            dpl_ids = []
+            for target, cred, future in futures:
                 try:
-                    depl_id = self.launch(manifest, app_name, cred)
-                    log.info(f'Launched app on {target} with: {depl_id}')
+                    depl_id = future.result()
+                    log.info('Launched app on %s with: %s', target, depl_id,
+                             extra={'group': gid, 'target': target,
+                                    'deployment': depl_id})
                     deployed_jobs.append({'job': gid,
                                           'target': target,
                                           'deployment': depl_id})
-                    for job_id in mjob['IDs']:
-                        jm.mark_job_as_completed(job_id)
-                except Exception:
-                    log.exception(f'Failed launching deployment: {gid}')
-                    for job_id in mjob['IDs']:
-                        jm.unlock_job(job_id)
-
+                    dpl_ids.append(depl_id)
+                    launches_total.labels(result='ok').inc()
+                    self.breaker.success(target)
+                except DeploymentBusy as ex:
+                    # Not a failure of the target, the jobs are unlocked
+                    # and the group is deployed again in a later cycle.
+                    self.placement.release(cred)
+                    log.info('%s, deferring the group', ex,
+                             extra={'group': gid, 'target': target})
+                    failed = True
+                except Exception as ex:
+                    launches_total.labels(result='failed').inc()
+                    self.breaker.failure(target)
+                    self.placement.release(cred)
+                    log.exception('Failed launching deployment: %s', gid,
+                                  extra={'group': gid, 'target': target})
+                    if is_auth_or_not_found_error(ex):
+                        log.warning('Invalidating cached credentials of %s',
+                                    target)
+                        self.creds_cache.invalidate(target)
+                    failed = True
+            if not failed and self.config.confirm_started:
+                # The jobs stay locked until the deployments are started.
+                started_groups.append((gid, mjob['IDs'], dpl_ids))
+                completed.extend(mjob['IDs'])
+                continue
+            for job_id in mjob['IDs']:
+                if failed:
+                    transitions.unlock(job_id)
+                else:
+                    transitions.complete(job_id)
+                    completed.append(job_id)
+            if not failed:
+                done_groups.append((gid, mjob['IDs']))
+
+        outcomes = transitions.flush()
+        # Watched only once the locks were sent, so that the tracker does not
+        # complete jobs before they are locked.
+        for gid, job_ids, dpl_ids in started_groups:
+            self._confirm_started(gid, job_ids, dpl_ids, jm)
+        self.completed_jobs = sum(1 for x in completed if outcomes.get(x))
+        for gid, job_ids in done_groups:
+            if all(outcomes.get(x) for x in job_ids):
+                self.journal.done(gid)
+        failed_jobs = [k for k, ok in outcomes.items() if not ok]
+        if failed_jobs:
+            log.error('Failed updating state of jobs on JM: %s', failed_jobs)
+
+        log.debug('Credentials cache: %s', self.creds_cache.stats())
         return deployed_jobs
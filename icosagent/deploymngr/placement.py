@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import Callable, Iterable, List
+
+from nuvla.api import Api as Nuvla
+from nuvla.api.resources.deployment import Deployment
+
+from icosagent.log import get_logger
+
+log = get_logger('placement')
+
+# Credential statuses set by the Nuvla credential check.
+INVALID_CRED_STATUSES = ('UNVALID', 'INVALID')
+# Deployments in these states put no load on their credential.
+INACTIVE_STATES = (Deployment.STATE_STOPPED, Deployment.STATE_ERROR)
+# Buckets Nuvla returns for a terms aggregation, so at most as many
+# credentials are counted per search.
+AGGREGATION_BUCKETS = 10
+
+
+def is_valid_cred(cred: dict) -> bool:
+    """Credentials that were not checked yet are taken as valid."""
+    return cred.get('status') not in INVALID_CRED_STATUSES
+
+
+class CredentialSelector:
+    """Chooses the credential to launch with among the credentials of a
+    target: the valid one with the fewest active deployments.
+
+    The number of active deployments of the credentials that are not known
+    or older than `ttl` seconds is counted by Nuvla, aggregating the
+    deployments by `parent` without returning them, with one search per
+    `AGGREGATION_BUCKETS` credentials. In between, the launches chosen here are
+    counted locally, so consecutive launches spread over the credentials.
+    """
+
+    def __init__(self, nuvla: Nuvla, ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.nuvla = nuvla
+        self.ttl = ttl
+        self._clock = clock
+        # Credential ID to [active deployments, time loaded].
+        self._loads = {}
+        self._lock = threading.Lock()
+
+    def load(self, cred_id: str) -> int:
+        with self._lock:
+            entry = self._loads.get(cred_id)
+            return entry[0] if entry else 0
+
+    def _stale(self, cred_ids: Iterable[str]) -> List[str]:
+        now = self._clock()
+        with self._lock:
+            return [x for x in dict.fromkeys(cred_ids)
+                    if x not in self._loads or
+                    now - self._loads[x][1] >= self.ttl]
+
+    def refresh(self, creds_lists: Iterable[List[dict]]):
+        """Gets the active deployments of the credentials in `creds_lists`
+        that need it. Lists with a single valid credential leave no choice
+        and are skipped."""
+        stale = self._stale(c['id'] for creds in creds_lists
+                            if sum(map(is_valid_cred, creds)) > 1
+                            for c in creds if is_valid_cred(c))
+        if not stale:
+            return
+        active = ' and '.join(f'state!="{x}"' for x in INACTIVE_STATES)
+        loads = dict.fromkeys(stale, 0)
+        for i in range(0, len(stale), AGGREGATION_BUCKETS):
+            parents = ' or '.join(f'parent="{x}"' for x in
+                                  stale[i:i + AGGREGATION_BUCKETS])
+            found = self.nuvla.search(
+                Deployment.resource, filter=f'({parents}) and {active}',
+                aggregation='terms:parent', last=0)
+            buckets = found.data.get('aggregations', {}) \
+                .get('terms:parent', {}).get('buckets', [])
+            for bucket in buckets:
+                if bucket.get('key') in loads:
+                    loads[bucket['key']] = bucket.get('doc_count', 0)
+        now = self._clock()
+        with self._lock:
+            for cred_id, load in loads.items():
+                self._loads[cred_id] = [load, now]
+        log.debug('Active deployments of credentials: %s', loads)
+
+    def choose(self, creds: List[dict]) -> str:
+        """Returns ID of the least loaded valid credential in `creds`, the
+        first one on ties, and counts a launch on it. When none is valid
+        the first credential is returned, to let the launch report why."""
+        valid = [c['id'] for c in creds if is_valid_cred(c)]
+        if not valid:
+            log.warning('No valid credentials among %s',
+                        [c['id'] for c in creds])
+            return creds[0]['id']
+        with self._lock:
+            cred_id = min(valid, key=lambda x: self._loads[x][0]
+                          if x in self._loads else 0)
+            if cred_id in self._loads:
+                self._loads[cred_id][0] += 1
+        return cred_id
+
+    def release(self, cred_id: str):
+        """Uncounts a launch on `cred_id` that failed."""
+        with self._lock:
+            entry = self._loads.get(cred_id)
+            if entry and entry[0] > 0:
+                entry[0] -= 1
@@ -0,0 +1,235 @@
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+from nuvla.api.resources.deployment import Deployment
+from nuvla.api.resources.module import Module
+
+from icosagent.deploymngr.limits import TokenBucket
+from icosagent.deploymngr.nuvla import APP_DIGEST_RE, GROUP_TAG, \
+    DeploymentManagerNuvla
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.log import get_logger
+from icosagent.metrics import REGISTRY
+
+log = get_logger('reaper')
+
+reaped = REGISTRY.counter(
+    'dm_gc_actions_total',
+    'Stale deployments stopped or deleted and app modules deleted.',
+    labelnames=('action',))
+
+# Deployments in these states can be deleted right away, the others have to
+# be stopped first.
+DELETABLE_STATES = ('CREATED', Deployment.STATE_STOPPED,
+                    Deployment.STATE_ERROR)
+
+
+class GCReport(NamedTuple):
+    # IDs of the deployments to stop, deployments to delete and modules to
+    # delete.
+    stop: List[str]
+    delete: List[str]
+    modules: List[str]
+    # Resources looked at that are still in use or too young.
+    kept: int
+
+    @property
+    def total(self) -> int:
+        return len(self.stop) + len(self.delete) + len(self.modules)
+
+
+def _created_at(resource: dict) -> float:
+    try:
+        return datetime.fromisoformat(resource['created']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def _group_of(deployment: dict) -> Optional[str]:
+    for tag in deployment.get('tags') or []:
+        if tag.startswith(GROUP_TAG):
+            return tag[len(GROUP_TAG):]
+    return None
+
+
+def _app_of(module_path: str) -> Optional[str]:
+    match = APP_DIGEST_RE.search(module_path)
+    if not match:
+        return None
+    return module_path[:match.start()].rsplit('/', 1)[-1]
+
+
+class Reaper:
+    """Removes the deployments of the app modules under
+    `DeploymentManagerNuvla.PARENT_PATH` that no JM job refers to any more,
+    and the modules left without deployments.
+
+    A deployment belongs to the job group of its `GROUP_TAG` tag (see
+    `DeploymentManagerNuvla.deployment_tags`). Deployments of groups no
+    longer on the JM are stopped and, once stopped, deleted, and the modules
+    are deleted once they have no deployments; so a group is cleaned up over
+    a few passes. Modules are kept as long as a job of their app, by
+    `job_group_name`, is on the JM, so that the modules of live groups are
+    not created again. Deployments without the tag, launched by older
+    versions, are left alone. Resources younger than `min_age` seconds are left alone
+    too, so that launches in flight are not raced. Nothing is removed when
+    the JM returns no jobs at all.
+
+    Modules and deployments are paged through `page_size` at a time, in
+    the order they were created, selecting only the needed attributes. At most `batch` resources are
+    removed per pass, at `rate` calls per second. With `dry_run`, the
+    stale resources are only reported.
+    """
+
+    def __init__(self, dm: DeploymentManagerNuvla, jm: JobManagerProxy,
+                 interval: float = 0.0, dry_run=False,
+                 min_age: float = 3600.0, page_size: int = 500,
+                 batch: int = 100, rate: float = 1.0,
+                 clock: Callable[[], float] = time.time,
+                 bucket: TokenBucket = None):
+        self.dm = dm
+        self.nuvla = dm.nuvla
+        self.jm = jm
+        self.interval = interval
+        self.dry_run = dry_run
+        self.min_age = min_age
+        self.page_size = page_size
+        self.batch = batch
+        self.bucket = bucket or TokenBucket(rate, 1)
+        self._clock = clock
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _search_all(self, resource: str, flt: str, select: str) -> list:
+        # Paged by a cursor on the creation time and the ID rather than by
+        # offset, which Nuvla caps at 10000 results: after a page, the rest
+        # of the resources created at the same time as its last one, then
+        # the ones created later.
+        found = []
+        created = last_id = None
+        while True:
+            if last_id is not None:
+                page_flt = f'{flt} and created="{created}" and ' \
+                           f'id>"{last_id}"'
+                orderby = 'id:asc'
+            else:
+                page_flt = flt if created is None else \
+                    f'{flt} and created>"{created}"'
+                orderby = 'created:asc,id:asc'
+            page = [x.data for x in self.nuvla.search(
+                resource, filter=page_flt, select=select, orderby=orderby,
+                last=self.page_size).resources]
+            found.extend(page)
+            if len(page) == self.page_size:
+                created, last_id = page[-1].get('created'), page[-1]['id']
+            elif last_id is not None:
+                last_id = None
+            else:
+                return found
+
+    def find_stale(self) -> GCReport:
+        jobs = self.jm.fetch_jobs()
+        live = {j.get('job_group_id') for j in jobs}
+        live_apps = {self.dm.module_name(j['job_group_name']) for j in jobs
+                     if isinstance(j.get('job_group_name'), str)}
+        if not live:
+            # Most likely a JM answering wrong, rather than no jobs at all.
+            log.warning('No jobs on the JM, skipping the collection.')
+            return GCReport([], [], [], 0)
+        parent_path = self.dm.PARENT_PATH
+        modules = self._search_all(
+            Module.resource, f'parent-path="{parent_path}"',
+            'id,path,created')
+        deployments = self._search_all(
+            Deployment.resource, f'module/parent-path="{parent_path}"',
+            'id,state,module,tags,created')
+        old = self._clock() - self.min_age
+
+        stop, delete, kept = [], [], 0
+        # Modules with deployments, even stale ones, are deleted in a later
+        # pass.
+        used_paths = set()
+        for dpl in deployments:
+            used_paths.add((dpl.get('module') or {}).get('path'))
+            gid = _group_of(dpl)
+            if gid is None or gid in live or _created_at(dpl) > old:
+                kept += 1
+            elif dpl.get('state') in DELETABLE_STATES:
+                delete.append(dpl['id'])
+            else:
+                stop.append(dpl['id'])
+
+        stale_modules = []
+        for module in modules:
+            path = module.get('path') or ''
+            if path in used_paths or _app_of(path) in live_apps or \
+                    _created_at(module) > old:
+                kept += 1
+            else:
+                stale_modules.append(module['id'])
+        return GCReport(stop, delete, stale_modules, kept)
+
+    def _act(self, action: str, resource_id: str):
+        self.bucket.acquire()
+        try:
+            if action == 'stop':
+                self.nuvla.operation(self.nuvla.get(resource_id), 'stop')
+                self.dm.forget_deployment(resource_id)
+            else:
+                self.nuvla.delete(resource_id)
+                if action == 'delete_module':
+                    self.dm.forget_module(resource_id)
+                else:
+                    self.dm.forget_deployment(resource_id)
+            reaped.labels(action=action).inc()
+        except Exception as ex:
+            log.warning('Failed to %s %s: %s', action, resource_id, ex)
+
+    def reap(self) -> GCReport:
+        """Finds the stale resources and removes up to `batch` of them,
+        unless in dry run. Returns the report of the stale resources."""
+        report = self.find_stale()
+        log.info('%sStale: %s deployments to stop, %s deployments and %s '
+                 'modules to delete; %s resources kept',
+                 '[dry run] ' if self.dry_run else '', len(report.stop),
+                 len(report.delete), len(report.modules), report.kept)
+        if self.dry_run:
+            for name, ids in report._asdict().items():
+                if name != 'kept' and ids:
+                    log.info('[dry run] %s: %s', name, ids)
+            return report
+        actions = [('stop', x) for x in report.stop] + \
+            [('delete', x) for x in report.delete] + \
+            [('delete_module', x) for x in report.modules]
+        for action, resource_id in actions[:self.batch]:
+            if self._stop.is_set():
+                break
+            self._act(action, resource_id)
+        return report
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.reap()
+            except Exception:
+                log.exception('Failed collecting stale Nuvla resources.')
+
+    def start(self):
+        if self.running or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='reaper')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
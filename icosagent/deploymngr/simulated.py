@@ -0,0 +1,238 @@
+import itertools
+import operator
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Callable, Union
+
+import requests
+from nuvla.api import NuvlaError
+from nuvla.api.models import CimiCollection, CimiResource, CimiResponse
+
+# Latency in seconds of a call, given its name and the resource type.
+LatencyFn = Callable[[str, str], float]
+
+_TERM_RE = re.compile(
+    r'''([\w/-]+)\s*(!=|>=|<=|=|>|<)\s*["']([^"']*)["']''')
+_OPERATORS = {'>=': operator.ge, '<=': operator.le, '>': operator.gt,
+              '<': operator.lt}
+
+
+def _split_and(flt: str) -> list:
+    terms, depth, start = [], 0, 0
+    for i, c in enumerate(flt):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and flt.startswith(' and ', i):
+            terms.append(flt[start:i])
+            start = i + len(' and ')
+    terms.append(flt[start:])
+    return terms
+
+
+def parse_filter(flt: str) -> list:
+    """Parses the subset of CIMI filters used by the agent: conjunction of
+    terms, where each term is `key="value"` or an `or` of such on the same
+    key, or a comparison such as `key!="value"` or `key>="value"`. Returns
+    list of (key, operator, {values})."""
+    conditions = []
+    for term in _split_and(flt or ''):
+        matches = _TERM_RE.findall(term)
+        if not matches:
+            continue
+        values = {}
+        for key, op, value in matches:
+            values.setdefault((key, op), set()).add(value)
+        conditions.extend((k, op, v) for (k, op), v in values.items())
+    return conditions
+
+
+def _attribute(resource: dict, key: str):
+    # Nested attributes are given as e.g. `module/path`.
+    for name in key.split('/'):
+        if not isinstance(resource, dict):
+            return None
+        resource = resource.get(name)
+    return resource
+
+
+def _matches(resource: dict, conditions: list) -> bool:
+    for key, op, values in conditions:
+        value = _attribute(resource, key)
+        if op == '=':
+            ok = value in values
+        elif op == '!=':
+            ok = value not in values
+        else:
+            ok = value is not None and \
+                all(_OPERATORS[op](str(value), v) for v in values)
+        if not ok:
+            return False
+    return True
+
+
+def _aggregate(resources: list, aggregation: str) -> dict:
+    # Only `terms:<attribute>` aggregations, as used by the agent.
+    op, key = aggregation.split(':', 1)
+    if op != 'terms':
+        raise ValueError(f'Unsupported aggregation: {aggregation}')
+    counts = Counter(_attribute(r, key) for r in resources)
+    return {aggregation: {'buckets': [{'key': k, 'doc_count': n}
+                                      for k, n in counts.most_common()
+                                      if k is not None]}}
+
+
+class SimulatedNuvla:
+    """Minimal in-memory implementation of the `nuvla.api.Api` calls used by
+    the Deployment Manager, for the tests, the benchmarks and the replay mode
+    (see `icosagent.replay`).
+
+    Every call sleeps `latency` seconds to emulate the network round-trip;
+    `latency` can also be a function of the call name and the resource
+    type. Launches with the credentials in `fail_launch_on` fail with
+    `fail_launch_status`, and started deployments are in `started_state`.
+    """
+
+    def __init__(self, latency: Union[float, LatencyFn] = 0.0):
+        self.latency = latency
+        self.resources = {}
+        self.calls = Counter()
+        self.fail_launch_on = set()
+        self.fail_launch_status = 500
+        self.started_state = 'STARTED'
+        self._username = 'group/icos'
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def _call(self, name: str, resource: str = ''):
+        with self._lock:
+            self.calls[name] += 1
+        delay = self.latency(name, resource.split('/')[0]) \
+            if callable(self.latency) else self.latency
+        if delay:
+            time.sleep(delay)
+
+    def _new_id(self, resource_type: str) -> str:
+        return f'{resource_type}/{next(self._seq):08d}-{uuid.uuid4()}'
+
+    def put(self, resource_type: str, data: dict) -> str:
+        rid = data.get('id') or self._new_id(resource_type)
+        data = dict({'created': datetime.now(timezone.utc).isoformat()},
+                    **data)
+        data.update({'id': rid, 'resource-type': resource_type})
+        with self._lock:
+            self.resources[rid] = data
+        return rid
+
+    def add_edge(self, ne_id: str = None, creds=1, clusters=1) -> str:
+        """Registers NuvlaEdge with `clusters` kubernetes infrastructure
+        services and `creds` credentials on each. Returns NuvlaEdge ID."""
+        isg = self.put('infrastructure-service-group', {})
+        ne_id = self.put('nuvlabox', {'id': ne_id,
+                                      'infrastructure-service-group': isg})
+        for _ in range(clusters):
+            infra = self.put('infrastructure-service',
+                             {'parent': isg, 'subtype': 'kubernetes'})
+            for _ in range(creds):
+                self.put('credential', {'parent': infra,
+                                        'subtype': 'infrastructure-service-'
+                                                   'kubernetes'})
+        return ne_id
+
+    def _resource(self, resource_id: str) -> dict:
+        try:
+            return self.resources[resource_id]
+        except KeyError:
+            response = requests.Response()
+            response.status_code = 404
+            raise NuvlaError(f'{resource_id} not found', response)
+
+    def get(self, resource_id: str, select=None, **kwargs) -> CimiResource:
+        self._call('get', resource_id)
+        data = dict(self._resource(resource_id))
+        if select:
+            keys = set(select.split(',')) | {'id', 'resource-type'}
+            data = {k: v for k, v in data.items() if k in keys}
+        return CimiResource(data)
+
+    def search(self, resource_type: str, filter=None, select=None, first=None,
+               last=None, aggregation=None, orderby=None,
+               **kwargs) -> CimiCollection:
+        self._call('search', resource_type)
+        conditions = parse_filter(filter)
+        with self._lock:
+            found = [r for r in self.resources.values()
+                     if r['resource-type'] == resource_type and
+                     _matches(r, conditions)]
+        for order in reversed((orderby or '').split(',') if orderby else []):
+            key, _, direction = order.partition(':')
+            found.sort(key=lambda r: str(_attribute(r, key) or ''),
+                       reverse=direction == 'desc')
+        data = {'count': len(found)}
+        if aggregation:
+            data['aggregations'] = _aggregate(found, aggregation)
+        if first or last is not None:
+            found = found[(first or 1) - 1:last]
+        if select:
+            keys = set(select.split(',')) | {'id', 'resource-type'}
+            found = [{k: v for k, v in r.items() if k in keys} for r in found]
+        data['resources'] = found
+        return CimiCollection(data)
+
+    def add(self, resource_type: str, data: dict) -> CimiResponse:
+        self._call('add', resource_type)
+        if resource_type == 'deployment':
+            module_id = data['module']['href']
+            data = {'module': self._resource(module_id),
+                    'state': 'CREATED',
+                    'operations': [{'rel': 'start', 'href': 'start'}]}
+        elif resource_type == 'module':
+            with self._lock:
+                exists = any(r.get('path') == data['path']
+                             for r in self.resources.values())
+            if exists:
+                raise NuvlaError(f'path {data["path"]} already exist')
+        rid = self.put(resource_type, data)
+        return CimiResponse({'status': 201, 'resource-id': rid})
+
+    def edit(self, resource_id: str, data: dict, **kwargs) -> CimiResource:
+        self._call('edit', resource_id)
+        resource = self._resource(resource_id)
+        with self._lock:
+            resource.update(data)
+        return CimiResource(dict(resource))
+
+    def operation(self, resource: CimiResource, operation: str,
+                  data=None) -> CimiResponse:
+        self._call('operation', resource.id)
+        stored = self._resource(resource.id)
+        if operation == 'start':
+            if stored.get('parent') in self.fail_launch_on:
+                response = requests.Response()
+                response.status_code = self.fail_launch_status
+                raise NuvlaError(f'failed starting {resource.id}', response)
+            stored['state'] = self.started_state
+            stored['operations'] = [{'rel': rel, 'href': rel} for rel in
+                                    ('stop', 'fetch-module', 'update')]
+        elif operation == 'stop':
+            stored['state'] = 'STOPPED'
+            stored['operations'] = [{'rel': 'start', 'href': 'start'}]
+        elif operation == 'fetch-module':
+            stored['module'] = self._resource(data['module-href'])
+        elif operation == 'update':
+            stored['state'] = self.started_state
+        return CimiResponse({'status': 200, 'resource-id': resource.id})
+
+    def delete(self, resource_id: str) -> CimiResponse:
+        self._call('delete', resource_id)
+        with self._lock:
+            self.resources.pop(resource_id, None)
+        return CimiResponse({'status': 200, 'resource-id': resource_id})
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
@@ -0,0 +1,142 @@
+import threading
+import time
+from typing import Callable, Union
+
+from nuvla.api import Api as Nuvla
+from nuvla.api.resources.deployment import Deployment
+
+from icosagent.log import get_logger
+
+log = get_logger('dpl-tracker')
+
+# Gets deployment ID and its final state: `Deployment.STATE_STARTED`,
+# `Deployment.STATE_ERROR` or `DeploymentTracker.TIMEOUT`.
+FinalStateCallback = Callable[[str, str], None]
+
+
+class DeploymentTracker:
+    """Watches many Nuvla deployments at once until they reach a final
+    state.
+
+    Each `poll()` gets the state of all the watched deployments with one
+    search. The poll interval starts at `min_interval` and grows by
+    `backoff_factor` up to `max_interval` while none of the deployments
+    changes its state. Deployments that do not reach a final state within
+    their timeout are reported as `TIMEOUT`.
+    """
+
+    FINAL_STATES = (Deployment.STATE_STARTED, Deployment.STATE_ERROR)
+    TIMEOUT = 'TIMEOUT'
+
+    def __init__(self, nuvla: Nuvla, min_interval=1.0, max_interval=30.0,
+                 backoff_factor=2.0, timeout=600.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.nuvla = nuvla
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.interval = min_interval
+        self._clock = clock
+        # Deployment ID to (deadline, callback).
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._watched)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def watch(self, dpl_id: str, callback: FinalStateCallback,
+              timeout: Union[float, None] = None):
+        deadline = self._clock() + (timeout or self.timeout)
+        with self._lock:
+            was_idle = not self._watched
+            self._watched[dpl_id] = (deadline, callback)
+        self.interval = self.min_interval
+        if was_idle:
+            self._wakeup.set()
+
+    def _fetch_states(self, dpl_ids: list) -> dict:
+        flt = ' or '.join(f'id="{x}"' for x in dpl_ids)
+        resources = self.nuvla.search(Deployment.resource, filter=flt,
+                                      select='id,state',
+                                      last=len(dpl_ids)).resources
+        return {x.data['id']: x.data.get('state') for x in resources}
+
+    def poll(self) -> int:
+        """Gets states of the watched deployments and calls back for the
+        ones in final state or timed out. Returns the number of such
+        deployments."""
+        with self._lock:
+            watched = dict(self._watched)
+        if not watched:
+            return 0
+
+        states = self._fetch_states(list(watched))
+        now = self._clock()
+        finished = []
+        for dpl_id, (deadline, callback) in watched.items():
+            # Fresh deployments might not be searchable yet.
+            state = states.get(dpl_id)
+            if state in self.FINAL_STATES:
+                finished.append((dpl_id, state, callback))
+            elif now >= deadline:
+                log.warning('Deployment %s not in final state after timeout '
+                            '(state: %s)', dpl_id, state)
+                finished.append((dpl_id, self.TIMEOUT, callback))
+
+        with self._lock:
+            for dpl_id, _, _ in finished:
+                self._watched.pop(dpl_id, None)
+        for dpl_id, state, callback in finished:
+            log.info('Deployment %s is %s', dpl_id, state)
+            try:
+                callback(dpl_id, state)
+            except Exception:
+                log.exception('Failed handling final state of %s', dpl_id)
+
+        if finished:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff_factor,
+                                self.max_interval)
+        return len(finished)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not len(self):
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.poll()
+            except Exception:
+                log.exception('Failed getting states of deployments.')
+                self.interval = min(self.interval * self.backoff_factor,
+                                    self.max_interval)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='dpl-tracker')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,102 @@
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable
+
+from icosagent.config.config import HealthConf
+from icosagent.log import get_logger
+
+log = get_logger('health')
+
+
+class Health:
+    """Initialisation, readiness and liveness of the agent.
+
+    `init()` runs the initialisation of a component (e.g. a login) in a
+    background thread, retrying it with exponential backoff from
+    `retry_min_interval` up to `retry_max_interval` seconds until it
+    succeeds. The agent is ready once all its components are initialised.
+    It is alive while the main loop calls `beat()` at least every
+    `liveness_timeout` seconds.
+    """
+
+    READY_PATH = '/readyz'
+    LIVE_PATH = '/healthz'
+
+    def __init__(self, config: HealthConf = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = None):
+        self.config = config or HealthConf()
+        self._clock = clock
+        self._stop = threading.Event()
+        self._sleep = sleep or self._stop.wait
+        self._last_beat = clock()
+        # Component name to the event set once it is initialised.
+        self._components = {}
+        self._lock = threading.Lock()
+
+    def init(self, name: str, func: Callable[[], None]) -> threading.Thread:
+        with self._lock:
+            self._components[name] = threading.Event()
+        thread = threading.Thread(target=self._init, args=(name, func),
+                                  daemon=True, name=f'init-{name}')
+        thread.start()
+        return thread
+
+    def _init(self, name: str, func: Callable[[], None]):
+        delay = self.config.retry_min_interval
+        attempt = 1
+        start = self._clock()
+        while not self._stop.is_set():
+            try:
+                func()
+                log.info('Initialised %s in %.1f sec (attempts: %s).', name,
+                         self._clock() - start, attempt)
+                self._components[name].set()
+                return
+            except Exception as ex:
+                log.warning('Failed initialising %s (attempt %s), retrying '
+                            'in %.1f sec: %s', name, attempt, delay, ex)
+            self._sleep(delay)
+            delay = min(delay * 2, self.config.retry_max_interval)
+            attempt += 1
+
+    def stop(self):
+        self._stop.set()
+
+    def initialised(self, name: str) -> bool:
+        with self._lock:
+            event = self._components.get(name)
+        return event is not None and event.is_set()
+
+    def wait(self, name: str, timeout: float = None) -> bool:
+        """Waits up to `timeout` seconds for component `name` to be
+        initialised. Returns whether it is."""
+        with self._lock:
+            event = self._components.get(name)
+        return event is not None and event.wait(timeout)
+
+    def ready(self) -> bool:
+        with self._lock:
+            return all(e.is_set() for e in self._components.values())
+
+    def beat(self):
+        self._last_beat = self._clock()
+
+    def live(self) -> bool:
+        return self._clock() - self._last_beat < self.config.liveness_timeout
+
+    def handle_ready(self, body: bytes) -> tuple:
+        if self.ready():
+            return HTTPStatus.OK, 'text/plain', b'ready\n'
+        with self._lock:
+            pending = [n for n, e in self._components.items()
+                       if not e.is_set()]
+        return HTTPStatus.SERVICE_UNAVAILABLE, 'text/plain', \
+            f'initialising: {", ".join(pending)}\n'.encode()
+
+    def handle_live(self, body: bytes) -> tuple:
+        if self.live():
+            return HTTPStatus.OK, 'text/plain', b'alive\n'
+        return HTTPStatus.SERVICE_UNAVAILABLE, 'text/plain', \
+            b'main loop stuck\n'
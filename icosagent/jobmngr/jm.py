@@ -1,13 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from http import HTTPStatus
 import os
+import threading
+from typing import Dict, Tuple, Union
 import requests
 
 from icosagent.authmngr.authmngr import AuthManager
 from icosagent.config.config import JobManagerConf as JMConfig
 from icosagent.log import get_logger
+from icosagent.metrics import REGISTRY
 
 log = get_logger('job-manager')
 
+request_sec = REGISTRY.histogram(
+    'jm_request_seconds', 'Latency of ICOS JM requests.',
+    labelnames=('call',))
+request_failures = REGISTRY.counter(
+    'jm_request_failures_total', 'Failed ICOS JM requests.',
+    labelnames=('call',))
+
 
 class JobManagerProxy:
 
@@ -20,91 +32,248 @@ class JobManagerProxy:
     JOBS_URI = os.path.join(JM_URI, 'jobs')
     JOBS_URI_NUVLA = os.path.join(JOBS_URI, 'executable/orchestrator/nuvla')
 
-    def __init__(self, config: JMConfig, auth_mngr: AuthManager):
+    def __init__(self, config: JMConfig, auth_mngr: AuthManager,
+                 session: requests.Session = None):
         self.url = config.url
         self.auth_mngr = auth_mngr
-        self.token = None
+        # Shared with the auth manager to keep the connections alive.
+        self.session = session or auth_mngr.session
+        self.transition_workers = config.transition_workers
+        self.bulk_url = None
+        if config.bulk_uri:
+            self.bulk_url = os.path.join(self.url, config.bulk_uri)
+        # Last list of jobs to launch and its ETag.
+        self._jobs = []
+        self._jobs_etag = None
 
-    def _cond_authn(self):
-        if not self.token:
-            log.info('Authenticating with ICOS.')
-            self.token = self.auth_mngr.get_token()
+    @staticmethod
+    def job_created_at(job: dict) -> Union[float, None]:
+        """Returns creation time of `job` as POSIX timestamp, falling back to
+        its last update time, or None if the job has neither."""
+        for key in ('created_at', 'updated_at'):
+            try:
+                return datetime.fromisoformat(job[key]).timestamp()
+            except (KeyError, TypeError, ValueError):
+                continue
+        return None
 
-    def _is_need_reauthn(self, resp: requests.Response) -> bool:
-        if resp.status_code == HTTPStatus.INTERNAL_SERVER_ERROR:
+    def _is_need_reauthn(self, resp: requests.Response, token: str) -> bool:
+        if resp.status_code in (HTTPStatus.UNAUTHORIZED,
+                                HTTPStatus.INTERNAL_SERVER_ERROR):
             log.warning('Need to re-authenticate with ICOS.')
-            self.token = None
+            self.auth_mngr.invalidate(token)
             return True
         return False
 
-    def deployments_to_launch(self) -> list:
-        depl_jobs_url_nuvla = os.path.join(self.url, self.JOBS_URI_NUVLA)
+    def _send(self, method: str, url: str, action: str, call: str,
+              **kwargs) -> requests.Response:
+        """Sends the request and returns successful response or raises
+        `requests.exceptions.RequestException`. Latency of each attempt is
+        observed under the `call` label."""
+        latency = request_sec.labels(call=call)
+        extra_headers = kwargs.pop('headers', {})
         try:
-            for _ in range(2):  # retry logic for re-authentication
-                self._cond_authn()
-                headers = {'Authorization': f'Bearer {self.token}'}
-                log.info('Getting deployments from JM...')
-                resp = requests.get(depl_jobs_url_nuvla, headers=headers)
+            for attempt in range(2):  # retry logic for re-authentication
+                token = self.auth_mngr.token()
+                headers = dict(extra_headers,
+                               Authorization=f'Bearer {token}')
+                log.info(action)
+                with latency.time():
+                    resp = self.session.request(method, url, headers=headers,
+                                                **kwargs)
 
-                if self._is_need_reauthn(resp):
+                if attempt == 0 and self._is_need_reauthn(resp, token):
                     continue
                 resp.raise_for_status()
-                return resp.json()
+                return resp
+        except requests.exceptions.RequestException:
+            request_failures.labels(call=call).inc()
+            raise
 
+    def _request(self, method: str, url: str, action: str, call: str,
+                 **kwargs):
+        try:
+            return self._send(method, url, action, call, **kwargs).json()
         except requests.exceptions.RequestException as ex:
             log.exception(ex)
 
-        return []
+    def fetch_deployments(self) -> Tuple[list, bool]:
+        """Returns the jobs to launch and whether they changed since the
+        last call. When the JM sends an ETag, the jobs are only downloaded
+        again when they changed. Raises
+        `requests.exceptions.RequestException` on failure."""
+        depl_jobs_url_nuvla = os.path.join(self.url, self.JOBS_URI_NUVLA)
+        headers = {}
+        if self._jobs_etag:
+            headers['If-None-Match'] = self._jobs_etag
+        resp = self._send('GET', depl_jobs_url_nuvla,
+                          'Getting deployments from JM...',
+                          'deployments_to_launch', headers=headers)
+        if resp.status_code == HTTPStatus.NOT_MODIFIED:
+            return self._jobs, False
+        self._jobs = resp.json() or []
+        self._jobs_etag = resp.headers.get('ETag')
+        return self._jobs, True
+
+    def deployments_to_launch(self) -> list:
+        """Returns the jobs to launch. Raises
+        `requests.exceptions.RequestException` on failure, so that errors
+        are not mistaken for no jobs."""
+        return self.fetch_deployments()[0]
+
+    def fetch_jobs(self) -> list:
+        """Returns all the jobs on the JM, whatever their state. Raises
+        `requests.exceptions.RequestException` on failure."""
+        jobs_url = os.path.join(self.url, self.JOBS_URI)
+        return self._send('GET', jobs_url, 'Getting all jobs from JM...',
+                          'fetch_jobs').json() or []
 
     def delete_job(self, job_id):
         depl_job_url = os.path.join(self.url, self.JOBS_URI, job_id)
-        try:
-            for _ in range(2):  # retry logic for re-authentication
-                self._cond_authn()
-                headers = {'Authorization': f'Bearer {self.token}'}
-                log.info(f'Delete job {job_id}...')
-                resp = requests.delete(depl_job_url, headers=headers)
+        return self._request('DELETE', depl_job_url, f'Delete job {job_id}...',
+                             'delete_job')
 
-                if self._is_need_reauthn(resp):
-                    continue
-                resp.raise_for_status()
-                return resp.json()
+    @classmethod
+    def _job_state(cls, job_id: str, locker: bool, state: int) -> dict:
+        return {'ID': job_id, 'uuid': job_id, 'locker': locker,
+                'state': state}
 
-        except requests.exceptions.RequestException as ex:
-            log.exception(ex)
+    def mark_job_as_completed(self, job_id) -> bool:
+        data = self._job_state(job_id, True, self.JOB_COMPLETED)
+        return self._put_job(job_id, data, 'Mark as completed')
 
-    def mark_job_as_completed(self, job_id):
-        data = {'ID': job_id, 'uuid': job_id,
-                'locker': True, 'state': self.JOB_COMPLETED}
-        self._put_job(job_id, data, 'Mark as completed')
+    def lock_job(self, job_id, **fields) -> bool:
+        """Locks the job, recording `fields` on it along the lock, e.g. the
+        lease of the replica locking it (see `JobSharding.lease_fields`)."""
+        data = dict(self._job_state(job_id, True, self.JOB_PROCESSING),
+                    **fields)
+        return self._put_job(job_id, data, 'Lock')
 
-    def lock_job(self, job_id):
-        data = {'ID': job_id, 'uuid': job_id,
-                'locker': True, 'state': self.JOB_PROCESSING}
-        self._put_job(job_id, data, 'Lock')
+    def unlock_job(self, job_id) -> bool:
+        data = self._job_state(job_id, False, self.JOB_CREATED)
+        return self._put_job(job_id, data, 'Unlock')
 
-    def unlock_job(self, job_id):
-        data = {'ID': job_id, 'uuid': job_id,
-                'locker': False, 'state': self.JOB_CREATED}
-        self._put_job(job_id, data, 'Unlock')
+    def mark_job_as_degraded(self, job_id) -> bool:
+        data = self._job_state(job_id, True, self.JOB_DEGRADED)
+        return self._put_job(job_id, data, 'Mark as degraded')
 
-    def _put_job(self, job_id: str, data: dict, action: str):
+    def _put_job(self, job_id: str, data: dict, action: str) -> bool:
         depl_job_url = os.path.join(self.url, self.JOBS_URI, job_id)
         try:
-            for _ in range(2):  # retry logic for re-authentication
-                if not self.token:
-                    log.info('Authenticating with ICOS.')
-                    self.token = self.auth_mngr.get_token()
-                headers = {'Authorization': f'Bearer {self.token}'}
-                log.info(f'{action} job {job_id}')
-                resp = requests.put(depl_job_url, json=data, headers=headers)
-
-                if resp.status_code == HTTPStatus.INTERNAL_SERVER_ERROR:
-                    log.warning('Re-authenticating with ICOS.')
-                    self.token = None
-                    continue
-                resp.raise_for_status()
-                return resp.json()
+            self._send('PUT', depl_job_url, f'{action} job {job_id}',
+                       'put_job', json=data)
+            return True
+        except requests.exceptions.RequestException as ex:
+            log.exception(ex)
+            return False
 
+    def put_jobs(self, jobs: list) -> bool:
+        """Updates state of all `jobs` with one request to the JM bulk
+        endpoint (see `JobManagerConf.bulk_uri`)."""
+        try:
+            self._send('PUT', self.bulk_url, f'Update {len(jobs)} jobs',
+                       'put_jobs', json=jobs)
+            return True
         except requests.exceptions.RequestException as ex:
             log.exception(ex)
+            return False
+
+    def transitions(self) -> 'JobTransitions':
+        return JobTransitions(self, self.transition_workers)
+
+
+class JobTransitions:
+    """Buffers job state transitions of one cycle and sends only the final
+    state of each job on `flush()`.
+
+    A lock followed by completion of the same job results in a single
+    completion, and a lock followed by unlock cancels out when the lock was
+    not sent yet. The states are sent concurrently on `workers` threads, or
+    with one request when the JM proxy has a bulk endpoint configured.
+    `lock_fields` are recorded on the jobs along their locks."""
+
+    LOCK = 'lock'
+    COMPLETE = 'complete'
+    DEGRADE = 'degrade'
+    UNLOCK = 'unlock'
+
+    def __init__(self, jm, workers: int = 1):
+        self.jm = jm
+        self.workers = workers
+        self._pending = {}
+        self._sent = {}
+        self._lock = threading.Lock()
+        self.lock_fields = {}
+
+    def _add(self, job_id: str, action: str):
+        with self._lock:
+            self._pending[job_id] = action
+
+    def lock(self, job_id: str):
+        self._add(job_id, self.LOCK)
+
+    def complete(self, job_id: str):
+        self._add(job_id, self.COMPLETE)
+
+    def degrade(self, job_id: str):
+        self._add(job_id, self.DEGRADE)
+
+    def unlock(self, job_id: str):
+        self._add(job_id, self.UNLOCK)
+
+    def _is_noop(self, job_id: str, action: str) -> bool:
+        sent = self._sent.get(job_id)
+        if action == self.UNLOCK:
+            return sent in (None, self.UNLOCK)
+        return sent == action
+
+    def _put(self, item: tuple) -> bool:
+        job_id, action = item
+        if action == self.LOCK:
+            return self.jm.lock_job(job_id, **self.lock_fields)
+        if action == self.COMPLETE:
+            return self.jm.mark_job_as_completed(job_id)
+        if action == self.DEGRADE:
+            return self.jm.mark_job_as_degraded(job_id)
+        return self.jm.unlock_job(job_id)
+
+    def _put_bulk(self, items: list) -> list:
+        states = {self.LOCK: (True, JobManagerProxy.JOB_PROCESSING),
+                  self.COMPLETE: (True, JobManagerProxy.JOB_COMPLETED),
+                  self.DEGRADE: (True, JobManagerProxy.JOB_DEGRADED),
+                  self.UNLOCK: (False, JobManagerProxy.JOB_CREATED)}
+        data = [dict(JobManagerProxy._job_state(job_id, *states[action]),
+                     **(self.lock_fields if action == self.LOCK else {}))
+                for job_id, action in items]
+        return [self.jm.put_jobs(data)] * len(items)
+
+    def flush(self) -> Dict[str, bool]:
+        """Sends the buffered transitions. Returns job ID to whether its
+        state was updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        outcomes = {}
+        items = []
+        for job_id, action in pending.items():
+            if self._is_noop(job_id, action):
+                outcomes[job_id] = True
+            else:
+                items.append((job_id, action))
+        if not items:
+            return outcomes
+
+        if getattr(self.jm, 'bulk_url', None):
+            results = self._put_bulk(items)
+        elif self.workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(self._put, items))
+        else:
+            results = [self._put(x) for x in items]
+
+        for (job_id, action), ok in zip(items, results):
+            outcomes[job_id] = bool(ok)
+            if ok:
+                self._sent[job_id] = action
+            else:
+                log.error('Failed to %s job %s', action, job_id)
+        return outcomes
@@ -0,0 +1,154 @@
+import hashlib
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Union
+
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.log import get_logger
+
+log = get_logger('sharding')
+
+REPLICA_INDEX_RE = re.compile(r'(\d+)$')
+
+# Job attributes recording the replica that locked the job and when.
+LOCKED_BY_KEY = 'locked_by'
+LOCKED_AT_KEY = 'locked_at'
+
+
+def replica_index(replica: str) -> int:
+    """Returns index of the replica given either as the index itself or as a
+    name ending with it, e.g. the `icos-agent-dm-2` pod of a StatefulSet.
+    Defaults to the host name."""
+    replica = replica or os.environ.get('HOSTNAME', '')
+    match = REPLICA_INDEX_RE.search(replica)
+    if not match:
+        raise ValueError(f'Cannot get replica index from "{replica}"')
+    return int(match.group(1))
+
+
+class JobSharding:
+    """Splits job groups between `replicas` Deployment Manager replicas so
+    that each group is launched by exactly one of them.
+
+    Each replica ranks the replicas for a group by rendezvous hashing of the
+    group ID, which all the replicas compute the same way without talking to
+    each other. The group belongs to the first replica of the ranking. Once
+    the group has been waiting on the JM for `lease` seconds, e.g. because
+    its replica is down, it moves to the next replica of the ranking, and so
+    on every `lease` seconds.
+
+    Replicas lock the jobs on the JM before launching them, recording on
+    them which replica locked them and when (see `lease_fields`). Locked
+    jobs belong to the replica that locked them for `lock_lease` seconds,
+    and then move along the ranking from that replica every `lock_lease`
+    seconds, so that the groups of a replica that crashed in the middle of
+    a deployment are taken over (see `reclaim`). `lock_lease` has to be
+    longer than deploying a group takes.
+    """
+
+    def __init__(self, replicas: int, index: int, lease: float = 300.0,
+                 lock_lease: float = None,
+                 clock: Callable[[], float] = time.time):
+        if not 0 <= index < replicas:
+            raise ValueError(f'Replica index {index} not in [0, {replicas})')
+        self.replicas = replicas
+        self.index = index
+        self.lease = lease
+        self.lock_lease = lease if lock_lease is None else lock_lease
+        self._clock = clock
+        self._reclaim_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.replicas > 1
+
+    def ranking(self, group_id: str) -> List[int]:
+        def score(replica: int) -> bytes:
+            return hashlib.sha256(f'{group_id}/{replica}'.encode()).digest()
+        return sorted(range(self.replicas), key=score, reverse=True)
+
+    def owner(self, group_id: str, age: float = 0.0) -> int:
+        leases = int(age // self.lease) if self.lease > 0 else 0
+        return self.ranking(group_id)[leases % self.replicas]
+
+    def lease_fields(self) -> dict:
+        """Returns the attributes to record on the jobs this replica
+        locks."""
+        return {LOCKED_BY_KEY: self.index,
+                LOCKED_AT_KEY: datetime.fromtimestamp(
+                    self._clock(), timezone.utc).isoformat()}
+
+    def lock_owner(self, job: dict) -> Union[int, None]:
+        """Returns the replica a job locked for deployment belongs to, or
+        None when the job is done or its lock has no lease."""
+        if job.get('state') != JobManagerProxy.JOB_PROCESSING:
+            return None
+        try:
+            locked_by = int(job[LOCKED_BY_KEY])
+            locked_at = datetime.fromisoformat(job[LOCKED_AT_KEY]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return None
+        ranking = self.ranking(job.get('job_group_id'))
+        if locked_by not in ranking:
+            return None
+        leases = 0
+        if self.lock_lease > 0:
+            leases = int(max(0.0, self._clock() - locked_at)
+                         // self.lock_lease)
+        return ranking[(ranking.index(locked_by) + leases) % self.replicas]
+
+    def select(self, jobs: List[dict]) -> List[dict]:
+        """Returns the `jobs` of the groups owned by this replica. Locked
+        jobs are returned only once their lock expired and they moved to
+        this replica."""
+        if not self.enabled:
+            return jobs
+        now = self._clock()
+        created: Dict[str, float] = {}
+        # Group ID to whether its locked jobs moved to this replica.
+        taken_over: Dict[str, bool] = {}
+        for job in jobs:
+            gid = job.get('job_group_id')
+            ts = JobManagerProxy.job_created_at(job)
+            if ts is not None and ts < created.get(gid, now):
+                created[gid] = ts
+            owner = self.lock_owner(job) if job.get('locker') else None
+            if owner is not None:
+                taken_over[gid] = taken_over.get(gid, True) and \
+                    owner == self.index and \
+                    job.get(LOCKED_BY_KEY) != self.index
+        owned = set()
+        for gid in dict.fromkeys(j.get('job_group_id') for j in jobs):
+            if gid in taken_over:
+                if taken_over[gid]:
+                    owned.add(gid)
+                continue
+            age = max(0.0, now - created.get(gid, now))
+            if self.owner(gid, age) == self.index:
+                owned.add(gid)
+        # Jobs locked otherwise, e.g. done, are left alone.
+        selected = [j for j in jobs if j.get('job_group_id') in owned and
+                    (not j.get('locker') or self.lock_owner(j) is not None)]
+        log.debug('Replica %s of %s owns %s of %s jobs', self.index,
+                  self.replicas, len(selected), len(jobs))
+        return selected
+
+    def reclaim(self, fetch_jobs: Callable[[], List[dict]]) -> List[dict]:
+        """Returns the jobs locked by other replicas whose lock expired and
+        that this replica takes over. All the jobs are got with
+        `fetch_jobs` at most every half `lock_lease`."""
+        if not self.enabled or self.lock_lease <= 0:
+            return []
+        now = self._clock()
+        if now < self._reclaim_at:
+            return []
+        self._reclaim_at = now + self.lock_lease / 2
+        jobs = [j for j in fetch_jobs()
+                if j.get('locker') and self.lock_owner(j) is not None]
+        reclaimed = self.select(jobs)
+        if reclaimed:
+            log.warning('Taking over %s jobs locked by other replicas: %s',
+                        len(reclaimed), [j['ID'] for j in reclaimed])
+        return reclaimed
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import time
+from typing import Callable, Dict, List
+
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.log import get_logger
+
+log = get_logger('job-sync')
+
+
+class JobSync:
+    """Gets from the JM only the jobs that are new or changed since the last
+    call.
+
+    Jobs are remembered by ID and digest of their content. All the jobs of
+    a group are returned when any of them is new or changed, so that groups
+    are always deployed whole. When the JM answers that the list did not
+    change (see `JobManagerProxy.fetch_deployments`), the jobs are not
+    looked at at all. Every `resync_interval` seconds all the jobs are
+    returned again, so that jobs that failed, or whose replica went away
+    (see `JobSharding`), are retried; with 0, all the jobs are returned on
+    every call.
+    """
+
+    def __init__(self, jm: JobManagerProxy, resync_interval: float = 0.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.jm = jm
+        self.resync_interval = resync_interval
+        self._clock = clock
+        self._resync_at = 0.0
+        # Job ID to digest of its content.
+        self._seen: Dict[str, str] = {}
+        # Whether the last call returned all the jobs on the JM.
+        self.full = False
+
+    @staticmethod
+    def digest(job: dict) -> str:
+        return hashlib.sha1(json.dumps(job, sort_keys=True).encode()) \
+            .hexdigest()
+
+    def resync(self):
+        """Makes the next call return all the jobs, e.g. after the changed
+        ones could not be deployed."""
+        self._resync_at = 0.0
+
+    def changed(self) -> List[dict]:
+        jobs, modified = self.jm.fetch_deployments()
+        self.full = self.resync_interval <= 0
+        if self.full:
+            return jobs
+        now = self._clock()
+        resync = now >= self._resync_at
+        if not modified and not resync:
+            return []
+
+        seen, self._seen = self._seen, {}
+        changed_groups = set()
+        for job in jobs:
+            digest = self.digest(job)
+            self._seen[job['ID']] = digest
+            if seen.get(job['ID']) != digest:
+                changed_groups.add(job.get('job_group_id'))
+        if resync:
+            self._resync_at = now + self.resync_interval
+            self.full = True
+            return jobs
+        changed = [j for j in jobs if j.get('job_group_id') in changed_groups]
+        log.debug('%s of %s jobs changed', len(changed), len(jobs))
+        return changed
@@ -0,0 +1,160 @@
+import itertools
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from icosagent.log import get_logger
+from icosagent.metrics import REGISTRY, Histogram, Registry
+
+log = get_logger('work-queue')
+
+queue_wait_sec = REGISTRY.histogram(
+    'dm_queue_wait_seconds',
+    'Time job groups waited in the work queue before being deployed.')
+queue_evicted = REGISTRY.counter(
+    'dm_queue_evicted_total',
+    'Job groups not queued or evicted because the work queue was full.')
+
+# Job attributes with the priority (higher first) and the deadline (ISO 8601
+# timestamp) of the job.
+PRIORITY_KEY = 'priority'
+DEADLINE_KEY = 'deadline'
+
+
+def _priority(job: dict) -> int:
+    try:
+        return int(job.get(PRIORITY_KEY) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _deadline(job: dict) -> float:
+    try:
+        return datetime.fromisoformat(job[DEADLINE_KEY]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return float('inf')
+
+
+class _Group:
+
+    def __init__(self, gid: str, seq: int, enqueued: float):
+        self.gid = gid
+        self.seq = seq
+        self.enqueued = enqueued
+        self.jobs = []
+        self.priority = 0
+        self.deadline = float('inf')
+        self.cost = 1
+
+    def update(self, jobs: List[dict]):
+        self.jobs = jobs
+        self.priority = max(_priority(j) for j in jobs)
+        self.deadline = min(_deadline(j) for j in jobs)
+        # Launches the group takes, one per Nuvla target.
+        self.cost = max(1, len({t.get('cluster_name') for j in jobs
+                                for t in j.get('targets') or []
+                                if t.get('orchestrator') == 'nuvla'}))
+
+    def key(self) -> tuple:
+        return -self.priority, self.deadline, self.seq
+
+
+class WorkQueue:
+    """Orders the job groups got from the JM for deployment.
+
+    Groups are taken highest `priority` first, then earliest `deadline`
+    first, then in the order they were queued, so that each group gets its
+    turn. Each `take()` returns the groups fitting in `max_launches` Nuvla
+    target launches, skipping the groups too large for what is left of the
+    budget, so that small groups are not held up behind a group fanning out
+    to many targets; the first group is always taken, however large. A
+    `max_launches` of 0 takes all the groups.
+
+    At most `max_groups` groups are queued. When full, a new group evicts
+    the last queued group if it comes before it, and is not queued
+    otherwise. Groups left out are got from the JM again later (see
+    `JobSync.resync`).
+
+    The time groups waited is observed in `wait_sec`, by default
+    `dm_queue_wait_seconds`.
+    """
+
+    def __init__(self, max_groups: int = 10000, max_launches: int = 0,
+                 clock: Callable[[], float] = time.monotonic,
+                 wait_sec: Histogram = None):
+        self.max_groups = max_groups
+        self.max_launches = max_launches
+        self._clock = clock
+        self.wait_sec = wait_sec or queue_wait_sec
+        self._seq = itertools.count()
+        self._groups: Dict[str, _Group] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._groups)
+
+    def register_metrics(self, registry: Registry = REGISTRY):
+        registry.gauge('dm_queue_groups', 'Job groups waiting in the work '
+                                          'queue.', fn=self.__len__)
+
+    def put(self, jobs: List[dict], full: bool = False) -> int:
+        """Queues the groups of `jobs`, replacing the jobs of the groups
+        queued already. With `full`, `jobs` are all the jobs on the JM and
+        the queued groups not among them are dropped. Returns the number of
+        groups left out because the queue is full."""
+        by_group: Dict[str, List[dict]] = {}
+        for job in jobs:
+            by_group.setdefault(job.get('job_group_id'), []).append(job)
+        now = self._clock()
+        left_out = 0
+        with self._lock:
+            if full:
+                for gid in [g for g in self._groups if g not in by_group]:
+                    del self._groups[gid]
+            for gid, group_jobs in by_group.items():
+                group = self._groups.get(gid)
+                if group is not None:
+                    group.update(group_jobs)
+                    continue
+                group = _Group(gid, next(self._seq), now)
+                group.update(group_jobs)
+                if self._full():
+                    left_out += 1
+                    last = max(self._groups.values(), key=_Group.key)
+                    if group.key() >= last.key():
+                        continue
+                    del self._groups[last.gid]
+                self._groups[gid] = group
+        if left_out:
+            queue_evicted.inc(left_out)
+            log.warning('Work queue full, %s job groups left out', left_out)
+        return left_out
+
+    def _full(self) -> bool:
+        return 0 < self.max_groups <= len(self._groups)
+
+    def take(self) -> List[dict]:
+        """Removes the next groups from the queue and returns their jobs."""
+        now = self._clock()
+        taken = []
+        budget = self.max_launches
+        with self._lock:
+            for group in sorted(self._groups.values(), key=_Group.key):
+                if self.max_launches > 0:
+                    if taken and group.cost > budget:
+                        continue
+                    budget -= group.cost
+                taken.append(group)
+                if self.max_launches > 0 and budget <= 0:
+                    break
+            for group in taken:
+                del self._groups[group.gid]
+            left = len(self._groups)
+        for group in taken:
+            self.wait_sec.observe(now - group.enqueued)
+        if left:
+            log.info('Taking %s job groups, %s left in the work queue',
+                     len(taken), left)
+        return [j for g in taken for j in g.jobs]
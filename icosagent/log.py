@@ -1,7 +1,16 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
 import sys
-from typing import Union
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Union
+
+from icosagent.config.config import LogConf
 
 log_formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s')
@@ -12,6 +21,14 @@ logger = logging.getLogger('icos')
 logger.addHandler(stdout_handler)
 logger.setLevel(logging.INFO)
 
+# Record attributes given with `extra` that are emitted as JSON fields.
+STRUCTURED_FIELDS = ('job', 'group', 'target', 'deployment', 'suppressed')
+
+# Handler of the loggers got with `get_logger`, see `setup_logging`.
+_handler: logging.Handler = stdout_handler
+_loggers = set()
+_listener: Union['_QueueListener', None] = None
+
 
 def loglevel_from_env(who: str) -> Union[int, None]:
     """
@@ -31,8 +48,159 @@ def loglevel_from_env(who: str) -> Union[int, None]:
 
 
 def get_logger(who: str, level=logging.INFO):
-    global stdout_handler
     log = logging.getLogger(who)
-    log.addHandler(stdout_handler)
+    log.addHandler(_handler)
     log.setLevel(loglevel_from_env(who) or level)
+    _loggers.add(who)
     return log
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with the
+    `STRUCTURED_FIELDS` given to the log call with `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record),
+                 'logger': record.name,
+                 'pid': record.process,
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most `burst` records of each logger and message
+    template every `interval` seconds. The next record let through tells how
+    many were suppressed. A `burst` of 0 lets everything through."""
+
+    def __init__(self, burst: int = 0, interval: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._clock = clock
+        # (logger, template) to [window start, records in window, suppressed]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if len(self._windows) > 10000:
+                    self._expire(now)
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _expire(self, now: float):
+        for key in [k for k, w in self._windows.items()
+                    if now - w[0] >= self.interval]:
+            del self._windows[key]
+
+
+class SuppressedFormatter(logging.Formatter):
+    """Text formatter telling how many similar records were suppressed."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            text += f' [{suppressed} similar messages suppressed]'
+        return text
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Puts records on a bounded queue without blocking, dropping them when
+    the queue is full. Only the message is rendered on the calling thread,
+    as its arguments may change afterwards; formatting and writing are done
+    by the writer thread."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = log_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(QueueListener):
+    """Writes the queued records from a background thread until stopped."""
+
+    def enqueue_sentinel(self):
+        # Waits for room in a full queue rather than failing.
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread:
+            super().stop()
+
+
+def setup_logging(config: LogConf) -> logging.Handler:
+    """Sets up the handler of all the loggers got with `get_logger`: text or
+    JSON format, sampling of repeated messages and, with `config.queue`,
+    writing from a background thread. Returns the new handler."""
+    global _handler, _listener
+    if config.format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = SuppressedFormatter(log_formatter._fmt)
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(formatter)
+    handler = writer
+    if config.queue:
+        handler = _NonBlockingQueueHandler(queue.Queue(config.queue_size))
+    handler.addFilter(SamplingFilter(config.sample_burst,
+                                     config.sample_interval))
+
+    if _listener:
+        _listener.stop()
+        _listener = None
+    if config.queue:
+        _listener = _QueueListener(handler.queue, writer)
+        _listener.start()
+    for name in _loggers:
+        log = logging.getLogger(name)
+        log.removeHandler(_handler)
+        log.addHandler(handler)
+    _handler = handler
+    return handler
+
+
+@atexit.register
+def _flush():
+    # Writes out the records still queued.
+    if _listener:
+        _listener.stop()
@@ -0,0 +1,236 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable, Union
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 120.0, 300.0, 600.0)
+
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in labels.items())
+    return '{' + pairs + '}'
+
+
+class _Metric:
+    """Base of the metrics. A metric with `labelnames` only holds its
+    children, one per combination of label values (see `labels()`)."""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str = '', labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self) -> '_Metric':
+        raise NotImplementedError
+
+    def _samples(self, labels: dict) -> list:
+        """Returns list of (name suffix, labels, value) of the metric."""
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels[x]) for x in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+        return child
+
+    def collect(self) -> list:
+        if not self.labelnames:
+            return self._samples({})
+        with self._lock:
+            children = sorted(self._children.items())
+        samples = []
+        for key, child in children:
+            samples.extend(child._samples(dict(zip(self.labelnames, key))))
+        return samples
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.collect():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} '
+                         f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    """Monotonically increasing value. With `fn`, the value is read from it
+    on collection instead (e.g. hits of a cache)."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str = '', labelnames=(),
+                 fn: Callable[[], float] = None):
+        super().__init__(name, help, labelnames)
+        self._value = 0.0
+        self._fn = fn
+
+    def _new_child(self):
+        return type(self)(self.name, self.help)
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        if self._fn is not None:
+            return self._fn()
+        with self._lock:
+            return self._value
+
+    def _samples(self, labels: dict) -> list:
+        return [('', labels, self.value)]
+
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+
+class Histogram(_Metric):
+    """Cumulative histogram of observed values (e.g. latencies in seconds)
+    over fixed upper-bound `buckets`."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str = '', buckets=DEFAULT_BUCKETS,
+                 labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def _new_child(self):
+        return type(self)(self.name, self.help, self.buckets[:-1])
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self, clock: Callable[[], float] = time.perf_counter):
+        """Observes the duration of the `with` block, even if it raises."""
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(clock() - start)
+
+    def quantile(self, q: float) -> float:
+        """Returns upper bound of the bucket holding the `q` quantile."""
+        with self._lock:
+            if not self.count:
+                return math.nan
+            rank = q * self.count
+            seen = 0
+            for bound, n in zip(self.buckets, self.counts):
+                seen += n
+                if seen >= rank:
+                    return bound
+        return math.inf
+
+    @property
+    def mean(self) -> float:
+        with self._lock:
+            return self.sum / self.count if self.count else math.nan
+
+    def _samples(self, labels: dict) -> list:
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            samples.append(('_bucket', dict(labels, le=_format_value(bound)),
+                            seen))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, count))
+        return samples
+
+
+class Registry:
+    """Named metrics of the agent, rendered in the Prometheus text format
+    on `/metrics`.
+
+    Registering a metric under a name that is already taken returns the
+    registered one, so that modules can declare their metrics at import
+    time. Metrics with `fn` replace the registered ones, as they are bound
+    to the objects they read from.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None or getattr(metric, '_fn', None) is not None:
+                self._metrics[metric.name] = metric
+                return metric
+        if type(existing) is not type(metric):
+            raise ValueError(f'Metric {metric.name} already registered as '
+                             f'{existing.type}')
+        return existing
+
+    def histogram(self, name: str, help: str = '', buckets=DEFAULT_BUCKETS,
+                  labelnames=()) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labelnames))
+
+    def counter(self, name: str, help: str = '', labelnames=(),
+                fn: Callable[[], float] = None) -> Counter:
+        return self.register(Counter(name, help, labelnames, fn))
+
+    def gauge(self, name: str, help: str = '', labelnames=(),
+              fn: Callable[[], float] = None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, fn))
+
+    def get(self, name: str) -> Union[_Metric, None]:
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = [self._metrics[k] for k in sorted(self._metrics)]
+        return ''.join(x.render() for x in metrics)
+
+    def handle_metrics(self, body: bytes) -> tuple:
+        return HTTPStatus.OK, CONTENT_TYPE, self.render().encode()
+
+
+# Metrics of the whole agent.
+REGISTRY = Registry()
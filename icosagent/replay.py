@@ -0,0 +1,376 @@
+import functools
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla, \
+    InfraService, Nuvla, resource_type_of, wrap_nuvla_calls
+from icosagent.deploymngr.simulated import LatencyFn, SimulatedNuvla
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.log import get_logger
+from icosagent.metrics import Histogram
+
+log = get_logger('replay')
+
+RECORD_VERSION = 1
+
+# Job attributes the agent changes itself, ignored when telling whether the
+# JM issued a job again.
+AGENT_KEYS = ('locker', 'state', 'updated_at', 'resource')
+
+
+def _job_digest(job: dict) -> str:
+    content = {k: v for k, v in job.items() if k not in AGENT_KEYS}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+class TrafficRecorder:
+    """Records the traffic of the agent to a gzipped file of JSON lines.
+
+    The jobs got from the JM are recorded when they are new or changed,
+    with their arrival time, and every Nuvla call with its duration. Times
+    are seconds since the start of the recording. Lines are flushed every
+    `flush_interval` seconds, so that the file is readable up to then should
+    the agent be killed.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._start = clock()
+        self._flushed = self._start
+        # Job ID to digest of its content.
+        self._seen: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._write({'version': RECORD_VERSION,
+                     'started': datetime.now(timezone.utc).isoformat()})
+        log.info('Recording JM and Nuvla traffic to %s', path)
+
+    def _write(self, entry: dict):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            if not self._file:
+                return
+            self._file.write(line)
+            now = self._clock()
+            if now - self._flushed >= self.flush_interval:
+                self._file.flush()
+                self._flushed = now
+
+    def _now(self) -> float:
+        return round(self._clock() - self._start, 4)
+
+    def jobs(self, jobs: List[dict]):
+        arrived = []
+        for job in jobs:
+            digest = _job_digest(job)
+            if self._seen.get(job['ID']) != digest:
+                self._seen[job['ID']] = digest
+                arrived.append(job)
+        if arrived:
+            self._write({'t': self._now(), 'jobs': arrived})
+
+    def nuvla_call(self, call: str, resource: str, seconds: float):
+        self._write({'t': self._now(),
+                     'nuvla': [call, resource, round(seconds, 6)]})
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def record_jm(jm: JobManagerProxy, recorder: TrafficRecorder):
+    """Records the jobs `jm` gets from the JM."""
+    func = jm.fetch_deployments
+
+    @functools.wraps(func)
+    def recorded():
+        jobs, modified = func()
+        if modified:
+            recorder.jobs(jobs)
+        return jobs, modified
+
+    jm.fetch_deployments = recorded
+
+
+def record_nuvla(nuvla: Nuvla, recorder: TrafficRecorder) -> Nuvla:
+    """Records the duration of the API calls of `nuvla` (see
+    `NUVLA_CALLS`)."""
+    def wrap(call, func):
+        def recorded(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.nuvla_call(
+                    call, resource_type_of(args[0]) if args else '',
+                    time.perf_counter() - start)
+        return recorded
+
+    return wrap_nuvla_calls(nuvla, wrap)
+
+
+class Recording:
+    """Traffic recorded by `TrafficRecorder`: the arrivals of jobs, as
+    (seconds since start, jobs), and the durations of the Nuvla calls by
+    call name and resource type."""
+
+    def __init__(self, arrivals: List[Tuple[float, List[dict]]] = None,
+                 timings: Dict[Tuple[str, str], List[float]] = None):
+        self.arrivals = arrivals or []
+        self.timings = timings or {}
+
+    @classmethod
+    def load(cls, path: str) -> 'Recording':
+        recording = cls()
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for n, line in enumerate(f, 1):
+                    try:
+                        recording._add(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        log.warning('Skipping bad line %s of %s', n, path)
+            except (EOFError, gzip.BadGzipFile):
+                # The agent was killed while recording.
+                log.warning('Recording %s is truncated', path)
+        recording.arrivals.sort(key=lambda x: x[0])
+        log.info('Loaded %s jobs and %s Nuvla calls from %s',
+                 sum(len(j) for _, j in recording.arrivals),
+                 sum(len(t) for t in recording.timings.values()), path)
+        return recording
+
+    def _add(self, entry: dict):
+        if 'jobs' in entry:
+            self.arrivals.append((entry['t'], entry['jobs']))
+        elif 'nuvla' in entry:
+            call, resource, seconds = entry['nuvla']
+            self.timings.setdefault((call, resource), []).append(seconds)
+
+    @property
+    def duration(self) -> float:
+        return self.arrivals[-1][0] if self.arrivals else 0.0
+
+    def latency(self, seed: int = 0) -> LatencyFn:
+        """Returns the latency of the simulated Nuvla calls, drawn from the
+        recorded durations of the same call on the same resource type, or
+        else of the same call."""
+        rand = random.Random(seed)
+        by_call = {}
+        for (call, _), durations in self.timings.items():
+            by_call.setdefault(call, []).extend(durations)
+        lock = threading.Lock()
+
+        def latency(call: str, resource: str) -> float:
+            durations = self.timings.get((call, resource)) or \
+                by_call.get(call)
+            if not durations:
+                return 0.0
+            with lock:
+                return rand.choice(durations)
+
+        return latency
+
+    def simulated_nuvla(self, seed: int = 0) -> SimulatedNuvla:
+        """Returns simulated Nuvla with the recorded latencies, and with
+        credentials for all the targets of the recorded jobs."""
+        nuvla = SimulatedNuvla(self.latency(seed))
+        targets = dict.fromkeys(
+            t['cluster_name'] for _, jobs in self.arrivals for j in jobs
+            for t in DeploymentManagerNuvla.nuvla_targets(j))
+        for target in targets:
+            if target.startswith(f'{InfraService.resource}/'):
+                nuvla.put(InfraService.resource,
+                          {'id': target, 'subtype': 'kubernetes'})
+                nuvla.put('credential', {'parent': target})
+            else:
+                nuvla.add_edge(target)
+        return nuvla
+
+
+class _StaticAuth:
+    # Stands in for `AuthManager`, the replayed JM takes any token.
+
+    def __init__(self, session: requests.Session):
+        self.session = session
+
+    def token(self) -> str:
+        return 'replay'
+
+    def invalidate(self, token: str):
+        pass
+
+
+class _JMAdapter(BaseAdapter):
+
+    def __init__(self, jm: 'ReplayJM'):
+        super().__init__()
+        self.jm = jm
+
+    def send(self, request, **kwargs) -> requests.Response:
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+        status, data, headers = self.jm.handle(
+            request.method, urlparse(request.url).path,
+            json.loads(body) if body else None, request.headers)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = json.dumps(data).encode() \
+            if data is not None else b''
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class ReplayJM:
+    """ICOS JM replaying the recorded arrivals of jobs, served in process
+    to an unchanged `JobManagerProxy` (see `proxy()`). Jobs are handed out
+    until locked by the agent, like on the JM, and the time each job took
+    from its arrival to its completion is kept."""
+
+    URL = 'http://replay-jm'
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.jobs: Dict[str, dict] = {}
+        self.arrived: Dict[str, float] = {}
+        self.finished: Dict[str, float] = {}
+        self.requests = 0
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def arrive(self, jobs: List[dict]):
+        now = self._clock()
+        with self._lock:
+            for job in jobs:
+                self.jobs[job['ID']] = dict(job, locker=False, state=1)
+                self.arrived[job['ID']] = now
+                self.finished.pop(job['ID'], None)
+            self._version += 1
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self.arrived) - len(self.finished)
+
+    def _update(self, state: dict):
+        job = self.jobs.get(state.get('ID'))
+        if job is None:
+            return
+        job.update(locker=state['locker'], state=state['state'])
+        if state['state'] in (JobManagerProxy.JOB_COMPLETED,
+                              JobManagerProxy.JOB_DEGRADED):
+            self.finished.setdefault(job['ID'], self._clock())
+        self._version += 1
+
+    def handle(self, method: str, path: str, body, headers) -> tuple:
+        jobs_path = f'/{JobManagerProxy.JOBS_URI}'
+        with self._lock:
+            self.requests += 1
+            if method == 'GET' and \
+                    path == f'/{JobManagerProxy.JOBS_URI_NUVLA}':
+                etag = f'"{self._version}"'
+                if headers.get('If-None-Match') == etag:
+                    return HTTPStatus.NOT_MODIFIED, None, {'ETag': etag}
+                return HTTPStatus.OK, [j for j in self.jobs.values()
+                                       if not j.get('locker')], \
+                    {'ETag': etag}
+            if method == 'GET' and path == jobs_path:
+                return HTTPStatus.OK, list(self.jobs.values()), {}
+            if method == 'PUT' and path == jobs_path:
+                for state in body:
+                    self._update(state)
+                return HTTPStatus.OK, {}, {}
+            if method == 'PUT' and path.startswith(f'{jobs_path}/'):
+                self._update(body)
+                return HTTPStatus.OK, {}, {}
+        return HTTPStatus.NOT_FOUND, {'message': path}, {}
+
+    def proxy(self, config) -> JobManagerProxy:
+        """Returns `JobManagerProxy` with `JobManagerConf` `config` talking
+        to this JM."""
+        session = requests.Session()
+        session.mount(self.URL, _JMAdapter(self))
+        config.url = self.URL
+        return JobManagerProxy(config, _StaticAuth(session), session)
+
+    def play(self, arrivals: List[Tuple[float, List[dict]]],
+             speed: float = 1.0) -> threading.Thread:
+        """Makes the jobs arrive in a background thread, `speed` times
+        faster than recorded."""
+        start = self._clock()
+
+        def run():
+            for t, jobs in arrivals:
+                delay = start + t / speed - self._clock()
+                if delay > 0:
+                    time.sleep(delay)
+                self.arrive(jobs)
+
+        thread = threading.Thread(target=run, daemon=True, name='replay')
+        thread.start()
+        return thread
+
+
+def _quantile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class ReplayReport:
+    """Outcome of a replay. `queue_wait` is the time job groups waited in
+    the work queue (see `WorkQueue`), as observed in
+    `dm_queue_wait_seconds`; its quantiles are bucket upper bounds."""
+
+    def __init__(self, jm: ReplayJM, nuvla: SimulatedNuvla, elapsed: float,
+                 queue_wait: Histogram = None):
+        self.queue_wait = queue_wait or Histogram('dm_queue_wait_seconds')
+        self.jobs = len(jm.arrived)
+        self.finished = len(jm.finished)
+        self.elapsed = elapsed
+        self.delays = [jm.finished[x] - jm.arrived[x] for x in jm.finished]
+        self.nuvla_calls = nuvla.total_calls()
+        self.jm_requests = jm.requests
+
+    @property
+    def jobs_per_sec(self) -> float:
+        return self.finished / self.elapsed if self.elapsed else 0.0
+
+    def calls_per_job(self, calls: int) -> float:
+        return calls / self.finished if self.finished else 0.0
+
+    def summary(self) -> str:
+        return '\n'.join((
+            f'{self.finished}/{self.jobs} jobs finished in '
+            f'{self.elapsed:.1f} sec, {self.jobs_per_sec:.2f} jobs/s',
+            f'arrival to completion: p50 {_quantile(self.delays, 0.5):.2f} '
+            f'sec, p99 {_quantile(self.delays, 0.99):.2f} sec, max '
+            f'{max(self.delays, default=0.0):.2f} sec',
+            f'work queue wait: p50 <= {self.queue_wait.quantile(0.5):.3f} '
+            f'sec, p99 <= {self.queue_wait.quantile(0.99):.3f} sec, mean '
+            f'{self.queue_wait.mean:.3f} sec',
+            f'calls per job: Nuvla '
+            f'{self.calls_per_job(self.nuvla_calls):.1f}, JM '
+            f'{self.calls_per_job(self.jm_requests):.1f}'))
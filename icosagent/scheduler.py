@@ -0,0 +1,61 @@
+import random
+import threading
+from http import HTTPStatus
+from typing import Callable
+
+from icosagent.config.config import SchedulerConf
+from icosagent.log import get_logger
+
+log = get_logger('scheduler')
+
+
+class PollScheduler:
+    """Decides how long to wait before the next JM poll.
+
+    Polls again right away while the previous cycle made progress, and
+    backs off exponentially, with jitter, from `min_interval` up to
+    `max_interval` while the JM is idle or failing. `trigger()` (e.g. from
+    the `/trigger` webhook) ends the current wait immediately.
+    """
+
+    BUSY = 'busy'
+    IDLE = 'idle'
+    ERROR = 'error'
+
+    TRIGGER_PATH = '/trigger'
+
+    def __init__(self, config: SchedulerConf = None,
+                 rand: Callable[[], float] = random.random):
+        self.config = config or SchedulerConf()
+        self._rand = rand
+        self._backoffs = 0
+        self._event = threading.Event()
+
+    def next_delay(self, outcome: str) -> float:
+        if outcome == self.BUSY:
+            self._backoffs = 0
+            return 0.0
+        delay = min(self.config.min_interval *
+                    self.config.backoff_factor ** self._backoffs,
+                    self.config.max_interval)
+        if delay < self.config.max_interval:
+            self._backoffs += 1
+        jitter = self.config.jitter * (2 * self._rand() - 1)
+        return max(0.0, delay * (1 + jitter))
+
+    def trigger(self):
+        self._event.set()
+
+    def wait(self, outcome: str) -> float:
+        """Waits before the next poll. Returns the planned delay."""
+        delay = self.next_delay(outcome)
+        if delay:
+            log.info('Sleeping %.1f sec...', delay)
+        if self._event.wait(delay):
+            log.info('Poll triggered.')
+        self._event.clear()
+        return delay
+
+    def handle_trigger(self, body: bytes) -> tuple:
+        self.trigger()
+        return HTTPStatus.ACCEPTED, 'text/plain', b'triggered\n'
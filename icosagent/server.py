@@ -0,0 +1,84 @@
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Tuple
+
+from icosagent.config.config import ServerConf
+from icosagent.log import get_logger
+
+log = get_logger('server')
+
+# Handler gets the request body and returns tuple of HTTP status, content
+# type and the response body.
+Handler = Callable[[bytes], Tuple[int, str, bytes]]
+
+
+class AgentServer:
+    """Minimal HTTP server for the agent's own endpoints (e.g. triggers,
+    metrics, health). Disabled when `ServerConf.port` is 0."""
+
+    def __init__(self, config: ServerConf):
+        self.config = config
+        self._routes = {}
+        self._httpd = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.port)
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1] if self._httpd else 0
+
+    def route(self, method: str, path: str, handler: Handler):
+        self._routes[(method, path)] = handler
+
+    def start(self):
+        if not self.enabled or self._httpd:
+            return
+        self._httpd = ThreadingHTTPServer(
+            (self.config.host, self.config.port), self._handler())
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True,
+                         name='agent-server').start()
+        log.info('Serving %s on %s:%s', sorted(p for _, p in self._routes),
+                 self.config.host, self.port)
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def _handler(self):
+        routes = self._routes
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def _serve(self):
+                handler = routes.get((self.command, self.path.split('?')[0]))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if handler is None:
+                    status, ctype, payload = \
+                        HTTPStatus.NOT_FOUND, 'text/plain', b'not found\n'
+                else:
+                    try:
+                        status, ctype, payload = handler(body)
+                    except Exception:
+                        log.exception('Failed serving %s', self.path)
+                        status, ctype, payload = \
+                            HTTPStatus.INTERNAL_SERVER_ERROR, 'text/plain', \
+                            b'error\n'
+                self.send_response(status)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _serve
+
+            def log_message(self, fmt, *args):
+                log.debug(fmt, *args)
+
+        return RequestHandler
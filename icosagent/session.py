@@ -0,0 +1,22 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+from icosagent.config.config import HttpConf
+
+
+class Session(requests.Session):
+    """`requests.Session` with a tuned connection pool and a default timeout
+    applied to every request that does not set one."""
+
+    def __init__(self, config: HttpConf = None):
+        super().__init__()
+        config = config or HttpConf()
+        self.timeout = (config.connect_timeout, config.read_timeout)
+        adapter = HTTPAdapter(pool_connections=config.pool_connections,
+                              pool_maxsize=config.pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
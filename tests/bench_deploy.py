@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Throughput of `DeploymentManagerNuvla.deploy` against stubbed Nuvla with
+injected per-call latency, for a range of launch worker counts.
+
+    cd tests && PYTHONPATH=.. python bench_deploy.py [latency_sec] [targets]
+"""
+
+import sys
+import time
+
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.log import get_logger
+from stubs import RecordingJM, StubNuvla, make_jobs
+
+WORKERS = (1, 2, 4, 8, 16, 32)
+
+
+def run(workers: int, latency: float, n_targets: int) -> tuple:
+    nuvla = StubNuvla(latency)
+    targets = [nuvla.add_edge() for _ in range(n_targets)]
+    jobs = make_jobs(groups=5, jobs_per_group=2, targets=targets,
+                     targets_per_group=n_targets // 5 or 1)
+    config = DeployConf()
+    config.launch_workers = workers
+    dm = DeploymentManagerNuvla(nuvla, config)
+    start = time.perf_counter()
+    try:
+        deployed = dm.deploy(jobs, RecordingJM())
+    finally:
+        dm.close()
+    return len(deployed), time.perf_counter() - start, nuvla.total_calls()
+
+
+def main():
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.005
+    n_targets = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    get_logger('dm-nuvla').setLevel('WARNING')
+    print(f'Nuvla latency {latency * 1000:.1f} ms, {n_targets} targets')
+    print(f'{"workers":>8} {"launches":>9} {"sec":>8} {"launch/s":>9} '
+          f'{"speedup":>8} {"calls":>6}')
+    base = None
+    for workers in WORKERS:
+        launched, elapsed, calls = run(workers, latency, n_targets)
+        base = base or elapsed
+        print(f'{workers:>8} {launched:>9} {elapsed:>8.3f} '
+              f'{launched / elapsed:>9.1f} {base / elapsed:>8.2f} {calls:>6}')
+
+
+if __name__ == '__main__':
+    main()
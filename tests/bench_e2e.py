@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""End-to-end load test of the Deployment Manager cycle of `dm.py` against
+local Keycloak, ICOS JM and Nuvla stand-ins served over HTTP, with injected
+latency and errors. Reports jobs/s, p50/p99 time from job creation to its
+completion on the JM, and HTTP calls per job.
+
+    cd tests && PYTHONPATH=.. python bench_e2e.py [jobs] [groups] [targets] \\
+        [latency_sec] [error_rate] [workers]
+"""
+
+import logging
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+from nuvla.api import Api
+
+import dm as dm_main
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.jobmngr.sync import JobSync
+from fake_servers import FakeICOS, FakeNuvla
+from stubs import make_jobs
+from test_jm import new_jm
+
+
+class Result:
+
+    def __init__(self, jobs: int, elapsed: float, cycles: int,
+                 job_to_launch: list, http_calls: int):
+        self.jobs = jobs
+        self.elapsed = elapsed
+        self.cycles = cycles
+        self.job_to_launch = job_to_launch
+        self.http_calls = http_calls
+
+    @property
+    def completed(self) -> int:
+        return len(self.job_to_launch)
+
+    @property
+    def jobs_per_sec(self) -> float:
+        return self.completed / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def calls_per_job(self) -> float:
+        return self.http_calls / self.jobs if self.jobs else 0.0
+
+    def quantile(self, q: float) -> float:
+        if len(self.job_to_launch) < 2:
+            return self.job_to_launch[0] if self.job_to_launch else 0.0
+        return statistics.quantiles(self.job_to_launch, n=100,
+                                    method='inclusive')[round(q * 100) - 1]
+
+
+def run(jobs: int = 100, groups: int = 20, targets: int = 10,
+        latency: float = 0.0, error_rate: float = 0.0, workers: int = 8,
+        seed: int = 0, max_cycles: int = 50) -> Result:
+    """Deploys `jobs` jobs in `groups` groups spread over `targets`
+    NuvlaEdges, cycling until all of them are completed on the JM or
+    `max_cycles` cycles ran. Errors are injected only after the setup."""
+    nuvla_fake = FakeNuvla(latency=latency, seed=seed)
+    edges = [nuvla_fake.stub.add_edge() for _ in range(targets)]
+    created_at = datetime.now(timezone.utc).isoformat()
+    test_jobs = [dict(j, created_at=created_at) for j in
+                 make_jobs(groups, max(1, jobs // groups), edges,
+                           targets_per_group=min(2, targets))]
+    with FakeICOS(test_jobs, latency=latency, seed=seed) as icos, nuvla_fake:
+        nuvla = Api(endpoint=nuvla_fake.url, persist_cookie=False)
+        nuvla.login_apikey('key', 'secret')
+        config = DeployConf()
+        config.launch_workers = workers
+        # Injected errors would otherwise open the circuits of the targets
+        # for longer than the run.
+        config.breaker_failures = 0
+        dm = DeploymentManagerNuvla(nuvla, config)
+        sync = JobSync(new_jm(icos))
+        icos.error_rate = nuvla_fake.error_rate = error_rate
+        icos.requests.clear()
+        nuvla_fake.requests.clear()
+
+        job_to_launch = []
+        done = set()
+        start = time.perf_counter()
+        cycles = 0
+        try:
+            while len(done) < len(test_jobs) and cycles < max_cycles:
+                dm_main.cycle(sync, dm)
+                cycles += 1
+                now = time.time()
+                with icos.lock:
+                    completed = [j for j in icos.jobs.values() if j.get(
+                        'state') == JobManagerProxy.JOB_COMPLETED and
+                                 j['ID'] not in done]
+                for job in completed:
+                    done.add(job['ID'])
+                    job_to_launch.append(
+                        now - JobManagerProxy.job_created_at(job))
+        finally:
+            dm.close()
+        elapsed = time.perf_counter() - start
+        return Result(len(test_jobs), elapsed, cycles, job_to_launch,
+                      len(icos.requests) + len(nuvla_fake.requests))
+
+
+def main():
+    args = [t(a) for t, a in zip((int, int, int, float, float, int),
+                                 sys.argv[1:])]
+    logging.disable(logging.CRITICAL)
+    result = run(*args)
+    print(f'{result.completed}/{result.jobs} jobs in {result.cycles} cycles, '
+          f'{result.elapsed:.3f} sec')
+    print(f'{"jobs/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"calls/job":>10}')
+    print(f'{result.jobs_per_sec:>8.1f} {result.quantile(0.5) * 1000:>8.1f} '
+          f'{result.quantile(0.99) * 1000:>8.1f} '
+          f'{result.calls_per_job:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
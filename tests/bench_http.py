@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Per-call latency of `JobManagerProxy` job state updates against a local
+JM stand-in, with a new connection per call (module-level `requests`
+functions, as before) and with the pooled keep-alive `Session`.
+
+    cd tests && PYTHONPATH=.. python bench_http.py [calls]
+"""
+
+import statistics
+import sys
+import time
+
+import requests
+
+from icosagent.authmngr.authmngr import AuthManager
+from icosagent.config.config import JobManagerConf, KeycloakConf
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.log import get_logger
+from icosagent.session import Session
+from fake_servers import FakeICOS
+from stubs import make_jobs
+
+
+class NoPoolSession:
+    """Sends every request on a new connection."""
+
+    request = staticmethod(requests.request)
+    post = staticmethod(requests.post)
+
+
+def run(fake: FakeICOS, session, calls: int) -> list:
+    kc = KeycloakConf()
+    kc.url, kc.client_id, kc.client_secret = fake.token_url, 'dm', 'secret'
+    jm_conf = JobManagerConf()
+    jm_conf.url = fake.url
+    jm = JobManagerProxy(jm_conf, AuthManager(kc, session), session)
+    job_ids = list(fake.jobs)
+    jm.lock_job(job_ids[0])  # authenticate
+    timings = []
+    for i in range(calls):
+        start = time.perf_counter()
+        jm.lock_job(job_ids[i % len(job_ids)])
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    get_logger('job-manager').setLevel('WARNING')
+    get_logger('authmngr').setLevel('WARNING')
+    print(f'{calls} JM PUTs per mode')
+    print(f'{"mode":>10} {"mean ms":>8} {"p50 ms":>7} {"p99 ms":>7} '
+          f'{"conns":>6}')
+    for mode, session in (('no pool', NoPoolSession()),
+                          ('session', Session())):
+        with FakeICOS(make_jobs(10, 1, ['nuvlabox/a'])) as fake:
+            timings = sorted(run(fake, session, calls))
+            print(f'{mode:>10} {statistics.mean(timings) * 1000:>8.3f} '
+                  f'{timings[len(timings) // 2] * 1000:>7.3f} '
+                  f'{timings[int(len(timings) * 0.99)] * 1000:>7.3f} '
+                  f'{len(fake.connections):>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Measures the cost of recording launches in `LaunchJournal`, with and
+without fsync, and of replaying the journal on start.
+
+    cd tests && PYTHONPATH=.. python bench_journal.py [groups] [targets]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from icosagent.deploymngr.journal import LaunchJournal
+
+
+def record(path: str, groups: int, targets: int, fsync: bool) -> float:
+    journal = LaunchJournal(path, fsync=fsync, compact_after=groups + 1)
+    start = time.perf_counter()
+    for g in range(groups):
+        for t in range(targets):
+            journal.launched(f'group-{g}', f'nuvlabox/{t}', 'a' * 16,
+                             f'deployment/{g}-{t}')
+    elapsed = time.perf_counter() - start
+    journal.close()
+    return elapsed / (groups * targets)
+
+
+def main():
+    groups = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    targets = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'journal.jsonl')
+        synced = record(path, min(groups, 100), 1, fsync=True)
+        os.remove(path)
+        flushed = record(path, groups, targets, fsync=False)
+
+        start = time.perf_counter()
+        journal = LaunchJournal(path)
+        replay_sec = time.perf_counter() - start
+        assert len(journal) == groups
+        journal.close()
+
+    print(f'record (flush) {flushed * 1e6:>10.1f} us')
+    print(f'record (fsync) {synced * 1e6:>10.1f} us')
+    print(f'replay {groups * targets} entries {replay_sec * 1000:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Measures the logging overhead of a simulated deploy cycle on the calling
+thread, writing to a slow stdout, for the `[log]` settings: text or JSON,
+written synchronously or from the background thread, with and without
+sampling.
+
+    cd tests && PYTHONPATH=.. python bench_logging.py [cycles] [launches] \\
+        [write_latency_us]
+"""
+
+import sys
+import time
+
+from icosagent import log as icos_log
+from icosagent.config.config import LogConf
+from icosagent.log import get_logger, setup_logging
+
+
+class SlowStream:
+    """Stands in for a stdout piped to a slow log collector."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lines = 0
+
+    def write(self, text: str):
+        time.sleep(self.latency)
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+def cycle(log, launches: int, jobs: list):
+    log.info('Deploying %s deployments on Nuvla.', launches)
+    log.debug('Jobs: %s', jobs)
+    for i in range(launches):
+        log.info('Launched app on %s with: %s', f'nuvlabox/{i % 5}',
+                 f'deployment/{i}', extra={'group': f'group-{i}',
+                                           'target': f'nuvlabox/{i % 5}',
+                                           'deployment': f'deployment/{i}'})
+        log.warning('Skipping targets with open circuit: %s', ['nuvlabox/9'])
+
+
+def run(conf: LogConf, cycles: int, launches: int, latency: float) -> tuple:
+    stream = SlowStream(latency)
+    stdout = sys.stdout
+    sys.stdout = stream
+    try:
+        setup_logging(conf)
+        log = get_logger('bench-logging')
+        jobs = [{'id': f'job-{i}', 'manifest': 'x' * 1000}
+                for i in range(launches)]
+        start = time.perf_counter()
+        for _ in range(cycles):
+            cycle(log, launches, jobs)
+        elapsed = time.perf_counter() - start
+        dropped = getattr(icos_log._handler, 'dropped', 0)
+        setup_logging(LogConf())
+    finally:
+        sys.stdout = stdout
+    return elapsed / cycles, stream.lines, dropped
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    launches = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1e6
+
+    settings = []
+    for fmt, queue, burst in (('text', False, 0), ('json', False, 0),
+                              ('json', True, 0), ('json', True, 10)):
+        conf = LogConf()
+        conf.format = fmt
+        conf.queue = queue
+        conf.sample_burst = burst
+        settings.append((f'{fmt} queue={queue} burst={burst}', conf))
+
+    print(f'{"setting":<30} {"ms/cycle":>10} {"lines":>8} {"dropped":>8}')
+    for name, conf in settings:
+        per_cycle, lines, dropped = run(conf, cycles, launches, latency)
+        print(f'{name:<30} {per_cycle * 1000:>10.2f} {lines:>8} '
+              f'{dropped:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Compares `DeploymentManagerNuvla._merge_jobs` with its previous
+O(groups x jobs) implementation on synthetic JM responses and checks that
+both produce the same result.
+
+    cd tests && PYTHONPATH=.. python bench_merge.py [jobs] [jobs_per_group]
+"""
+
+import copy
+import sys
+import time
+
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from stubs import make_jobs
+
+
+def merge_jobs_quadratic(jobs: list) -> dict:
+    """Previous `_merge_jobs` implementation kept as the reference."""
+    group_ids = set()
+    for job in jobs:
+        group_ids.add(job.get('job_group_id'))
+
+    jobs_merged = {}
+    for gid in group_ids:
+        for job in jobs:
+            if job.get('job_group_id') == gid:
+                if gid not in jobs_merged:
+                    jobs_merged[gid] = {'IDs': {job['ID']},
+                                        'job': job}
+                    del jobs_merged[gid]['job']['ID']
+                elif job['ID'] not in jobs_merged[gid]['IDs']:
+                    jobs_merged[gid]['IDs'].add(job['ID'])
+                    jobs_merged[gid]['job']['manifest'] += \
+                        DeploymentManagerNuvla.MANIFEST_SEPARATOR + \
+                        job['manifest']
+    return jobs_merged
+
+
+def timed(func, jobs) -> tuple:
+    start = time.perf_counter()
+    result = func(jobs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_group = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    targets = [f'nuvlabox/{i}' for i in range(10)]
+    jobs = make_jobs(n_jobs // per_group, per_group, targets,
+                     targets_per_group=2)
+
+    new, new_sec = timed(DeploymentManagerNuvla._merge_jobs, iter(jobs))
+    old, old_sec = timed(merge_jobs_quadratic, copy.deepcopy(jobs))
+
+    assert new == old, 'merge results differ'
+    print(f'{len(jobs)} jobs in {len(new)} groups: equal results')
+    print(f'{"previous":>10} {old_sec * 1000:>10.1f} ms')
+    print(f'{"streaming":>10} {new_sec * 1000:>10.1f} ms '
+          f'({old_sec / new_sec:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Latency of small job groups under a mixed workload: groups with one
+target keep arriving while groups fanning out to all the targets arrive
+every second. Each cycle deploys what the work queue hands out, against
+stubbed Nuvla with injected per-call latency. Compares deploying all the
+arrived groups in each cycle with `WorkQueue` launch budgets and
+priorities.
+
+    cd tests && PYTHONPATH=.. python bench_queue.py [duration_sec] \\
+        [targets] [latency_sec] [workers]
+"""
+
+import logging
+import statistics
+import sys
+import time
+
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.jobmngr.workqueue import WorkQueue
+from stubs import RecordingJM, StubNuvla, make_jobs
+
+SMALL_EVERY = 0.05
+BIG_EVERY = 1.0
+
+
+def workload(duration: float, targets: list, urgent: bool) -> list:
+    """Returns the arrivals as (offset in seconds, jobs of one group)."""
+    arrivals = []
+    for n in range(int(duration / SMALL_EVERY)):
+        jobs = make_jobs(1, 1, [targets[n % len(targets)]])
+        for job in jobs:
+            job.update(job_group_id=f'small-{n}', ID=f'small-{n}-job')
+            if urgent:
+                job['priority'] = 1
+        arrivals.append((n * SMALL_EVERY, jobs))
+    for n in range(int(duration / BIG_EVERY)):
+        jobs = make_jobs(1, 1, targets)
+        for job in jobs:
+            job.update(job_group_id=f'big-{n}', ID=f'big-{n}-job')
+        arrivals.append((n * BIG_EVERY, jobs))
+    return sorted(arrivals, key=lambda x: x[0])
+
+
+def run(duration: float, n_targets: int, latency: float, workers: int,
+        max_launches: int, urgent: bool) -> dict:
+    nuvla = StubNuvla(latency)
+    targets = [nuvla.add_edge() for _ in range(n_targets)]
+    config = DeployConf()
+    config.launch_workers = workers
+    config.update_deployments = False
+    dm = DeploymentManagerNuvla(nuvla, config)
+    queue = WorkQueue(max_launches=max_launches)
+    arrivals = workload(duration, targets, urgent)
+    arrived_at = {}
+    latencies = {'small': [], 'big': []}
+    start = time.perf_counter()
+    try:
+        while arrivals or len(queue):
+            now = time.perf_counter() - start
+            while arrivals and arrivals[0][0] <= now:
+                _, jobs = arrivals.pop(0)
+                arrived_at[jobs[0]['job_group_id']] = now
+                queue.put(jobs)
+            jobs = queue.take()
+            if not jobs:
+                time.sleep(max(0.0, arrivals[0][0] - now))
+                continue
+            dm.deploy(jobs, RecordingJM())
+            done = time.perf_counter() - start
+            for gid in dict.fromkeys(j['job_group_id'] for j in jobs):
+                latencies[gid.split('-')[0]].append(done - arrived_at[gid])
+    finally:
+        dm.close()
+    return latencies
+
+
+def quantile(values: list, q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[int(q * 100) - 1]
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+    n_targets = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.002
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    logging.disable(logging.CRITICAL)
+    print(f'{duration} sec, {n_targets} targets, Nuvla latency '
+          f'{latency * 1000:.1f} ms, {workers} workers')
+    print(f'{"mode":<26} {"small p50":>10} {"small p99":>10} '
+          f'{"big p50":>10} (ms)')
+    for name, max_launches, urgent in (
+            ('all arrived per cycle', 0, False),
+            ('budget 20 launches', 20, False),
+            ('budget 20, small urgent', 20, True)):
+        latencies = run(duration, n_targets, latency, workers, max_launches,
+                        urgent)
+        small, big = latencies['small'], latencies['big']
+        print(f'{name:<26} {quantile(small, 0.5) * 1000:>10.1f} '
+              f'{quantile(small, 0.99) * 1000:>10.1f} '
+              f'{quantile(big, 0.5) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""Local HTTP stand-ins for the ICOS services and Nuvla the agent talks to,
+served by `http.server` from a background thread."""
+
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+from nuvla.api import NuvlaError
+from nuvla.api.models import CimiResource
+
+from stubs import StubNuvla
+
+TOKEN_PATH = '/token'
+JOBS_PATH = '/jobmanager/jobs'
+NUVLA_JOBS_PATH = f'{JOBS_PATH}/executable/orchestrator/nuvla'
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out close the connection before the response.
+        pass
+
+
+class FakeServer:
+    """Base of the stand-ins. `latency` seconds are slept before every
+    response, and a `error_rate` fraction of the requests, picked by a
+    random generator seeded with `seed`, fails with 503."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.server = _Server(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        args=(0.05,), daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method: str, path_re: str = '.*') -> int:
+        with self.lock:
+            return sum(1 for m, p in self.requests
+                       if m == method and re.fullmatch(path_re, p))
+
+    def _inject_error(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self._random.random() < self.error_rate
+
+    def handle(self, method: str, path: str, query: str, body: bytes,
+               headers) -> tuple:
+        """Returns tuple of HTTP status, JSON serialisable response and
+        dictionary of extra response headers."""
+        raise NotImplementedError
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                path, _, query = self.path.partition('?')
+                with fake.lock:
+                    fake.requests.append((self.command, path))
+                    fake.connections.add(self.client_address)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake._inject_error():
+                    status, data, headers = HTTPStatus.SERVICE_UNAVAILABLE, \
+                        {'message': 'injected error'}, {}
+                else:
+                    status, data, headers = fake.handle(
+                        self.command, path, query, body, self.headers)
+                payload = json.dumps(data).encode()
+                if headers.get('ETag') and \
+                        self.headers.get('If-None-Match') == headers['ETag']:
+                    status, payload = HTTPStatus.NOT_MODIFIED, b''
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeICOS(FakeServer):
+    """Keycloak token endpoint and ICOS JM jobs API kept in memory.
+
+    JM requests with a token that was not issued, or was revoked, get 401.
+    With `etags`, the list of jobs is served with an ETag and 304 when it
+    did not change."""
+
+    def __init__(self, jobs: list = None, latency=0.0, token_ttl=300,
+                 etags=False, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.jobs = {j['ID']: dict(j) for j in jobs or []}
+        self.token_ttl = token_ttl
+        self.etags = etags
+        self.tokens = set()
+        self.grants = []
+        self._token_seq = itertools.count()
+
+    @property
+    def token_url(self) -> str:
+        return self.url + TOKEN_PATH
+
+    def revoke_tokens(self):
+        with self.lock:
+            self.tokens.clear()
+
+    def _issue_token(self, body: bytes) -> tuple:
+        form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        with self.lock:
+            self.grants.append(form.get('grant_type'))
+            n = next(self._token_seq)
+            token = f'token-{n}'
+            self.tokens.add(token)
+        return HTTPStatus.OK, {'access_token': token,
+                               'expires_in': self.token_ttl,
+                               'refresh_token': f'refresh-{n}',
+                               'refresh_expires_in': self.token_ttl * 6}
+
+    def _jobs_to_launch(self) -> tuple:
+        with self.lock:
+            jobs = [j for j in self.jobs.values() if not j.get('locker')]
+        headers = {}
+        if self.etags:
+            digest = hashlib.sha1(json.dumps(jobs).encode()).hexdigest()
+            headers['ETag'] = f'"{digest}"'
+        return HTTPStatus.OK, jobs, headers
+
+    def handle(self, method: str, path: str, query: str, body: bytes,
+               headers) -> tuple:
+        if method == 'POST' and path == TOKEN_PATH:
+            return self._issue_token(body) + ({},)
+        token = headers.get('Authorization', '').replace('Bearer ', '')
+        with self.lock:
+            if token not in self.tokens:
+                return HTTPStatus.UNAUTHORIZED, {'error': 'unauthorized'}, {}
+        if method == 'PUT' and path == JOBS_PATH:
+            with self.lock:
+                for state in json.loads(body):
+                    if state['ID'] in self.jobs:
+                        self.jobs[state['ID']].update(state)
+            return HTTPStatus.OK, {'updated': len(json.loads(body))}, {}
+        if method == 'GET' and path == NUVLA_JOBS_PATH:
+            return self._jobs_to_launch()
+        if method == 'GET' and path == JOBS_PATH:
+            with self.lock:
+                return HTTPStatus.OK, list(self.jobs.values()), {}
+        if path.startswith(JOBS_PATH + '/'):
+            job_id = path[len(JOBS_PATH) + 1:]
+            with self.lock:
+                if job_id not in self.jobs:
+                    return HTTPStatus.NOT_FOUND, {'error': 'not found'}, {}
+                if method == 'PUT':
+                    self.jobs[job_id].update(json.loads(body))
+                    return HTTPStatus.OK, self.jobs[job_id], {}
+                if method == 'DELETE':
+                    return HTTPStatus.OK, self.jobs.pop(job_id), {}
+        return HTTPStatus.NOT_FOUND, {'error': f'{method} {path}'}, {}
+
+
+class FakeNuvla(FakeServer):
+    """Nuvla REST API, as used through `nuvla.api.Api`, on top of the
+    resources of a `StubNuvla` (see `stub`).
+
+    Supports the cloud entry point, session login, and search, add, get,
+    edit, delete and operations of resources. With `sessions`, requests
+    without the cookie of a live session get 401 (see `expire_sessions`)."""
+
+    API = '/api/'
+    COLLECTIONS = ('credential', 'deployment', 'deployment-parameter',
+                   'infrastructure-service', 'infrastructure-service-group',
+                   'module', 'nuvlabox', 'session', 'user')
+
+    COOKIE = 'com.sixsq.nuvla.cookie'
+
+    def __init__(self, stub: StubNuvla = None, latency=0.0, error_rate=0.0,
+                 seed=0, sessions=False):
+        super().__init__(latency, error_rate, seed)
+        self.stub = stub or StubNuvla()
+        self.sessions = sessions
+        self.live_sessions = set()
+        self._session_seq = itertools.count()
+
+    def expire_sessions(self):
+        with self.lock:
+            self.live_sessions.clear()
+
+    def _login(self) -> tuple:
+        with self.lock:
+            session = f'{next(self._session_seq)}-{uuid.uuid4()}'
+            self.live_sessions.add(session)
+        return HTTPStatus.CREATED, {'status': 201,
+                                    'resource-id': f'session/{session}'}, \
+            {'Set-Cookie': f'{self.COOKIE}={session}; Path=/'}
+
+    def _has_session(self, headers) -> bool:
+        cookies = dict(c.strip().split('=', 1) for c in
+                       headers.get('Cookie', '').split(';') if '=' in c)
+        with self.lock:
+            return cookies.get(self.COOKIE) in self.live_sessions
+
+    def _with_operations(self, data: dict) -> dict:
+        rid = data['id']
+        rels = ['edit', 'delete'] + [op['rel'] for op in
+                                     data.get('operations', [])]
+        operations = [{'rel': rel, 'href': rid if rel in ('edit', 'delete')
+                       else f'{rid}/{rel}'} for rel in dict.fromkeys(rels)]
+        return dict(data, operations=operations)
+
+    def _search(self, resource_type: str, body: bytes) -> tuple:
+        params = {k: ','.join(v) for k, v in parse_qs(body.decode()).items()}
+        for key in ('first', 'last'):
+            if key in params:
+                params[key] = int(params[key])
+        found = self.stub.search(resource_type, **params).data
+        found['operations'] = [{'rel': 'add', 'href': resource_type}]
+        return HTTPStatus.OK, found, {}
+
+    def _call(self, method: str, uri: str, query: str, body: bytes) -> tuple:
+        parts = uri.split('/')
+        if method == 'GET' and uri == 'cloud-entry-point':
+            return HTTPStatus.OK, {
+                'id': 'cloud-entry-point', 'base-uri': self.url + self.API,
+                'collections': {c: {'href': c} for c in self.COLLECTIONS}}, {}
+        if method == 'POST' and uri == 'session':
+            return self._login()
+        if len(parts) == 1:
+            if method == 'PUT':
+                return self._search(uri, body)
+            if method == 'POST':
+                resp = self.stub.add(uri, json.loads(body))
+                return HTTPStatus.CREATED, resp.data, {}
+        elif len(parts) == 2:
+            if method == 'GET':
+                params = {k: ','.join(v) for k, v in parse_qs(query).items()}
+                data = self.stub.get(uri, **params).data
+                return HTTPStatus.OK, self._with_operations(data), {}
+            if method == 'PUT':
+                data = self.stub.edit(uri, json.loads(body)).data
+                return HTTPStatus.OK, self._with_operations(data), {}
+            if method == 'DELETE':
+                return HTTPStatus.OK, self.stub.delete(uri).data, {}
+        elif len(parts) == 3 and method == 'POST':
+            rid = '/'.join(parts[:2])
+            resp = self.stub.operation(CimiResource({'id': rid}), parts[2],
+                                       json.loads(body) if body else None)
+            return HTTPStatus.ACCEPTED, resp.data, {}
+        return HTTPStatus.NOT_FOUND, {'message': f'{method} {uri}'}, {}
+
+    def handle(self, method: str, path: str, query: str, body: bytes,
+               headers) -> tuple:
+        if not path.startswith(self.API):
+            return HTTPStatus.NOT_FOUND, {'message': path}, {}
+        if self.sessions and path not in (self.API + 'cloud-entry-point',
+                                          self.API + 'session') and \
+                not self._has_session(headers):
+            return HTTPStatus.UNAUTHORIZED, {'message': 'no session'}, {}
+        try:
+            return self._call(method, path[len(self.API):], query, body)
+        except NuvlaError as ex:
+            status = ex.response.status_code \
+                if isinstance(ex.response, requests.Response) \
+                else HTTPStatus.CONFLICT if 'already exist' in str(ex) \
+                else HTTPStatus.NOT_FOUND
+            return status, {'message': str(ex)}, {}
@@ -0,0 +1,84 @@
+"""In-process stand-ins for Nuvla and the ICOS JM used by the tests and the
+benchmarks."""
+
+import threading
+
+from icosagent.deploymngr.simulated import SimulatedNuvla
+from icosagent.jobmngr.jm import JobTransitions
+
+# Nuvla simulated in memory, shipped with the agent for the replay mode.
+StubNuvla = SimulatedNuvla
+
+
+class NestingNuvla(StubNuvla):
+    """Calls the API from within `add` and `edit` as `nuvla.api.Api`
+    does."""
+
+    def add(self, resource_type, data):
+        self.search(resource_type, last=0)
+        return super().add(resource_type, data)
+
+    def edit(self, resource_id, data, **kwargs):
+        self.get(resource_id)
+        return super().edit(resource_id, data, **kwargs)
+
+
+class RecordingJM:
+    """Stands in for `JobManagerProxy` and records the job state
+    transitions."""
+
+    def __init__(self, workers=1, jobs: list = None):
+        self.workers = workers
+        self.jobs = jobs or []
+        self.sent = []
+        self.lock_fields = {}
+        self.fail_on = set()
+        self._lock = threading.Lock()
+
+    def _record(self, action: str, job_id: str) -> bool:
+        with self._lock:
+            self.sent.append((action, job_id))
+        return job_id not in self.fail_on
+
+    def lock_job(self, job_id, **fields):
+        self.lock_fields = fields
+        return self._record('lock', job_id)
+
+    def mark_job_as_completed(self, job_id):
+        return self._record('complete', job_id)
+
+    def mark_job_as_degraded(self, job_id):
+        return self._record('degrade', job_id)
+
+    def unlock_job(self, job_id):
+        return self._record('unlock', job_id)
+
+    def fetch_jobs(self) -> list:
+        return list(self.jobs)
+
+    def transitions(self) -> JobTransitions:
+        return JobTransitions(self, self.workers)
+
+
+def make_jobs(groups: int, jobs_per_group: int, targets: list,
+              targets_per_group: int = None) -> list:
+    """Builds synthetic JM response with `groups` job groups, each with
+    `jobs_per_group` jobs deployed on `targets`."""
+    targets_per_group = targets_per_group or len(targets)
+    jobs = []
+    for g in range(groups):
+        gid = f'group-{g}'
+        group_targets = [targets[(g + i) % len(targets)]
+                         for i in range(targets_per_group)]
+        for j in range(jobs_per_group):
+            jobs.append({
+                'ID': f'{gid}-job-{j}',
+                'job_group_id': gid,
+                'job_group_name': f'app-{g}',
+                'orchestrator': 'nuvla',
+                'manifest': f'apiVersion: v1\nkind: Pod\nmetadata:\n'
+                            f'  name: pod-{g}-{j}\n',
+                'targets': [{'cluster_name': t, 'orchestrator': 'nuvla'}
+                            for t in group_targets],
+            })
+    return jobs
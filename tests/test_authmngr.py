@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+from icosagent.authmngr.authmngr import AuthManager
+from icosagent.config.config import KeycloakConf
+from fake_servers import FakeICOS
+from test_cache import FakeClock
+from test_jm import new_jm
+from stubs import make_jobs
+
+
+def new_auth_mngr(fake: FakeICOS, clock) -> AuthManager:
+    kc = KeycloakConf()
+    kc.url, kc.client_id, kc.client_secret = fake.token_url, 'dm', 'secret'
+    return AuthManager(kc, clock=clock)
+
+
+def wait_for(cond, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not cond() and time.monotonic() < end:
+        time.sleep(0.01)
+    return cond()
+
+
+class TestAuthManager(unittest.TestCase):
+
+    def test_token_cached_until_refresh_margin(self):
+        clock = FakeClock()
+        with FakeICOS(token_ttl=300) as fake:
+            am = new_auth_mngr(fake, clock)
+            token = am.token()
+            clock.now = 200
+            assert am.token() == token
+            assert fake.grants == ['client_credentials']
+
+            # Within the margin: current token served, refreshed in background.
+            clock.now = 280
+            assert am.token() == token
+            assert wait_for(lambda: fake.grants == ['client_credentials',
+                                                    'refresh_token'])
+            assert wait_for(lambda: am.token() != token)
+
+    def test_expired_token_refreshed_once(self):
+        clock = FakeClock()
+        with FakeICOS(token_ttl=300, latency=0.05) as fake:
+            am = new_auth_mngr(fake, clock)
+            am.token()
+            clock.now = 301
+            threads = [threading.Thread(target=am.token) for _ in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert fake.grants == ['client_credentials', 'refresh_token']
+
+            # The refresh token expired as well.
+            clock.now = 10000
+            am.token()
+            assert fake.grants[-1] == 'client_credentials'
+
+    def test_jm_reauthenticates_on_rejected_token(self):
+        with FakeICOS(make_jobs(1, 1, ['nuvlabox/a'])) as fake:
+            jm = new_jm(fake)
+            assert len(jm.deployments_to_launch()) == 1
+            assert len(jm.deployments_to_launch()) == 1
+            assert fake.count('POST') == 1
+            fake.revoke_tokens()
+            assert len(jm.deployments_to_launch()) == 1
+            assert fake.count('POST') == 2
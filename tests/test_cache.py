@@ -0,0 +1,50 @@
+import unittest
+
+from icosagent.deploymngr.cache import TTLCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_miss_expiry(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=10, maxsize=10, clock=clock)
+        assert cache.get('a') is None
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        clock.now = 10
+        assert cache.get('a') is None
+        assert 'a' not in cache
+        assert {'hits': 1, 'misses': 2, 'size': 0} == cache.stats()
+
+    def test_lru_eviction(self):
+        cache = TTLCache(ttl=10, maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert len(cache) == 2
+
+    def test_invalidate(self):
+        cache = TTLCache(ttl=10, maxsize=10)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.invalidate('a')
+        assert 'a' not in cache and 'b' in cache
+        cache.invalidate()
+        assert len(cache) == 0
+
+    def test_disabled(self):
+        cache = TTLCache(ttl=0, maxsize=10)
+        cache.put('a', 1)
+        assert cache.get('a') is None
@@ -1,7 +1,13 @@
 import json
+import time
 import unittest
 
-from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla, \
+    infra_service_creds_by_ne_ids
+from icosagent.deploymngr.tracker import DeploymentTracker
+from stubs import RecordingJM, StubNuvla, make_jobs
+from test_cache import FakeClock
 
 
 class TestDMNuvla(unittest.TestCase):
@@ -41,3 +47,361 @@ class TestDMNuvla(unittest.TestCase):
         assert 'ID' not in merged[gid]['job']
         assert 'kind: Pod' in merged[gid]['job']['manifest']
         assert 'kind: Service' in merged[gid]['job']['manifest']
+
+    def test_merge_jobs_single_pass(self):
+        jobs = [{'ID': 'a', 'job_group_id': '1', 'manifest': 'a'},
+                {'ID': 'x', 'job_group_id': '2', 'manifest': 'x'},
+                {'ID': 'b', 'job_group_id': '1', 'manifest': 'b'},
+                {'ID': 'c', 'job_group_id': '1', 'manifest': 'c'}]
+        merged = DeploymentManagerNuvla._merge_jobs(iter(jobs))
+        sep = DeploymentManagerNuvla.MANIFEST_SEPARATOR
+        assert list(merged) == ['1', '2']
+        assert merged['1']['IDs'] == {'a', 'b', 'c'}
+        assert merged['1']['job']['manifest'] == sep.join('abc')
+        assert merged['2'] == {'IDs': {'x'}, 'job': {'job_group_id': '2', 'manifest': 'x'}}
+        # Source jobs are left untouched.
+        assert jobs[0] == {'ID': 'a', 'job_group_id': '1', 'manifest': 'a'}
+
+
+class TestDMNuvlaDeploy(unittest.TestCase):
+
+    def _deploy(self, workers: int, fail_on_target=None, lock_before_launch=False):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(3)]
+        if fail_on_target is not None:
+            flt = f'parent="{nuvla.search("infrastructure-service").resources[fail_on_target].id}"'
+            nuvla.fail_launch_on = {nuvla.search('credential', filter=flt).resources[0].id}
+        config = DeployConf()
+        config.launch_workers = workers
+        config.lock_before_launch = lock_before_launch
+        dm = DeploymentManagerNuvla(nuvla, config)
+        jm = RecordingJM(workers)
+        jobs = make_jobs(2, 2, targets)
+        try:
+            deployed = dm.deploy(jobs, jm)
+        finally:
+            dm.close()
+        expected = [(j['job_group_id'], t['cluster_name'])
+                    for j in jobs[::2] for t in j['targets']]
+        return expected, deployed, jm.sent
+
+    def _assert_group_order(self, sent: list, expected: list):
+        for gid in ('group-0', 'group-1'):
+            actions = [a for a, jid in sent if jid.startswith(gid)]
+            assert sorted(actions) == sorted(expected), actions
+            if 'lock' in expected:
+                assert actions[:2] == ['lock', 'lock']
+
+    def test_deploy_sequential_and_concurrent(self):
+        for workers in (1, 4):
+            expected, deployed, sent = self._deploy(workers)
+            assert sorted((d['job'], d['target']) for d in deployed) == sorted(expected)
+            assert all(d['deployment'].startswith('deployment/') for d in deployed)
+            # Lock and complete of the same job are merged.
+            self._assert_group_order(sent, ['complete', 'complete'])
+
+    def test_deploy_failed_target_unlocks_group(self):
+        for workers in (1, 4):
+            expected, deployed, sent = self._deploy(workers, fail_on_target=1)
+            assert len(deployed) == 4
+            assert len({t for _, t in expected} - {d['target'] for d in deployed}) == 1
+            # Lock and unlock cancel out.
+            assert sent == []
+
+    def test_deploy_lock_before_launch(self):
+        _, _, sent = self._deploy(4, lock_before_launch=True)
+        self._assert_group_order(sent, ['lock', 'lock', 'complete', 'complete'])
+        _, _, sent = self._deploy(4, fail_on_target=1, lock_before_launch=True)
+        self._assert_group_order(sent, ['lock', 'lock', 'unlock', 'unlock'])
+
+    def test_deploy_caches_credentials(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(3)]
+        config = DeployConf()
+        # Every cycle launches the groups again.
+        config.update_deployments = False
+        dm = DeploymentManagerNuvla(nuvla, config)
+        dm.deploy(make_jobs(2, 1, targets), RecordingJM())
+        dm.deploy(make_jobs(2, 1, targets), RecordingJM())
+        assert {'hits': 3, 'misses': 3, 'size': 3} == dm.creds_cache.stats()
+
+        flt = f'parent="{nuvla.search("infrastructure-service").resources[0].id}"'
+        nuvla.fail_launch_on = {nuvla.search('credential', filter=flt).resources[0].id}
+        nuvla.fail_launch_status = 404
+        dm.deploy(make_jobs(1, 1, targets), RecordingJM())
+        assert targets[0] not in dm.creds_cache
+        assert targets[1] in dm.creds_cache
+
+
+class TestCredsResolution(unittest.TestCase):
+
+    def test_creds_by_ne_ids(self):
+        nuvla = StubNuvla()
+        edges = [nuvla.add_edge(creds=2) for _ in range(20)]
+        no_creds = nuvla.add_edge(creds=0)
+        infra_service = nuvla.search('infrastructure-service').resources[0].id
+        targets = edges + [no_creds, 'nuvlabox/unknown', infra_service]
+        nuvla.calls.clear()
+
+        creds, failures = infra_service_creds_by_ne_ids(nuvla, targets)
+
+        assert nuvla.calls == {'search': 3}
+        assert set(creds) == set(edges) | {infra_service}
+        assert all(len(c) == 2 for c in creds.values())
+        assert creds[infra_service] == creds[edges[0]]
+        assert set(failures) == {no_creds, 'nuvlabox/unknown'}
+        assert failures['nuvlabox/unknown'] == 'NuvlaEdge not found'
+
+    def test_creds_for_targets_keeps_going_after_failure(self):
+        nuvla = StubNuvla()
+        edges = [nuvla.add_edge(), 'nuvlabox/unknown', nuvla.add_edge()]
+        dm = DeploymentManagerNuvla(nuvla)
+        target_to_cred, failures = dm.creds_for_targets(edges)
+        assert list(target_to_cred) == [edges[0], edges[2]]
+        assert list(failures) == ['nuvlabox/unknown']
+
+        # Only the failed target is looked up again.
+        nuvla.calls.clear()
+        dm.creds_for_targets(edges)
+        assert nuvla.calls == {'search': 1}
+        nuvla.calls.clear()
+        dm.creds_for_targets(edges[::2])
+        assert nuvla.calls == {}
+
+    def test_deploy_unlocks_group_with_unresolved_target(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge(), 'nuvlabox/unknown']
+        jm = RecordingJM()
+        deployed = DeploymentManagerNuvla(nuvla).deploy(make_jobs(1, 1, targets), jm)
+        assert [d['target'] for d in deployed] == targets[:1]
+        assert jm.sent == []
+
+
+class TestAppModules(unittest.TestCase):
+
+    def test_module_reused_across_targets_and_redeploys(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(3)]
+        config = DeployConf()
+        # Every cycle launches the groups again.
+        config.update_deployments = False
+        dm = DeploymentManagerNuvla(nuvla, config)
+        deployed = dm.deploy(make_jobs(1, 2, targets), RecordingJM())
+        assert len(deployed) == 3
+        assert len(nuvla.search('module').resources) == 1
+
+        nuvla.calls.clear()
+        dm.deploy(make_jobs(1, 2, targets), RecordingJM())
+        # One add per deployment launch, none for modules.
+        assert nuvla.calls['add'] == 3
+        assert len(nuvla.search('module').resources) == 1
+
+        # Manifests are normalised, so comments do not make a new app.
+        jobs = make_jobs(1, 2, targets)
+        jobs[0]['manifest'] += '# changed\n'
+        dm.deploy(jobs, RecordingJM())
+        assert len(nuvla.search('module').resources) == 1
+
+        jobs[0]['manifest'] += 'spec:\n  restartPolicy: Never\n'
+        dm.deploy(jobs, RecordingJM())
+        assert len(nuvla.search('module').resources) == 2
+
+    def test_load_modules_index(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        DeploymentManagerNuvla(nuvla).deploy(make_jobs(2, 1, targets), RecordingJM())
+        nuvla.put('module', {'parent-path': DeploymentManagerNuvla.PARENT_PATH,
+                             'path': f'{DeploymentManagerNuvla.PARENT_PATH}/app-1712345678'})
+
+        dm = DeploymentManagerNuvla(nuvla)
+        nuvla.calls.clear()
+        dm.load_modules_index()
+        assert nuvla.calls == {'search': 1}
+        assert len(dm._modules) == 2
+
+        nuvla.calls.clear()
+        dm.deploy(make_jobs(2, 1, targets), RecordingJM())
+        assert nuvla.calls['add'] == 2
+        assert len(nuvla.search('module').resources) == 3
+
+
+class TestDeploymentUpdates(unittest.TestCase):
+
+    @staticmethod
+    def _deployments(nuvla: StubNuvla) -> list:
+        return nuvla.search('deployment').resources
+
+    def test_unchanged_group_kept(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        dm = DeploymentManagerNuvla(nuvla)
+        first = dm.deploy(make_jobs(1, 1, targets), RecordingJM())
+
+        nuvla.calls.clear()
+        jm = RecordingJM()
+        again = dm.deploy(make_jobs(1, 1, targets), jm)
+        assert again == first
+        assert nuvla.calls == {'get': 1}
+        assert jm.sent == [('complete', 'group-0-job-0')]
+        assert len(self._deployments(nuvla)) == 1
+
+    def test_changed_group_updated(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        dm = DeploymentManagerNuvla(nuvla)
+        dpl_id = dm.deploy(make_jobs(1, 1, targets), RecordingJM())[0][
+            'deployment']
+
+        jobs = make_jobs(1, 1, targets)
+        jobs[0]['manifest'] += 'spec:\n  restartPolicy: Never\n'
+        nuvla.calls.clear()
+        deployed = dm.deploy(jobs, RecordingJM())
+        assert [d['deployment'] for d in deployed] == [dpl_id]
+        assert nuvla.calls['operation'] == 2
+        assert len(self._deployments(nuvla)) == 1
+        path = nuvla.resources[dpl_id]['module']['path']
+        assert path.endswith(dm.app_digest(jobs[0]['manifest'], 'app-0'))
+
+    def test_gone_deployment_launched_again(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        dm = DeploymentManagerNuvla(nuvla)
+        dpl_id = dm.deploy(make_jobs(1, 1, targets), RecordingJM())[0][
+            'deployment']
+        nuvla.resources[dpl_id]['state'] = 'STOPPED'
+
+        deployed = dm.deploy(make_jobs(1, 1, targets), RecordingJM())
+        assert deployed[0]['deployment'] != dpl_id
+        nuvla.delete(deployed[0]['deployment'])
+        deployed = dm.deploy(make_jobs(1, 1, targets), RecordingJM())
+        assert len(deployed) == 1
+        assert len(self._deployments(nuvla)) == 2
+
+    def test_busy_deployment_deferred(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        dm = DeploymentManagerNuvla(nuvla)
+        dpl_id = dm.deploy(make_jobs(1, 1, targets), RecordingJM())[0][
+            'deployment']
+        operations = nuvla.resources[dpl_id]['operations']
+        nuvla.resources[dpl_id].update(state='STARTING', operations=[])
+
+        jobs = make_jobs(1, 1, targets)
+        jobs[0]['manifest'] += 'spec:\n  restartPolicy: Never\n'
+        jm = RecordingJM()
+        assert dm.deploy(jobs, jm) == []
+        assert jm.sent == []
+        assert len(self._deployments(nuvla)) == 1
+        assert dm.breaker.allow(targets[0])
+
+        # Updated in a later cycle, once it can be.
+        nuvla.resources[dpl_id].update(state='STARTED', operations=operations)
+        deployed = dm.deploy(jobs, jm)
+        assert [d['deployment'] for d in deployed] == [dpl_id]
+        assert len(self._deployments(nuvla)) == 1
+
+    def test_index_loaded_from_tags(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge(), nuvla.add_edge()]
+        DeploymentManagerNuvla(nuvla).deploy(make_jobs(2, 1, targets),
+                                             RecordingJM())
+
+        dm = DeploymentManagerNuvla(nuvla)
+        nuvla.calls.clear()
+        dm.load_deployments_index()
+        assert nuvla.calls == {'search': 1}
+        assert len(dm._deployments) == 4
+
+        jobs = make_jobs(2, 1, targets)
+        jobs[0]['manifest'] += 'spec:\n  restartPolicy: Never\n'
+        nuvla.calls.clear()
+        dm.deploy(jobs, RecordingJM())
+        # Only the new module of the changed group.
+        assert nuvla.calls['add'] == 1
+        assert nuvla.calls['operation'] == 4
+
+
+class TestDeploymentTracker(unittest.TestCase):
+
+    def _launch(self, nuvla: StubNuvla, n: int) -> list:
+        dm = DeploymentManagerNuvla(nuvla)
+        cred = dm.creds_for_targets([nuvla.add_edge()])[0]
+        return [dm.launch('kind: Pod', 'app', list(cred.values())[0]) for _ in range(n)]
+
+    def test_poll_many_with_one_search(self):
+        nuvla = StubNuvla()
+        nuvla.started_state = 'STARTING'
+        dpl_ids = self._launch(nuvla, 5)
+        clock = FakeClock()
+        tracker = DeploymentTracker(nuvla, timeout=60, clock=clock)
+        final = {}
+        for dpl_id in dpl_ids:
+            tracker.watch(dpl_id, final.__setitem__)
+
+        nuvla.calls.clear()
+        assert tracker.poll() == 0
+        assert tracker.interval == 2
+        nuvla.resources[dpl_ids[0]]['state'] = 'STARTED'
+        nuvla.resources[dpl_ids[1]]['state'] = 'ERROR'
+        assert tracker.poll() == 2
+        assert tracker.interval == 1
+        assert nuvla.calls == {'search': 2}
+        assert final == {dpl_ids[0]: 'STARTED', dpl_ids[1]: 'ERROR'}
+
+        clock.now = 61
+        assert tracker.poll() == 3
+        assert final[dpl_ids[4]] == DeploymentTracker.TIMEOUT
+        assert len(tracker) == 0
+
+    def test_wait_in_final_state(self):
+        nuvla = StubNuvla()
+        dpl_id = self._launch(nuvla, 1)[0]
+        dm = DeploymentManagerNuvla(nuvla)
+        assert dm.wait_in_final_state(dpl_id) == 'STARTED'
+
+    def test_deploy_confirm_started(self):
+        nuvla = StubNuvla()
+        nuvla.started_state = 'STARTING'
+        targets = [nuvla.add_edge() for _ in range(2)]
+        config = DeployConf()
+        config.confirm_started = True
+        dm = DeploymentManagerNuvla(nuvla, config)
+        jm = RecordingJM()
+        deployed = dm.deploy(make_jobs(2, 1, targets), jm)
+        assert sorted(jm.sent) == [('lock', 'group-0-job-0'), ('lock', 'group-1-job-0')]
+        assert dm.completed_jobs == 2
+
+        by_group = {}
+        for d in deployed:
+            by_group.setdefault(d['job'], []).append(d['deployment'])
+        nuvla.resources[by_group['group-0'][0]]['state'] = 'STARTED'
+        dm.tracker.poll()
+        assert len(jm.sent) == 2
+        for dpl_id in by_group['group-0'][1:]:
+            nuvla.resources[dpl_id]['state'] = 'STARTED'
+        nuvla.resources[by_group['group-1'][0]]['state'] = 'ERROR'
+        dm.tracker.poll()
+        assert sorted(jm.sent[2:]) == [('complete', 'group-0-job-0'), ('degrade', 'group-1-job-0')]
+
+    def test_confirm_started_after_lock(self):
+        nuvla = StubNuvla(latency=0.02)
+        targets = [nuvla.add_edge() for _ in range(2)]
+        config = DeployConf()
+        config.confirm_started = True
+        config.launch_workers = 2
+        config.track_min_interval = 0.01
+        dm = DeploymentManagerNuvla(nuvla, config)
+        dm.tracker.start()
+        try:
+            jm = RecordingJM()
+            dm.deploy(make_jobs(4, 1, targets, 1), jm)
+            deadline = time.monotonic() + 5
+            while len(dm.tracker) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            dm.close()
+        # The running tracker completes the jobs only after they are locked.
+        for g in range(4):
+            job_id = f'group-{g}-job-0'
+            assert [a for a, x in jm.sent if x == job_id] == \
+                ['lock', 'complete']
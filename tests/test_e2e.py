@@ -0,0 +1,19 @@
+import unittest
+
+from bench_e2e import run
+
+
+class TestEndToEnd(unittest.TestCase):
+
+    def test_all_jobs_launched(self):
+        result = run(jobs=12, groups=4, targets=3, workers=4)
+        assert result.completed == 12
+        assert result.cycles == 1
+        # Polling, locking and completing on the JM plus a launch per target
+        # on Nuvla, amortised over the jobs of the group.
+        assert result.calls_per_job < 15
+
+    def test_completes_despite_errors(self):
+        result = run(jobs=12, groups=4, targets=3, error_rate=0.1, workers=4)
+        assert result.completed == 12
+        assert result.cycles > 1
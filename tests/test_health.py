@@ -0,0 +1,88 @@
+import unittest
+
+import dm as dm_main
+from icosagent.config.config import HealthConf, NuvlaConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla, nuvla_client
+from icosagent.health import Health
+from icosagent.jobmngr.sync import JobSync
+from icosagent.scheduler import PollScheduler
+from fake_servers import FakeICOS, FakeNuvla
+from stubs import StubNuvla, make_jobs
+from test_cache import FakeClock
+from test_jm import new_jm
+
+
+class TestHealth(unittest.TestCase):
+
+    def test_init_retries_with_backoff(self):
+        slept = []
+        config = HealthConf()
+        config.retry_max_interval = 3
+        health = Health(config, sleep=slept.append)
+        attempts = []
+
+        def login():
+            attempts.append(1)
+            if len(attempts) < 4:
+                raise ConnectionError('down')
+
+        health.init('nuvla', login).join(5)
+        assert slept == [1, 2, 3]
+        assert health.initialised('nuvla')
+        assert health.ready()
+        assert health.handle_ready(b'')[0] == 200
+
+    def test_not_ready_until_all_initialised(self):
+        health = Health()
+        health.init('keycloak', lambda: None).join(5)
+        health.init('nuvla', lambda: 1 / 0)
+        assert not health.wait('nuvla', 0.1)
+        status, _, body = health.handle_ready(b'')
+        assert status == 503
+        assert body == b'initialising: nuvla\n'
+        health.stop()
+
+    def test_liveness(self):
+        clock = FakeClock()
+        config = HealthConf()
+        config.liveness_timeout = 60
+        health = Health(config, clock=clock)
+        clock.now = 59
+        assert health.handle_live(b'')[0] == 200
+        clock.now = 60
+        assert health.handle_live(b'')[0] == 503
+        health.beat()
+        assert health.live()
+
+
+class TestNuvlaSession(unittest.TestCase):
+
+    def test_login_when_session_missing_or_expired(self):
+        with FakeNuvla(sessions=True) as fake:
+            fake.stub.add_edge()
+            config = NuvlaConf()
+            config.url = fake.url
+            nuvla = nuvla_client(config)
+            assert nuvla.search('nuvlabox').count == 1
+            assert fake.count('POST', '/api/session') == 1
+
+            nuvla.search('nuvlabox')
+            assert fake.count('POST', '/api/session') == 1
+            fake.expire_sessions()
+            assert nuvla.search('nuvlabox').count == 1
+            assert fake.count('POST', '/api/session') == 2
+
+    def test_cycle_deploys_later_when_nuvla_not_ready(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        with FakeICOS(make_jobs(2, 1, targets), etags=True) as fake:
+            sync = JobSync(new_jm(fake), resync_interval=600)
+            dm = DeploymentManagerNuvla(nuvla)
+            nuvla.calls.clear()
+            outcome = dm_main.cycle(sync, dm, lambda: False)
+            assert outcome == PollScheduler.ERROR
+            assert nuvla.calls == {}
+
+            # The jobs polled meanwhile are not lost.
+            assert dm_main.cycle(sync, dm, lambda: True) == PollScheduler.BUSY
+            assert all(j.get('locker') for j in fake.jobs.values())
@@ -0,0 +1,143 @@
+import time
+import unittest
+
+import requests
+
+from icosagent.authmngr.authmngr import AuthManager
+from icosagent.config.config import HttpConf, JobManagerConf, KeycloakConf
+from icosagent.jobmngr.jm import JobManagerProxy, JobTransitions
+from icosagent.jobmngr.sync import JobSync
+from icosagent.session import Session
+from fake_servers import FakeICOS
+from stubs import RecordingJM, make_jobs
+
+
+def new_jm(fake: FakeICOS, http: HttpConf = None,
+           bulk_uri: str = '') -> JobManagerProxy:
+    kc = KeycloakConf()
+    kc.url, kc.client_id, kc.client_secret = fake.token_url, 'dm', 'secret'
+    jm_conf = JobManagerConf()
+    jm_conf.url = fake.url
+    jm_conf.bulk_uri = bulk_uri
+    session = Session(http)
+    return JobManagerProxy(jm_conf, AuthManager(kc, session), session)
+
+
+class TestJobManagerProxy(unittest.TestCase):
+
+    def test_session_keeps_connection_alive(self):
+        with FakeICOS(make_jobs(2, 2, ['nuvlabox/a'])) as fake:
+            jm = new_jm(fake)
+            assert len(jm.deployments_to_launch()) == 4
+            for job_id in list(fake.jobs):
+                jm.lock_job(job_id)
+                jm.mark_job_as_completed(job_id)
+            assert fake.count('POST') == 1
+            assert fake.count('PUT') == 8
+            assert len(fake.connections) == 1
+            assert all(j['state'] == JobManagerProxy.JOB_COMPLETED
+                       for j in fake.jobs.values())
+
+    def test_timeout(self):
+        http = HttpConf()
+        http.read_timeout = 0.05
+        with FakeICOS(make_jobs(1, 1, ['nuvlabox/a'])) as fake:
+            jm = new_jm(fake, http)
+            jm.lock_job('group-0-job-0')
+            fake.latency = 0.5
+            start = time.monotonic()
+            with self.assertRaises(requests.exceptions.Timeout):
+                jm.deployments_to_launch()
+            assert time.monotonic() - start < 0.4
+
+    def test_fetch_with_etag(self):
+        with FakeICOS(make_jobs(2, 1, ['nuvlabox/a']), etags=True) as fake:
+            jm = new_jm(fake)
+            jobs, modified = jm.fetch_deployments()
+            assert len(jobs) == 2 and modified
+            assert jm.fetch_deployments() == (jobs, False)
+            jm.lock_job('group-0-job-0')
+            jobs, modified = jm.fetch_deployments()
+            assert [j['ID'] for j in jobs] == ['group-1-job-0'] and modified
+            # Locked jobs are still listed among all the jobs.
+            assert len(jm.fetch_jobs()) == 2
+
+    def test_job_created_at(self):
+        job = {'updated_at': '2024-04-03T18:55:23.761Z'}
+        assert JobManagerProxy.job_created_at(job) == 1712170523.761
+        job['created_at'] = '2024-04-03T18:55:20Z'
+        assert JobManagerProxy.job_created_at(job) == 1712170520
+        assert JobManagerProxy.job_created_at({'created_at': 'never'}) is None
+
+
+class TestJobSync(unittest.TestCase):
+
+    def test_changed(self):
+        now = [0.0]
+        with FakeICOS(make_jobs(3, 2, ['nuvlabox/a']), etags=True) as fake:
+            sync = JobSync(new_jm(fake), resync_interval=60,
+                           clock=lambda: now[0])
+            assert len(sync.changed()) == 6
+            assert sync.changed() == []
+            with fake.lock:
+                fake.jobs['group-1-job-1']['manifest'] = 'kind: Service\n'
+                fake.jobs['group-3-job-0'] = dict(
+                    make_jobs(4, 1, ['nuvlabox/a'])[3])
+            changed = sync.changed()
+            assert sorted(j['ID'] for j in changed) == \
+                ['group-1-job-0', 'group-1-job-1', 'group-3-job-0']
+            assert sync.changed() == []
+            now[0] = 60
+            assert len(sync.changed()) == 7
+            assert fake.count('GET') == 5
+
+    def test_full_without_resync_interval(self):
+        with FakeICOS(make_jobs(1, 2, ['nuvlabox/a'])) as fake:
+            sync = JobSync(new_jm(fake))
+            assert len(sync.changed()) == 2
+            assert len(sync.changed()) == 2
+
+
+class TestJobTransitions(unittest.TestCase):
+
+    def test_merge(self):
+        jm = RecordingJM()
+        transitions = JobTransitions(jm)
+        for job_id in 'abc':
+            transitions.lock(job_id)
+        transitions.complete('a')
+        transitions.unlock('b')
+        assert transitions.flush() == {'a': True, 'b': True, 'c': True}
+        assert sorted(jm.sent) == [('complete', 'a'), ('lock', 'c')]
+
+        # Locked job has to be unlocked; nothing to do for completed one.
+        transitions.unlock('c')
+        transitions.complete('a')
+        transitions.flush()
+        assert jm.sent[2:] == [('unlock', 'c')]
+        assert transitions.flush() == {}
+
+    def test_outcomes(self):
+        jm = RecordingJM(workers=4)
+        jm.fail_on = {'b'}
+        transitions = jm.transitions()
+        for job_id in 'abcd':
+            transitions.complete(job_id)
+        assert transitions.flush() == {'a': True, 'b': False, 'c': True, 'd': True}
+        transitions.complete('b')
+        transitions.complete('c')
+        transitions.flush()
+        assert jm.sent.count(('complete', 'b')) == 2
+        assert jm.sent.count(('complete', 'c')) == 1
+
+    def test_flush_on_jm(self):
+        for bulk_uri, puts in (('', 4), ('jobmanager/jobs', 1)):
+            with FakeICOS(make_jobs(2, 2, ['nuvlabox/a'])) as fake:
+                transitions = new_jm(fake, bulk_uri=bulk_uri).transitions()
+                for job_id in fake.jobs:
+                    transitions.lock(job_id)
+                    transitions.complete(job_id)
+                assert all(transitions.flush().values())
+                assert fake.count('PUT') == puts
+                assert all(j['state'] == JobManagerProxy.JOB_COMPLETED and j['locker']
+                           for j in fake.jobs.values())
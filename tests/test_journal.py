@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.journal import LaunchJournal
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from stubs import RecordingJM, StubNuvla, make_jobs
+
+
+class TestLaunchJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'journal.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replay(self):
+        journal = LaunchJournal(self.path)
+        journal.launched('g1', 'nuvlabox/a', 'app1', 'deployment/1')
+        journal.launched('g1', 'nuvlabox/b', 'app1', 'deployment/2')
+        journal.launched('g2', 'nuvlabox/a', 'app2', 'deployment/3')
+        journal.done('g2')
+        journal.close()
+        # A line cut short by a crash.
+        with open(self.path, 'a') as f:
+            f.write('{"op":"launched","group":"g3"')
+
+        journal = LaunchJournal(self.path)
+        assert len(journal) == 1
+        assert journal.deployment('g1', 'nuvlabox/b', 'app1') == 'deployment/2'
+        assert journal.deployment('g1', 'nuvlabox/b', 'app2') is None
+        assert journal.deployment('g2', 'nuvlabox/a', 'app2') is None
+        journal.close()
+        with open(self.path) as f:
+            assert len(f.readlines()) == 2
+
+    def test_compaction(self):
+        journal = LaunchJournal(self.path, compact_after=10)
+        for i in range(25):
+            journal.launched(f'g{i}', 'nuvlabox/a', 'app', f'deployment/{i}')
+            journal.done(f'g{i}')
+        journal.launched('g-last', 'nuvlabox/a', 'app', 'deployment/last')
+        journal.close()
+        with open(self.path) as f:
+            assert len(f.readlines()) == 11
+        assert len(LaunchJournal(self.path)) == 1
+
+    def _dm(self, nuvla: StubNuvla) -> DeploymentManagerNuvla:
+        config = DeployConf()
+        config.journal_path = self.path
+        return DeploymentManagerNuvla(nuvla, config)
+
+    def test_no_relaunch_after_crash(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(2)]
+        jobs = make_jobs(2, 1, targets)
+        jm = RecordingJM()
+        # Completion of the jobs does not reach the JM, as if the agent
+        # crashed right after launching.
+        jm.fail_on = {j['ID'] for j in jobs}
+        dm = self._dm(nuvla)
+        deployed = dm.deploy(jobs, jm)
+        dm.close()
+        assert nuvla.calls['operation'] == 4
+
+        dm = self._dm(nuvla)
+        jm = RecordingJM()
+        assert dm.deploy(jobs, jm) == deployed
+        assert nuvla.calls['operation'] == 4
+        assert sorted(jm.sent) == [('complete', j['ID']) for j in jobs]
+        assert len(dm.journal) == 0
+
+    def test_only_failed_targets_relaunched(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(2)]
+        flt = f'parent="{nuvla.search("infrastructure-service").resources[0].id}"'
+        nuvla.fail_launch_on = {nuvla.search('credential', filter=flt).resources[0].id}
+        jobs = make_jobs(1, 1, targets)
+        dm = self._dm(nuvla)
+        dm.deploy(jobs, RecordingJM())
+        assert nuvla.calls['operation'] == 2
+
+        nuvla.fail_launch_on = set()
+        nuvla.calls.clear()
+        jm = RecordingJM()
+        assert len(dm.deploy(jobs, jm)) == 2
+        assert nuvla.calls['operation'] == 1
+        assert jm.sent == [('complete', jobs[0]['ID'])]
@@ -0,0 +1,99 @@
+import unittest
+
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.limits import CircuitBreaker, TokenBucket
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla, \
+    rate_limit_nuvla
+from stubs import NestingNuvla, RecordingJM, StubNuvla, make_jobs
+from test_cache import FakeClock
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, burst=2, clock=clock, sleep=lambda x: None)
+        waits = [bucket.acquire() for _ in range(4)]
+        assert waits == [0, 0, 0.1, 0.2]
+        clock.now = 1
+        # Refilled up to the burst only.
+        assert [bucket.acquire() for _ in range(3)] == [0, 0, 0.1]
+
+    def test_rate_limited_nuvla(self):
+        slept = []
+        nuvla = rate_limit_nuvla(StubNuvla(), TokenBucket(
+            5, clock=FakeClock(), sleep=slept.append))
+        for _ in range(3):
+            nuvla.search('nuvlabox')
+        assert slept == [0.2, 0.4]
+        assert nuvla.calls['search'] == 3
+
+    def test_nested_calls_limited_once(self):
+        slept = []
+        nuvla = rate_limit_nuvla(NestingNuvla(), TokenBucket(
+            5, clock=FakeClock(), sleep=slept.append))
+        nuvla.add('module', {'path': 'app'})
+        nuvla.edit(nuvla.put('nuvlabox', {}), {'name': 'edge'})
+        # One token per add and edit.
+        assert slept == [0.2]
+        assert nuvla.calls == {'add': 1, 'search': 1, 'edit': 1, 'get': 1}
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_half_open_close(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(2, reset_timeout=10, clock=clock)
+        breaker.failure('a')
+        assert breaker.allow('a')
+        breaker.failure('a')
+        assert breaker.state('a') == CircuitBreaker.OPEN
+        assert not breaker.allow('a')
+        assert breaker.allow('b')
+
+        clock.now = 10
+        assert breaker.allow('a')
+        assert breaker.state('a') == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow('a')
+        breaker.failure('a')
+        assert breaker.state('a') == CircuitBreaker.OPEN
+
+        clock.now = 20
+        assert breaker.allow('a')
+        breaker.success('a')
+        assert breaker.state('a') == CircuitBreaker.CLOSED
+        assert breaker.open_keys() == []
+
+    def test_bad_target_skipped(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(3)]
+        flt = f'parent="{nuvla.search("infrastructure-service").resources[0].id}"'
+        nuvla.fail_launch_on = {nuvla.search('credential', filter=flt).resources[0].id}
+        config = DeployConf()
+        # Every cycle launches the groups again.
+        config.update_deployments = False
+        dm = DeploymentManagerNuvla(nuvla, config)
+        clock = FakeClock()
+        dm.breaker = CircuitBreaker(2, reset_timeout=60, clock=clock)
+        # One group on the bad target and one on the good ones.
+        jobs = make_jobs(1, 1, targets[:1]) + \
+            [dict(j, job_group_id='ok', ID='ok-job')
+             for j in make_jobs(1, 1, targets[1:])]
+
+        for _ in range(2):
+            dm.deploy(jobs, RecordingJM())
+        assert dm.breaker.open_keys() == [targets[0]]
+
+        nuvla.calls.clear()
+        jm = RecordingJM()
+        deployed = dm.deploy(jobs, jm)
+        assert {d['target'] for d in deployed} == set(targets[1:])
+        # Only the two launches on the good targets.
+        assert nuvla.calls['operation'] == 2
+        assert jm.sent == [('complete', 'ok-job')]
+
+        clock.now = 60
+        nuvla.fail_launch_on = set()
+        deployed = dm.deploy(jobs, RecordingJM())
+        assert targets[0] in {d['target'] for d in deployed}
+        assert dm.breaker.open_keys() == []
@@ -0,0 +1,108 @@
+import io
+import json
+import logging
+import queue
+import unittest
+from unittest import mock
+
+from icosagent import log as icos_log
+from icosagent.config.config import LogConf
+from icosagent.log import JsonFormatter, SamplingFilter, \
+    SuppressedFormatter, get_logger, setup_logging
+from test_cache import FakeClock
+
+
+def capture(formatter: logging.Formatter, *filters):
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(formatter)
+    for f in filters:
+        handler.addFilter(f)
+    log = logging.getLogger('test-log')
+    log.handlers = [handler]
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    return log, stream
+
+
+class Unprintable:
+
+    def __str__(self):
+        raise AssertionError('formatted')
+
+
+class TestLog(unittest.TestCase):
+
+    def test_json_fields(self):
+        log, stream = capture(JsonFormatter())
+        log.info('Launched app on %s with: %s', 'ne/1', 'deployment/1',
+                 extra={'group': 'g1', 'target': 'ne/1',
+                        'deployment': 'deployment/1'})
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            log.exception('Failed launching deployment: %s', 'g2',
+                          extra={'group': 'g2'})
+        first, second = [json.loads(x) for x in stream.getvalue().split('\n')
+                         if x]
+        assert first['message'] == 'Launched app on ne/1 with: deployment/1'
+        assert first['level'] == 'INFO'
+        assert first['logger'] == 'test-log'
+        assert (first['group'], first['target'], first['deployment']) == \
+            ('g1', 'ne/1', 'deployment/1')
+        assert 'job' not in first
+        assert second['group'] == 'g2'
+        assert 'ZeroDivisionError' in second['exception']
+
+    def test_sampling(self):
+        clock = FakeClock()
+        log, stream = capture(SuppressedFormatter('%(message)s'),
+                              SamplingFilter(2, 60, clock=clock))
+        for i in range(5):
+            log.warning('Target %s down', i)
+        log.warning('Other message')
+        clock.now = 60
+        log.warning('Target %s down', 5)
+        assert stream.getvalue().splitlines() == [
+            'Target 0 down', 'Target 1 down', 'Other message',
+            'Target 5 down [3 similar messages suppressed]']
+
+    def test_disabled_level_not_formatted(self):
+        log, stream = capture(JsonFormatter())
+        log.debug('Jobs: %s', Unprintable())
+        assert stream.getvalue() == ''
+
+    def test_queue(self):
+        conf = LogConf()
+        conf.format = 'json'
+        conf.queue = True
+        conf.queue_size = 1
+        stream = io.StringIO()
+        try:
+            with mock.patch('sys.stdout', stream):
+                handler = setup_logging(conf)
+                log = get_logger('test-log-queue')
+                assert handler in log.handlers
+                # With the writer thread stopped, the records wait on the
+                # queue.
+                icos_log._listener.stop()
+                args = ['deployment/1']
+                log.info('Launched %s', args, extra={'job': 'j1'})
+                args.append('deployment/2')
+                log.info('Dropped')
+                assert handler.dropped == 1
+                icos_log._listener.start()
+                icos_log._listener.stop()
+        finally:
+            setup_logging(LogConf())
+        entry = json.loads(stream.getvalue())
+        assert entry['message'] == "Launched ['deployment/1']"
+        assert entry['job'] == 'j1'
+        assert handler not in log.handlers
+
+    def test_queue_full_does_not_block(self):
+        handler = icos_log._NonBlockingQueueHandler(queue.Queue(1))
+        record = logging.makeLogRecord({'msg': 'x'})
+        handler.handle(record)
+        handler.handle(record)
+        assert handler.dropped == 1
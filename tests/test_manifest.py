@@ -0,0 +1,109 @@
+import traceback
+import unittest
+
+from icosagent.deploymngr.manifest import ManifestError, ManifestValidator
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from stubs import RecordingJM, StubNuvla, make_jobs
+
+POD = 'apiVersion: v1\nkind: Pod\nmetadata:\n  name: web\n'
+SERVICE = 'apiVersion: v1\nkind: Service\nmetadata:\n  name: web\n'
+
+
+class TestManifestValidator(unittest.TestCase):
+
+    def test_documents(self):
+        validator = ManifestValidator()
+        docs = validator.documents(f'---\n{POD}---\n# nothing\n---\n{SERVICE}')
+        assert [d.key for d in docs] == [('Pod', '', 'web'),
+                                         ('Service', '', 'web')]
+        assert docs[0].text == POD
+        assert validator.documents(POD + '# comment\n')[0].text == POD
+
+    def test_invalid(self):
+        validator = ManifestValidator(max_bytes=200, max_documents=2)
+        for manifest, error in (
+                ('', 'empty manifest'),
+                ('kind: [Pod', 'invalid YAML'),
+                ('- a\n- b\n', 'not a mapping'),
+                ('apiVersion: v1\nmetadata:\n  name: web\n', 'no kind'),
+                ('apiVersion: v1\nkind: Pod\n', 'no metadata'),
+                (POD.replace('web', 'Web_1'), 'invalid name'),
+                (POD.replace('web', 'web-'), 'invalid name'),
+                ('---\n'.join([POD] * 3), 'more than 2 documents'),
+                (POD + '#' * 200, 'larger than 200 bytes')):
+            with self.assertRaisesRegex(ManifestError, error):
+                validator.documents(manifest)
+
+    def test_valid_kubernetes(self):
+        validator = ManifestValidator()
+        role = 'apiVersion: rbac.authorization.k8s.io/v1\nkind: ClusterRole' \
+               '\nmetadata:\n  name: system:icos-reader\nrules: []\n'
+        assert validator.documents(role)[0].key == \
+            ('ClusterRole', '', 'system:icos-reader')
+        items = 'apiVersion: v1\nkind: List\nitems:\n- apiVersion: v1\n' \
+                '  kind: Pod\n  metadata:\n    name: web\n'
+        assert validator.documents(items)[0].key == ('List', '', 'Pod//web')
+        for manifest, error in (
+                (role.replace('system:', 'system/'), 'invalid name'),
+                ('apiVersion: v1\nkind: List\n', 'List in document 1 has '
+                                                   'no items'),
+                ('apiVersion: v1\nkind: List\nitems:\n- kind: Pod\n',
+                 'no apiVersion')):
+            with self.assertRaisesRegex(ManifestError, error):
+                validator.documents(manifest)
+
+    def test_cache(self):
+        validator = ManifestValidator()
+        for _ in range(3):
+            validator.documents(POD)
+            with self.assertRaises(ManifestError):
+                validator.documents('kind: [Pod')
+        assert validator.cache.stats() == {'hits': 4, 'misses': 2, 'size': 2}
+
+    def test_cached_error_raised_afresh(self):
+        validator = ManifestValidator()
+        errors = []
+        for _ in range(3):
+            with self.assertRaises(ManifestError) as ctx:
+                validator.documents('kind: [Pod')
+            errors.append(ctx.exception)
+        assert len({id(e) for e in errors}) == 3
+        assert len({str(e) for e in errors}) == 1
+        assert len(traceback.extract_tb(errors[2].__traceback__)) == \
+            len(traceback.extract_tb(errors[1].__traceback__))
+
+    def test_generate_name(self):
+        validator = ManifestValidator()
+        manifest = POD.replace('  name: web', '  generateName: web-')
+        assert validator.documents(manifest)[0].key == ('Pod', '', 'web-')
+        role = 'apiVersion: rbac.authorization.k8s.io/v1\nkind: Role\n' \
+               'metadata:\n  name: reader-\n'
+        assert validator.documents(role)[0].key == ('Role', '', 'reader-')
+
+    def test_join(self):
+        validator = ManifestValidator()
+        pod, service = validator.documents(POD), validator.documents(SERVICE)
+        assert validator.join([pod, service, pod]) == f'{POD}---\n{SERVICE}'
+        changed = validator.documents(POD + 'spec: {}\n')
+        with self.assertRaisesRegex(ManifestError, 'Pod web defined more'):
+            validator.join([pod, changed])
+
+
+class TestDeployValidation(unittest.TestCase):
+
+    def test_invalid_group_degraded_locally(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge()]
+        jobs = make_jobs(2, 2, targets)
+        jobs[1]['manifest'] = 'kind: [Pod'
+        dm = DeploymentManagerNuvla(nuvla)
+        jm = RecordingJM()
+        nuvla.calls.clear()
+        deployed = dm.deploy(jobs, jm)
+        assert [d['job'] for d in deployed] == ['group-1']
+        assert sorted(jm.sent) == [('complete', 'group-1-job-0'),
+                                   ('complete', 'group-1-job-1'),
+                                   ('degrade', 'group-0-job-0'),
+                                   ('degrade', 'group-0-job-1')]
+        # Only the valid group got as far as Nuvla.
+        assert nuvla.calls['operation'] == 1
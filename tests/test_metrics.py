@@ -0,0 +1,125 @@
+import unittest
+
+import requests
+
+from icosagent.config.config import ServerConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla, \
+    instrument_nuvla
+from icosagent.metrics import CONTENT_TYPE, METRICS_PATH, REGISTRY, \
+    Counter, Histogram, Registry
+from icosagent.server import AgentServer
+from fake_servers import FakeICOS
+from stubs import NestingNuvla, StubNuvla, make_jobs
+from test_jm import new_jm
+from test_scheduler import free_port
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render_histogram(self):
+        hist = Histogram('req_seconds', 'Latency.', buckets=(0.1, 1),
+                         labelnames=('call',))
+        hist.labels(call='get').observe(0.05)
+        hist.labels(call='get').observe(0.5)
+        hist.labels(call='put').observe(2)
+        assert hist.labels(call='get').count == 2
+        assert hist.render() == '''\
+# HELP req_seconds Latency.
+# TYPE req_seconds histogram
+req_seconds_bucket{call="get",le="0.1"} 1
+req_seconds_bucket{call="get",le="1"} 2
+req_seconds_bucket{call="get",le="+Inf"} 2
+req_seconds_sum{call="get"} 0.55
+req_seconds_count{call="get"} 2
+req_seconds_bucket{call="put",le="0.1"} 0
+req_seconds_bucket{call="put",le="1"} 0
+req_seconds_bucket{call="put",le="+Inf"} 1
+req_seconds_sum{call="put"} 2
+req_seconds_count{call="put"} 1
+'''
+
+    def test_registry(self):
+        registry = Registry()
+        counter = registry.counter('jobs_total', 'Jobs.')
+        assert registry.counter('jobs_total') is counter
+        with self.assertRaises(ValueError):
+            registry.gauge('jobs_total')
+        counter.inc(3)
+        size = [1]
+        registry.gauge('size', 'Size.', fn=lambda: size[0])
+        size[0] = 5
+        assert registry.render() == '''\
+# HELP jobs_total Jobs.
+# TYPE jobs_total counter
+jobs_total 3
+# HELP size Size.
+# TYPE size gauge
+size 5
+'''
+
+    def test_metrics_endpoint(self):
+        registry = Registry()
+        registry.counter('up', 'Up.').inc()
+        config = ServerConf()
+        config.host, config.port = '127.0.0.1', free_port()
+        server = AgentServer(config)
+        server.route('GET', METRICS_PATH, registry.handle_metrics)
+        server.start()
+        try:
+            resp = requests.get(f'http://127.0.0.1:{server.port}{METRICS_PATH}')
+            assert resp.headers['Content-Type'] == CONTENT_TYPE
+            assert 'up 1\n' in resp.text
+        finally:
+            server.stop()
+
+    def test_instrumented_calls(self):
+        def count(name, **labels) -> float:
+            metric = REGISTRY.get(name).labels(**labels)
+            return metric.count if isinstance(metric, Histogram) \
+                else metric.value
+
+        nuvla = instrument_nuvla(StubNuvla())
+        searches = count('nuvla_request_seconds', call='search',
+                         resource='credential')
+        dm = DeploymentManagerNuvla(nuvla)
+        dm.creds_for_targets([nuvla.add_edge()])
+        assert count('nuvla_request_seconds', call='search',
+                     resource='credential') == searches + 1
+
+        nuvla = instrument_nuvla(NestingNuvla())
+        adds, searches = (count('nuvla_request_seconds', call=call,
+                                resource='module')
+                          for call in ('add', 'search'))
+        nuvla.add('module', {'path': 'app'})
+        # The search made by add is observed as part of the add only.
+        assert count('nuvla_request_seconds', call='add',
+                     resource='module') == adds + 1
+        assert count('nuvla_request_seconds', call='search',
+                     resource='module') == searches
+
+        with FakeICOS(make_jobs(1, 2, ['nuvlabox/a'])) as fake:
+            jm = new_jm(fake)
+            puts = count('jm_request_seconds', call='put_job')
+            refreshes = count('keycloak_token_request_seconds',
+                              grant_type='refresh_token')
+            jm.deployments_to_launch()
+            jm.lock_job('group-0-job-0')
+            fake.revoke_tokens()
+            jm.lock_job('group-0-job-1')
+            assert count('jm_request_seconds', call='put_job') == puts + 3
+            assert count('keycloak_token_request_seconds',
+                         grant_type='refresh_token') == refreshes + 1
+
+            failures = count('jm_request_failures_total', call='put_job')
+            assert not jm.lock_job('no-such-job')
+            assert count('jm_request_failures_total', call='put_job') == \
+                failures + 1
+
+    def test_callback_metrics_replace(self):
+        registry = Registry()
+        DeploymentManagerNuvla(StubNuvla()).register_metrics(registry)
+        dm = DeploymentManagerNuvla(StubNuvla())
+        dm.register_metrics(registry)
+        dm.creds_for_targets([dm.nuvla.add_edge()])
+        assert registry.get('dm_creds_cache_misses_total').value == 1
+        assert isinstance(registry.get('dm_creds_cache_hits_total'), Counter)
@@ -0,0 +1,106 @@
+import unittest
+from collections import Counter
+
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla, \
+    infra_service_creds_by_ne_ids
+from icosagent.deploymngr.placement import CredentialSelector
+from stubs import RecordingJM, StubNuvla, make_jobs
+from test_cache import FakeClock
+
+
+class TestCredentialSelector(unittest.TestCase):
+
+    def test_least_loaded_valid(self):
+        nuvla = StubNuvla()
+        creds = [{'id': 'credential/a'}, {'id': 'credential/b'},
+                 {'id': 'credential/c', 'status': 'UNVALID'}]
+        for parent, state in (('credential/a', 'STARTED'),
+                              ('credential/a', 'STARTED'),
+                              ('credential/a', 'STOPPED'),
+                              ('credential/c', 'STARTED')):
+            nuvla.put('deployment', {'parent': parent, 'state': state})
+        clock = FakeClock()
+        selector = CredentialSelector(nuvla, ttl=60, clock=clock)
+        selector.refresh([creds])
+        assert nuvla.calls == {'search': 1}
+        assert selector.load('credential/a') == 2
+        assert [selector.choose(creds) for _ in range(4)] == [
+            'credential/b', 'credential/b', 'credential/a', 'credential/b']
+        selector.release('credential/a')
+        assert selector.choose(creds) == 'credential/a'
+
+        # Loads are got again only once expired.
+        selector.refresh([creds])
+        assert nuvla.calls == {'search': 1}
+        clock.now = 60
+        selector.refresh([creds])
+        assert nuvla.calls == {'search': 2}
+        assert selector.load('credential/b') == 0
+
+    def test_loads_aggregated(self):
+        nuvla = StubNuvla()
+        creds = [{'id': f'credential/{i}'} for i in range(12)]
+        for i in range(12):
+            for state in ['STARTED'] * i + ['STOPPED', 'ERROR']:
+                nuvla.put('deployment', {'parent': f'credential/{i}',
+                                         'state': state})
+        returned = []
+        search = nuvla.search
+
+        def counting_search(*args, **kwargs):
+            found = search(*args, **kwargs)
+            returned.extend(found.resources)
+            return found
+
+        nuvla.search = counting_search
+        selector = CredentialSelector(nuvla)
+        selector.refresh([creds])
+        assert [selector.load(c['id']) for c in creds] == list(range(12))
+        # Counted by Nuvla, 10 credentials per search, nothing returned.
+        assert nuvla.calls == {'search': 2}
+        assert returned == []
+
+    def test_no_choice(self):
+        nuvla = StubNuvla()
+        selector = CredentialSelector(nuvla)
+        single = [{'id': 'credential/a'}, {'id': 'credential/b',
+                                           'status': 'UNVALID'}]
+        selector.refresh([single])
+        assert nuvla.calls == {}
+        assert selector.choose(single) == 'credential/a'
+        invalid = [{'id': 'credential/c', 'status': 'UNVALID'}]
+        assert selector.choose(invalid) == 'credential/c'
+
+
+class TestPlacement(unittest.TestCase):
+
+    def test_creds_of_all_clusters(self):
+        nuvla = StubNuvla()
+        edge = nuvla.add_edge(clusters=2)
+        creds, _ = infra_service_creds_by_ne_ids(nuvla, [edge])
+        assert len({c['parent'] for c in creds[edge]}) == 2
+
+    def test_deploy_spreads_over_clusters(self):
+        nuvla = StubNuvla()
+        edge = nuvla.add_edge(clusters=2)
+        config = DeployConf()
+        # Every cycle launches the groups again.
+        config.update_deployments = False
+        dm = DeploymentManagerNuvla(nuvla, config)
+        nuvla.calls.clear()
+        deployed = dm.deploy(make_jobs(4, 1, [edge]), RecordingJM())
+        assert len(deployed) == 4
+        # Credentials, then the load of both in one more search.
+        assert nuvla.calls['search'] == 4
+        loads = Counter(r['parent'] for r in nuvla.resources.values()
+                        if r['resource-type'] == 'deployment')
+        assert sorted(loads.values()) == [2, 2]
+
+        # The next cycle keeps balancing without looking the loads up again.
+        nuvla.calls.clear()
+        dm.deploy(make_jobs(2, 1, [edge]), RecordingJM())
+        assert nuvla.calls['search'] == 0
+        loads = Counter(r['parent'] for r in nuvla.resources.values()
+                        if r['resource-type'] == 'deployment')
+        assert sorted(loads.values()) == [3, 3]
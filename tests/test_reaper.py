@@ -0,0 +1,112 @@
+import unittest
+
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.deploymngr.reaper import Reaper
+from stubs import RecordingJM, StubNuvla, make_jobs
+
+
+class TestReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.nuvla = StubNuvla()
+        targets = [self.nuvla.add_edge() for _ in range(2)]
+        self.dm = DeploymentManagerNuvla(self.nuvla)
+        jobs = make_jobs(3, 2, targets)
+        self.dm.deploy(jobs, RecordingJM())
+        # The first group is no longer on the JM.
+        self.jm = RecordingJM(jobs=jobs[2:])
+        self.group_0 = [r['id'] for r in self._resources('deployment')
+                        if r['module']['name'].startswith('app-0 ')]
+
+    def _resources(self, resource_type: str) -> list:
+        return [r for r in self.nuvla.resources.values()
+                if r['resource-type'] == resource_type]
+
+    def _reaper(self, **kwargs) -> Reaper:
+        kwargs = dict({'min_age': 0, 'page_size': 2, 'rate': 0}, **kwargs)
+        return Reaper(self.dm, self.jm, **kwargs)
+
+    def test_dry_run(self):
+        report = self._reaper(dry_run=True).reap()
+        assert sorted(report.stop) == sorted(self.group_0)
+        assert report.delete == report.modules == []
+        assert report.kept == 4 + 3
+        assert all(self.nuvla.resources[x]['state'] == 'STARTED'
+                   for x in self.group_0)
+
+    def test_stale_removed_over_passes(self):
+        reaper = self._reaper()
+        module_id = self.nuvla.resources[self.group_0[0]]['module']['id']
+        self.nuvla.calls.clear()
+        assert reaper.reap().total == 2
+        assert self.nuvla.calls['operation'] == 2
+        assert all(self.nuvla.resources[x]['state'] == 'STOPPED'
+                   for x in self.group_0)
+
+        assert sorted(reaper.reap().delete) == sorted(self.group_0)
+        assert len(self._resources('deployment')) == 4
+        assert reaper.reap().modules == [module_id]
+        assert module_id not in self.nuvla.resources
+        assert module_id not in self.dm._modules.values()
+        assert reaper.reap().total == 0
+        assert len(self._resources('module')) == 2
+
+    def test_young_and_legacy(self):
+        assert self._reaper(min_age=3600).reap().total == 0
+        legacy = self.nuvla.put('module', {
+            'parent-path': DeploymentManagerNuvla.PARENT_PATH,
+            'path': f'{DeploymentManagerNuvla.PARENT_PATH}/app-1712345678'})
+        report = self._reaper(dry_run=True).reap()
+        assert report.modules == [legacy]
+
+    def test_batch(self):
+        reaper = self._reaper(batch=1)
+        assert reaper.reap().total == 2
+        assert sum(self.nuvla.resources[x]['state'] == 'STOPPED'
+                   for x in self.group_0) == 1
+
+    def test_group_liveness(self):
+        # The same jobs in another order keep their deployments.
+        self.jm.jobs = list(reversed(self.jm.jobs))
+        assert self._reaper(dry_run=True).reap().stop == self.group_0
+        # A group with some of its jobs left keeps its deployments too.
+        self.jm.jobs = self.jm.jobs[::2]
+        assert self._reaper(dry_run=True).reap().stop == self.group_0
+
+    def test_module_of_live_group_kept(self):
+        # The deployments of a live group failed and were cleaned up.
+        for dpl_id in [r['id'] for r in self._resources('deployment')
+                       if r['module']['name'].startswith('app-1 ')]:
+            self.nuvla.delete(dpl_id)
+        report = self._reaper(dry_run=True).reap()
+        assert report.modules == []
+        # The deployments of the third group and all the modules.
+        assert report.kept == 2 + 3
+
+    def test_paged_by_creation_time(self):
+        path = DeploymentManagerNuvla.PARENT_PATH
+        for i in range(7):
+            self.nuvla.put('module', {
+                'parent-path': path, 'path': f'{path}/old-{i}',
+                'created': f'2020-01-0{1 + i // 3}T00:00:00+00:00'})
+        searches = []
+        search = self.nuvla.search
+
+        def recording_search(*args, **kwargs):
+            searches.append(kwargs)
+            return search(*args, **kwargs)
+
+        self.nuvla.search = recording_search
+        found = self._reaper()._search_all(
+            'module', f'parent-path="{path}"', 'id,path,created')
+        assert len(found) == len({x['id'] for x in found}) == 3 + 7
+        # Ties across pages are got by ID, and no offset is used.
+        assert {x['orderby'] for x in searches} == {'created:asc,id:asc',
+                                                    'id:asc'}
+        assert all('first' not in x for x in searches)
+
+    def test_no_jobs_skipped(self):
+        self.jm.jobs = []
+        assert self._reaper().reap().total == 0
+        assert all(r['state'] == 'STARTED'
+                   for r in self._resources('deployment'))
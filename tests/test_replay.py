@@ -0,0 +1,124 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+import dm as dm_main
+from icosagent.config.config import JobManagerConf
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.replay import Recording, ReplayJM, TrafficRecorder
+from stubs import make_jobs
+from test_cache import FakeClock
+
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_round_trip(self):
+        clock = FakeClock()
+        recorder = TrafficRecorder(self.path, clock=clock)
+        jobs = make_jobs(2, 1, ['nuvlabox/a'])
+        recorder.jobs(jobs)
+        clock.now += 1.5
+        # Only the new and changed jobs are recorded, not the ones locked.
+        changed = dict(jobs[1], manifest='changed')
+        recorder.jobs([dict(jobs[0], locker=True, state=2), changed,
+                       *make_jobs(3, 1, ['nuvlabox/a'])[2:]])
+        recorder.nuvla_call('add', 'deployment', 0.25)
+        recorder.close()
+
+        recording = Recording.load(self.path)
+        assert [(t, [j['ID'] for j in js]) for t, js in recording.arrivals] \
+            == [(0, ['group-0-job-0', 'group-1-job-0']),
+                (1.5, ['group-1-job-0', 'group-2-job-0'])]
+        assert recording.arrivals[1][1][0] == changed
+        assert recording.timings == {('add', 'deployment'): [0.25]}
+        assert recording.duration == 1.5
+        assert recording.latency()('add', 'credential') == 0.25
+        assert recording.latency()('get', 'deployment') == 0.0
+
+    def test_truncated(self):
+        recorder = TrafficRecorder(self.path)
+        recorder.jobs(make_jobs(2, 1, ['nuvlabox/a']))
+        recorder.close()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-12])
+        # What was written before the cut is loaded.
+        arrivals = Recording.load(self.path).arrivals
+        assert [len(jobs) for _, jobs in arrivals] == [2]
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_jm_serves_proxy(self):
+        replay_jm = ReplayJM()
+        jm = replay_jm.proxy(JobManagerConf())
+        replay_jm.arrive(make_jobs(2, 1, ['nuvlabox/a']))
+        jobs, modified = jm.fetch_deployments()
+        assert len(jobs) == 2 and modified
+        assert jm.fetch_deployments() == (jobs, False)
+        jm.lock_job('group-0-job-0')
+        jm.mark_job_as_completed('group-0-job-0')
+        assert [j['ID'] for j in jm.deployments_to_launch()] == \
+            ['group-1-job-0']
+        assert replay_jm.pending == 1
+        assert replay_jm.jobs['group-0-job-0']['state'] == \
+            JobManagerProxy.JOB_COMPLETED
+
+    def test_replay(self):
+        targets = ['nuvlabox/a', 'nuvlabox/b']
+        jobs = make_jobs(4, 1, targets)
+        recording = Recording([(0.0, jobs[:2]), (2.0, jobs[2:])],
+                              {('add', 'deployment'): [0.001]})
+        config = dm_main._replay_config('/nonexistent/dm.conf')
+        config.scheduler.min_interval = 0.01
+        config.scheduler.max_interval = 0.05
+        config.dm.confirm_started = False
+        report = dm_main.replay(recording, config, speed=10, drain=5)
+        assert report.finished == report.jobs == 4
+        assert report.elapsed < 5
+        assert len(report.delays) == 4
+        assert report.nuvla_calls > 0 and report.jm_requests > 0
+        assert '4/4 jobs finished' in report.summary()
+
+
+    def test_queue_wait_reported(self):
+        targets = [f'nuvlabox/{i}' for i in range(10)]
+        jobs = make_jobs(10, 1, targets, 1)
+        # Arriving faster than launched, two at a time.
+        recording = Recording([(0.1 * i, [job]) for i, job in
+                               enumerate(jobs)],
+                              {('add', 'deployment'): [0.02],
+                               ('operation', 'deployment'): [0.02]})
+        config = dm_main._replay_config('/nonexistent/dm.conf')
+        config.scheduler.min_interval = 0.01
+        config.dm.confirm_started = False
+        config.dm.queue_max_launches = 2
+        report = dm_main.replay(recording, config, speed=10, drain=5)
+        assert report.finished == 10
+        assert report.queue_wait.count == 10
+        assert report.queue_wait.mean > 0.05
+        assert report.queue_wait.quantile(0.99) > 0.01
+        assert 'work queue wait: p50' in report.summary()
+
+
+class TestRecordFile(unittest.TestCase):
+
+    def test_format(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        recorder = TrafficRecorder(path)
+        recorder.nuvla_call('get', 'nuvlabox', 0.1)
+        recorder.close()
+        with gzip.open(path, 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[0]['version'] == 1
+        assert lines[1]['nuvla'] == ['get', 'nuvlabox', 0.1]
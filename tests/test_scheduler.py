@@ -0,0 +1,57 @@
+import socket
+import threading
+import time
+import unittest
+
+import requests
+
+from icosagent.config.config import SchedulerConf, ServerConf
+from icosagent.scheduler import PollScheduler
+from icosagent.server import AgentServer
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def test_backoff(self):
+        scheduler = PollScheduler(SchedulerConf(), rand=lambda: 0.5)
+        delays = [scheduler.next_delay(PollScheduler.IDLE) for _ in range(7)]
+        assert delays == [1, 2, 4, 8, 16, 30, 30]
+        assert scheduler.next_delay(PollScheduler.BUSY) == 0
+        assert scheduler.next_delay(PollScheduler.ERROR) == 1
+        assert scheduler.next_delay(PollScheduler.ERROR) == 2
+
+    def test_jitter(self):
+        for rand, delay in ((0.0, 0.9), (1.0, 1.1)):
+            scheduler = PollScheduler(SchedulerConf(), rand=lambda: rand)
+            assert abs(scheduler.next_delay(PollScheduler.IDLE) - delay) < 1e-9
+
+    def _assert_wait_ends_early(self, scheduler: PollScheduler, trigger):
+        threading.Timer(0.1, trigger).start()
+        start = time.monotonic()
+        assert scheduler.wait(PollScheduler.IDLE) == 10
+        assert time.monotonic() - start < 1
+
+    def test_trigger(self):
+        config = SchedulerConf()
+        config.min_interval, config.jitter = 10, 0
+        scheduler = PollScheduler(config)
+        self._assert_wait_ends_early(scheduler, scheduler.trigger)
+
+        server_conf = ServerConf()
+        server_conf.host, server_conf.port = '127.0.0.1', free_port()
+        server = AgentServer(server_conf)
+        server.route('POST', PollScheduler.TRIGGER_PATH, scheduler.handle_trigger)
+        server.start()
+        url = f'http://127.0.0.1:{server.port}{PollScheduler.TRIGGER_PATH}'
+        try:
+            scheduler.next_delay(PollScheduler.BUSY)
+            self._assert_wait_ends_early(scheduler, lambda: requests.post(url))
+            assert requests.get(url).status_code == 404
+        finally:
+            server.stop()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
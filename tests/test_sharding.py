@@ -0,0 +1,177 @@
+import threading
+import time
+import unittest
+from collections import Counter
+from datetime import datetime, timezone
+
+import dm as dm_main
+from icosagent.config.config import DeployConf
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.jobmngr.jm import JobManagerProxy
+from icosagent.jobmngr.sharding import JobSharding, replica_index
+from icosagent.jobmngr.sync import JobSync
+from fake_servers import FakeICOS
+from stubs import StubNuvla, make_jobs
+from test_jm import new_jm
+
+REPLICAS = 3
+
+
+class TestJobSharding(unittest.TestCase):
+
+    def test_replica_index(self):
+        assert replica_index('2') == 2
+        assert replica_index('icos-agent-dm-11') == 11
+        with self.assertRaises(ValueError):
+            replica_index('icos-agent-dm')
+        with self.assertRaises(ValueError):
+            JobSharding(REPLICAS, REPLICAS)
+
+    def test_each_group_has_one_owner(self):
+        shards = [JobSharding(REPLICAS, i) for i in range(REPLICAS)]
+        jobs = make_jobs(300, 2, ['nuvlabox/a'])
+        selected = [shard.select(jobs) for shard in shards]
+        owners = Counter(j['ID'] for jobs in selected for j in jobs)
+        assert sorted(owners) == sorted(j['ID'] for j in jobs)
+        assert set(owners.values()) == {1}
+        for jobs in selected:
+            assert 150 < len(jobs) < 250
+
+    def test_lease_moves_group_to_next_replica(self):
+        now = 1712170520.0
+        shards = [JobSharding(REPLICAS, i, lease=60, clock=lambda: now)
+                  for i in range(REPLICAS)]
+        ranking = shards[0].ranking('group-0')
+        job = make_jobs(1, 1, ['nuvlabox/a'])[0]
+        for age, owner in ((0, 0), (59, 0), (60, 1), (150, 2), (180, 0)):
+            job['created_at'] = datetime.fromtimestamp(
+                now - age, timezone.utc).isoformat()
+            assert [bool(s.select([job])) for s in shards] == \
+                [i == ranking[owner] for i in range(REPLICAS)]
+
+    def test_locked_jobs_not_selected(self):
+        shards = [JobSharding(REPLICAS, i) for i in range(REPLICAS)]
+        job = dict(make_jobs(1, 1, ['nuvlabox/a'])[0], locker=True)
+        assert not any(s.select([job]) for s in shards)
+
+    def test_lock_lease(self):
+        now = [1712170520.0]
+        shards = [JobSharding(REPLICAS, i, lease=60, lock_lease=100,
+                              clock=lambda: now[0]) for i in range(REPLICAS)]
+        ranking = shards[0].ranking('group-0')
+        job = dict(make_jobs(1, 1, ['nuvlabox/a'])[0], locker=True,
+                   state=JobManagerProxy.JOB_PROCESSING,
+                   **shards[ranking[1]].lease_fields())
+        # Held by the replica that locked it, then moved along the ranking.
+        for age, owner in ((0, 1), (99, 1), (100, 2), (250, 0), (300, 1)):
+            now[0] = 1712170520.0 + age
+            assert [shards[i].lock_owner(job) for i in range(REPLICAS)] == \
+                [ranking[owner]] * REPLICAS
+            # Never taken over by the replica holding the lock.
+            assert [bool(s.select([job])) for s in shards] == \
+                [i == ranking[owner] != ranking[1] for i in range(REPLICAS)]
+        done = dict(job, state=JobManagerProxy.JOB_COMPLETED)
+        assert not any(s.select([done]) for s in shards)
+
+    def test_crashed_replica_taken_over(self):
+        now = [1712170520.0]
+        ranking = JobSharding(REPLICAS, 0).ranking('group-0')
+        nuvla = StubNuvla()
+        job = make_jobs(1, 1, [nuvla.add_edge()])[0]
+
+        class Crash(BaseException):
+            pass
+
+        def crash(*args, **kwargs):
+            raise Crash()
+
+        def replica(owner: int, api: StubNuvla) -> DeploymentManagerNuvla:
+            config = DeployConf()
+            config.replicas, config.replica = REPLICAS, str(ranking[owner])
+            dm = DeploymentManagerNuvla(api, config)
+            dm.sharding = JobSharding(REPLICAS, ranking[owner], lease=60,
+                                      clock=lambda: now[0])
+            return dm
+
+        with FakeICOS([job]) as fake:
+            # The owner dies right after locking the jobs.
+            crashing = StubNuvla()
+            crashing.resources = nuvla.resources
+            crashing.add = crash
+            jm = new_jm(fake)
+            with self.assertRaises(Crash):
+                replica(0, crashing).deploy(jm.deployments_to_launch(), jm)
+            assert fake.jobs[job['ID']]['locker']
+            assert fake.jobs[job['ID']]['locked_by'] == ranking[0]
+
+            others = [(replica(i, nuvla), JobSync(new_jm(fake)))
+                      for i in (1, 2)]
+            for dm, sync in others:
+                dm_main.cycle(sync, dm)
+            assert fake.jobs[job['ID']]['state'] == \
+                JobManagerProxy.JOB_PROCESSING
+            now[0] += 60
+            for dm, sync in others:
+                dm.sharding._reclaim_at = 0.0
+                dm_main.cycle(sync, dm)
+            assert fake.jobs[job['ID']]['state'] == \
+                JobManagerProxy.JOB_COMPLETED
+            assert fake.jobs[job['ID']]['locked_by'] == ranking[1]
+        assert sum(r['id'].startswith('deployment/')
+                   for r in nuvla.resources.values()) == 1
+
+    def test_lease_ends_mid_launch(self):
+        now = [1712170520.0]
+        ranking = JobSharding(REPLICAS, 0).ranking('group-0')
+        nuvla = StubNuvla(latency=0.05)
+        job = make_jobs(1, 1, [nuvla.add_edge()])[0]
+        job['created_at'] = datetime.fromtimestamp(
+            now[0] - 59, timezone.utc).isoformat()
+
+        def replica(owner: int) -> DeploymentManagerNuvla:
+            config = DeployConf()
+            config.replicas, config.replica = REPLICAS, str(ranking[owner])
+            dm = DeploymentManagerNuvla(nuvla, config)
+            dm.sharding = JobSharding(REPLICAS, ranking[owner], lease=60,
+                                      clock=lambda: now[0])
+            return dm
+
+        with FakeICOS([job]) as fake:
+            jm = new_jm(fake)
+            launch = threading.Thread(target=replica(0).deploy, args=(
+                jm.deployments_to_launch(), jm))
+            launch.start()
+            while not nuvla.calls['add']:
+                time.sleep(0.005)
+            # The lease runs out while the first replica is launching.
+            now[0] += 2
+            assert replica(1).deploy(jm.deployments_to_launch(), jm) == []
+            launch.join()
+            assert fake.jobs[job['ID']]['state'] == \
+                JobManagerProxy.JOB_COMPLETED
+        assert sum(r['id'].startswith('deployment/')
+                   for r in nuvla.resources.values()) == 1
+
+    def test_replicas_launch_each_group_once(self):
+        nuvla = StubNuvla(latency=0.001)
+        targets = [nuvla.add_edge() for _ in range(4)]
+        with FakeICOS(make_jobs(60, 2, targets)) as fake:
+            def run(index: int):
+                config = DeployConf()
+                config.replicas, config.replica = REPLICAS, f'dm-{index}'
+                dm = DeploymentManagerNuvla(nuvla, config)
+                jm = new_jm(fake)
+                dm.deploy(jm.deployments_to_launch(), jm)
+
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(REPLICAS)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert all(j['state'] == JobManagerProxy.JOB_COMPLETED
+                       for j in fake.jobs.values())
+        launched = Counter(r['module']['id'] for r in nuvla.resources.values()
+                           if r['id'].startswith('deployment/'))
+        assert len(launched) == 60
+        assert set(launched.values()) == {len(targets)}
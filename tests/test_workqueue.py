@@ -0,0 +1,75 @@
+import unittest
+
+import dm as dm_main
+from icosagent.deploymngr.nuvla import DeploymentManagerNuvla
+from icosagent.jobmngr.sync import JobSync
+from icosagent.jobmngr.workqueue import WorkQueue
+from icosagent.scheduler import PollScheduler
+from fake_servers import FakeICOS
+from stubs import StubNuvla, make_jobs
+from test_jm import new_jm
+
+
+def group(gid: str, targets: int = 1, **attrs) -> list:
+    return [dict(job, job_group_id=gid, ID=f'{gid}-{job["ID"]}', **attrs)
+            for job in make_jobs(1, 1, [f'nuvlabox/{i}'
+                                        for i in range(targets)])]
+
+
+def gids(jobs: list) -> list:
+    return list(dict.fromkeys(j['job_group_id'] for j in jobs))
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def test_order(self):
+        queue = WorkQueue()
+        queue.put(group('a') + group('b', deadline='2030-01-01T00:00:00') +
+                  group('c', priority=1) +
+                  group('d', deadline='2029-01-01T00:00:00') + group('e'))
+        assert gids(queue.take()) == ['c', 'd', 'b', 'a', 'e']
+        assert len(queue) == 0
+
+    def test_launch_budget(self):
+        queue = WorkQueue(max_launches=4)
+        queue.put(group('big', 10) + group('s1') + group('mid', 3) +
+                  group('s2'))
+        # The first group is taken even when over the budget.
+        assert gids(queue.take()) == ['big']
+        # A group not fitting in what is left is skipped for smaller ones.
+        queue.put(group('s3', 2) + group('big2', 10))
+        assert gids(queue.take()) == ['s1', 'mid']
+        assert gids(queue.take()) == ['s2', 's3']
+        assert gids(queue.take()) == ['big2']
+
+    def test_put_updates_and_prunes(self):
+        queue = WorkQueue()
+        queue.put(group('a') + group('b'))
+        changed = group('a', priority=2)
+        queue.put(changed)
+        queue.put(group('c') + changed, full=True)
+        assert queue.take() == changed + group('c')
+
+    def test_full(self):
+        queue = WorkQueue(max_groups=2)
+        assert queue.put(group('a') + group('b')) == 0
+        # Lower priority than the queued groups, left out.
+        assert queue.put(group('c')) == 1
+        # Higher, evicts the group that would be taken last.
+        assert queue.put(group('d', priority=1)) == 1
+        assert gids(queue.take()) == ['d', 'a']
+
+
+class TestCycleWithQueue(unittest.TestCase):
+
+    def test_deploys_over_cycles(self):
+        nuvla = StubNuvla()
+        targets = [nuvla.add_edge() for _ in range(4)]
+        with FakeICOS(make_jobs(3, 1, targets), etags=True) as fake:
+            sync = JobSync(new_jm(fake))
+            dm = DeploymentManagerNuvla(nuvla)
+            queue = WorkQueue(max_launches=4)
+            outcomes = [dm_main.cycle(sync, dm, queue=queue)
+                        for _ in range(4)]
+            assert outcomes == [PollScheduler.BUSY] * 3 + [PollScheduler.IDLE]
+            assert all(j.get('locker') for j in fake.jobs.values())